@@ -81,6 +81,17 @@ class AbstractCollector(object):
             )
             raise
 
+    def siblings(self):
+        """
+        :return: [] of collectors of the same class of the object, this one included
+        """
+        collectors = [
+            collector for collector in self.object.collectors
+            if collector.__class__ is self.__class__ and collector is not self
+        ]
+        collectors.append(self)
+        return collectors
+
     def register(self, *methods):
         """
         Register methods for collecting
@@ -3,8 +3,13 @@ import time
 
 from amplify.agent.collectors.abstract import AbstractCollector
 from amplify.agent.common.context import context
+from amplify.agent.common.util.budget import WorkBudget, DEFAULT_MAX_TIME, DEFAULT_MAX_LINES
+from amplify.agent.common.util.intern import InternTable
+from amplify.agent.common.util.pool import ProcessPool
+from amplify.agent.data.statsd import StatsdBatch
 from amplify.agent.pipelines.abstract import Pipeline
-from amplify.agent.pipelines.file import FileTail
+from amplify.agent.pipelines.file import FileTail, FileTailSubscriber, read_range, save_offsets
+from amplify.agent.objects.nginx.filters import FilterMatcher
 from amplify.agent.objects.nginx.log.access import NginxAccessLogParser
 
 
@@ -16,6 +21,53 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
+DEFAULT_MAX_LINE_LENGTH = 32 * 1024  # 32 KB
+DEFAULT_FILTER_CACHE_SIZE = 10000
+DEFAULT_PARSE_WORKERS = 0  # parse in the collector
+DEFAULT_PARSE_WORKERS_MIN_SIZE = 4 * 1024 * 1024  # 4 MB
+
+# shared by all access log collectors, started on first use
+PARSE_POOL = {}
+
+
+def parse_range(args):
+    """
+    Parses a line-aligned range of a log file in a pool worker.
+    The range is read once and parsed for every collector of the file.
+
+    :param args: (filename, start, end, [] of (log_format, filters) of collectors, new_timer of StatsdClient)
+    :return: [] of (int number of lines, StatsdBatch of pre-aggregated metrics) for every collector
+    """
+    filename, start, end, parsers, new_timer = args
+    collectors = [
+        NginxAccessLogsCollector(
+            object=ParseWorkerObject(filters, new_timer), filename=filename, log_format=log_format, tail=[]
+        )
+        for log_format, filters in parsers
+    ]
+
+    count = 0
+    for chunk in read_range(filename, start, end):
+        count += chunk.count('\n') + 1
+        for collector in collectors:
+            for parsed in collector.parser.parse_batch(chunk, record=True):
+                collector.collect_parsed(parsed)
+
+    return [(count, collector.statsd) for collector in collectors]
+
+
+class ParseWorkerObject(object):
+    """
+    Minimal replacement of NginxObject for access log collectors running in pool workers
+    """
+    in_container = False
+    definition_hash = 'parse_worker'
+
+    def __init__(self, filters, new_timer):
+        self.filters = filters
+        self.statsd = StatsdBatch(new_timer=new_timer)
+
+
 class NginxAccessLogsCollector(AbstractCollector):
     short_name = 'nginx_alog'
 
@@ -55,6 +107,35 @@ class NginxAccessLogsCollector(AbstractCollector):
         'nginx.upstream.request.count': None
     }
 
+    # keys of parsed lines used by methods (upstreams uses every key which starts with "upstream")
+    method_keys = {
+        'http_method': ('request_method',),
+        'http_status': ('status',),
+        'http_version': ('server_protocol',),
+        'request_length': ('request_length',),
+        'body_bytes_sent': ('body_bytes_sent',),
+        'bytes_sent': ('bytes_sent',),
+        'gzip_ration': ('gzip_ratio',),
+        'request_time': ('request_time',),
+        'upstreams': (),
+    }
+
+    # metrics with constant names, counted by registry ids
+    metric_names = (
+        'nginx.http.request.malformed',
+        'nginx.http.request.length',
+        'nginx.http.request.body_bytes_sent',
+        'nginx.http.request.bytes_sent',
+        'nginx.http.gzip.ratio',
+        'nginx.http.request.time',
+        'nginx.upstream.response.length',
+        'nginx.upstream.connect.time',
+        'nginx.upstream.response.time',
+        'nginx.upstream.header.time',
+        'nginx.upstream.next.count',
+        'nginx.upstream.request.count',
+    )
+
     valid_http_methods = (
         'head',
         'get',
@@ -77,17 +158,40 @@ class NginxAccessLogsCollector(AbstractCollector):
     def __init__(self, filename=None, log_format=None, tail=None, **kwargs):
         super(NginxAccessLogsCollector, self).__init__(**kwargs)
         self.filename = filename
-        self.parser = NginxAccessLogParser(log_format)
+        self.log_format = log_format
+        nginx_config = context.app_config['containers'].get('nginx', {})
+        max_line_length = nginx_config.get('max_log_line_length', DEFAULT_MAX_LINE_LENGTH)
+        self.parse_workers = int(nginx_config.get('log_parse_workers', DEFAULT_PARSE_WORKERS))
+        self.parse_workers_min_size = int(
+            nginx_config.get('log_parse_workers_min_size', DEFAULT_PARSE_WORKERS_MIN_SIZE)
+        )
+        self.parser = NginxAccessLogParser(log_format, max_line_length=int(max_line_length))
         self.tail = tail if tail is not None else FileTail(filename)
+        self.budget = WorkBudget(
+            max_time=float(nginx_config.get('log_collect_time', DEFAULT_MAX_TIME)),
+            max_lines=int(nginx_config.get('log_collect_lines', DEFAULT_MAX_LINES))
+        )
+        self.backlog = 0  # unread bytes left by the last collect
         self.filters = []
+        self.filter_matcher = None
+        self.object_filters = None
+        self.statsd = self.object.statsd  # replaced with a local batch during collect
+
+        # metrics are counted by ids of the object registry
+        self.registry = self.object.statsd.registry
+        self.keys = dict((metric_name, self.registry.key(metric_name)) for metric_name in self.metric_names)
+        self.upstream_timers = tuple(
+            (self.keys['nginx.upstream.%s.time' % name], 'upstream_%s_time' % name)
+            for name in ('connect', 'response', 'header')
+        )
+        self.filter_keys = {}  # (metric key, filter_rule_id) -> key of the custom metric
 
-        # skip empty filters and filters for other log file
-        for log_filter in self.object.filters:
-            if log_filter.empty:
-                continue
-            if log_filter.filename and log_filter.filename != self.filename:
-                continue
-            self.filters.append(log_filter)
+        # metric keys for raw values, e.g. 'GET' -> key of 'nginx.http.method.get'
+        self.method_metrics = InternTable(self._method_metric)
+        self.status_metrics = InternTable(self._status_metrics)
+        self.version_metrics = InternTable(self._version_metric)
+        self.upstream_status_metrics = InternTable(self._upstream_status_metric)
+        self.cache_metrics = InternTable(self._cache_metric)
 
         self.register(
             self.http_method,
@@ -101,6 +205,56 @@ class NginxAccessLogsCollector(AbstractCollector):
             self.upstreams,
         )
 
+        self.setup_filters()
+
+    def setup_filters(self):
+        """
+        Picks filters of the object for this log and limits the parser to the keys metrics and filters use
+        """
+        self.object_filters = list(self.object.filters)
+        self.filters = []
+
+        # skip empty filters and filters for other log file
+        for log_filter in self.object_filters:
+            if log_filter.empty:
+                continue
+            if log_filter.filename and log_filter.filename != self.filename:
+                continue
+            self.filters.append(log_filter)
+
+        cache_size = context.app_config['containers'].get('nginx', {}).get(
+            'filter_cache_size', DEFAULT_FILTER_CACHE_SIZE
+        )
+        self.filter_matcher = FilterMatcher(self.filters, cache_size=int(cache_size))
+        self.parser.project(self.required_keys())
+
+        self.filter_keys = {}
+        for log_filter in self.filters:
+            custom_metric_name = '%s||%s' % (log_filter.metric, log_filter.filter_rule_id)
+            metric_key = self.registry.key(log_filter.metric)
+            self.filter_keys[(metric_key, log_filter.filter_rule_id)] = self.registry.key(custom_metric_name)
+
+        # collectors of a shared file parse its ranges for each other
+        if isinstance(self.tail, FileTailSubscriber) and self.parse_workers:
+            self.tail.parse_args = (self.log_format, self.filters)
+
+    def required_keys(self):
+        """
+        Collects keys used by registered methods and filters
+
+        :return: set of keys
+        """
+        keys = set()
+        for method in self.methods:
+            keys.update(self.method_keys.get(method.__name__, ()))
+            if method.__name__ == 'upstreams':
+                keys.update(key for key in self.parser.keys if key.startswith('upstream'))
+
+        for log_filter in self.filters:
+            keys.update(log_filter.data)
+
+        return keys
+
     def init_counters(self, counters=None):
         for counter, key in self.counters.iteritems():
             # If keys are in the parser format (access log) or not defined (error log)
@@ -109,43 +263,201 @@ class NginxAccessLogsCollector(AbstractCollector):
 
         # init counters for custom filters
         for counter in set(f.metric for f in self.filters):
-            self.count_custom_filter(self.filters, counter, 0, self.object.statsd.incr)
+            self.count_custom_filter(self.filters, self.registry.key(counter), 0, self.object.statsd.incr)
 
     def collect(self):
+        # filters could be changed since the last collect
+        if self.object.filters != self.object_filters:
+            self.setup_filters()
+
         self.init_counters()  # set all counters to 0
 
+        # aggregate locally and merge to the object statsd once
+        self.statsd = StatsdBatch(self.registry, self.object.statsd.new_timer)
+        self.budget.start()
+        start_time = time.time()
+        try:
+            count = 0
+            if isinstance(self.tail, FileTailSubscriber):
+                # ranges of a shared file parsed by other collectors
+                for lines, batch in self.tail.take_parsed():
+                    count += lines
+                    self.statsd.update(batch)
+
+            if self.parse_workers and hasattr(self.tail, 'read_ranges') and \
+                    self.tail.unread_size() >= self.parse_workers_min_size:
+                count += self.collect_ranges()
+            elif hasattr(self.tail, 'read_chunks'):
+                count += self.collect_chunks()
+            else:
+                count += self.collect_lines()
+        finally:
+            batch, self.statsd = self.statsd, self.object.statsd
+            self.object.statsd.merge(batch)
+        elapsed = time.time() - start_time
+
+        if isinstance(self.tail, (FileTail, FileTailSubscriber)):
+            save_offsets()
+
+        # the rest is read by the next collect
+        if hasattr(self.tail, 'unread_size'):
+            backlog = self.backlog = self.tail.unread_size()
+            # the gauge is the object's, so it's the total of all of its logs
+            self.object.statsd.agent(
+                'amplify.agent.nginx_alog.backlog', sum(collector.backlog for collector in self.siblings())
+            )
+            if self.budget.exhausted:
+                context.log.debug('%s left %s bytes of %s for the next collect' % (
+                    self.object.definition_hash, backlog, self.tail.name
+                ))
+
+        # the gauges are the object's, so they are computed over the matchers of all of its logs
+        matchers = [collector.filter_matcher for collector in self.siblings()]
+        hits = sum(matcher.cache_hits for matcher in matchers)
+        lookups = hits + sum(matcher.cache_misses for matcher in matchers)
+        if lookups:
+            self.object.statsd.agent('amplify.agent.filters.cache.hit_ratio', float(hits) / lookups)
+            self.object.statsd.agent(
+                'amplify.agent.filters.cache.size', sum(len(matcher.cache or ()) for matcher in matchers)
+            )
+
+        tail_name = self.tail.name if isinstance(self.tail, Pipeline) else 'list'
+        context.log.debug('%s processed %s lines from %s in %.3f (%.0f lines/s)' % (
+            self.object.definition_hash, count, tail_name, elapsed, count / elapsed if elapsed else 0
+        ))
+
+    def collect_lines(self):
+        """
+        Parses the tail line by line until the budget is exhausted
+
+        :return: int number of lines
+        """
         count = 0
         for line in self.tail:
             count += 1
 
-            # release GIL every 1000 of lines
-            if count % 1000 == 0:
-                time.sleep(0.001)
-
             try:
-                parsed = self.parser.parse(line)
+                parsed = self.parser.parse(line, record=True)
             except:
                 context.log.debug('could not parse line %s' % line, exc_info=True)
                 parsed = None
 
-            if not parsed:
-                continue
+            if parsed:
+                self.collect_parsed(parsed)
 
-            if parsed['malformed']:
-                self.request_malformed()
-            else:
-                # try to match custom filters and collect log metrics with them
-                matched_filters = [filter for filter in self.filters if filter.match(parsed)]
-                super(NginxAccessLogsCollector, self).collect(parsed, matched_filters)
+            # the budget is checked every 1000 of lines
+            if count % 1000 == 0 and not self.budget.spend(1000):
+                break
 
-        tail_name = self.tail.name if isinstance(self.tail, Pipeline) else 'list'
-        context.log.debug('%s processed %s lines from %s' % (self.object.definition_hash, count, tail_name))
+        return count
+
+    def collect_chunks(self):
+        """
+        Parses the tail chunk by chunk with the batch parser until the budget is exhausted
+
+        :return: int number of lines
+        """
+        count = 0
+        chunks = self.tail.read_chunks()
+        try:
+            for chunk in chunks:
+                lines = chunk.count('\n') + 1
+                count += lines
+
+                for parsed in self.parser.parse_batch(chunk, record=True):
+                    self.collect_parsed(parsed)
+
+                # the budget is checked after every chunk
+                if not self.budget.spend(lines):
+                    break
+        finally:
+            chunks.close()
+
+        return count
+
+    def collect_ranges(self):
+        """
+        Splits the unread part of the log into ranges and parses them in pool workers.
+        Ranges of a shared file are parsed for all of its collectors at once.
+
+        :return: int number of lines
+        """
+        ranges = self.tail.read_ranges(self.parse_workers)
+        if not ranges:
+            # chunks queued for the subscriber of a shared file go first
+            return self.collect_chunks()
+
+        if isinstance(self.tail, FileTailSubscriber):
+            subscribers = self.tail.range_subscribers()
+        else:
+            subscribers = [self.tail]
+        parsers = [
+            (self.log_format, self.filters) if subscriber is self.tail else subscriber.parse_args
+            for subscriber in subscribers
+        ]
+        new_timer = self.object.statsd.new_timer
+        tasks = [(self.tail.filename, start, end, parsers, new_timer) for start, end in ranges]
+
+        if self.parse_workers not in PARSE_POOL:
+            PARSE_POOL[self.parse_workers] = ProcessPool(self.parse_workers)
+
+        try:
+            results = PARSE_POOL[self.parse_workers].map(parse_range, tasks)
+        except:
+            context.log.error('%s failed to parse log in workers, parsing in collector' % self.short_name)
+            context.log.debug('additional info:', exc_info=True)
+            results = self.parse_ranges(tasks)
+
+        count = 0
+        for (start, end), parsed in zip(ranges, results):
+            for subscriber, (lines, batch) in zip(subscribers, parsed):
+                if subscriber is self.tail:
+                    count += lines
+                    self.statsd.update(batch)
+                else:
+                    subscriber.put_parsed(lines, batch, end - start)
+
+        if isinstance(self.tail, FileTailSubscriber):
+            self.tail.ranges_parsed(ranges[:len(results)])
+
+        return count
+
+    def parse_ranges(self, tasks):
+        """
+        Parses ranges in the collector until the budget is exhausted, the rest is read again by the next collect
+
+        :param tasks: [] of parse_range() arguments
+        :return: [] of parse_range() results of parsed ranges
+        """
+        results = []
+        for task in tasks:
+            results.append(parse_range(task))
+            if not self.budget.spend(results[-1][0][0]):
+                break
+
+        if len(results) < len(tasks):
+            self.tail.rewind(tasks[len(results)][1])  # the start of the first range left
+
+        return results
+
+    def collect_parsed(self, parsed):
+        """
+        Collects metrics from a parsed line
+
+        :param parsed: {} of parsed line
+        """
+        if parsed['malformed']:
+            self.request_malformed()
+        else:
+            # try to match custom filters and collect log metrics with them
+            matched_filters = self.filter_matcher.match(parsed) if self.filters else []
+            super(NginxAccessLogsCollector, self).collect(parsed, matched_filters)
 
     def request_malformed(self):
         """
         nginx.http.request.malformed
         """
-        self.object.statsd.incr('nginx.http.request.malformed')
+        self.statsd.incr(self.keys['nginx.http.request.malformed'])
 
     def http_method(self, data, matched_filters=None):
         """
@@ -161,12 +473,15 @@ class NginxAccessLogsCollector(AbstractCollector):
         :param matched_filters: [] of matched filters
         """
         if 'request_method' in data:
-            method = data['request_method'].lower()
-            method = method if method in self.valid_http_methods else 'other'
-            metric_name = 'nginx.http.method.%s' % method
-            self.object.statsd.incr(metric_name)
+            metric_key = self.method_metrics[data['request_method']]
+            self.statsd.incr(metric_key)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+                self.count_custom_filter(matched_filters, metric_key, 1, self.statsd.incr)
+
+    def _method_metric(self, method):
+        method = method.lower()
+        method = method if method in self.valid_http_methods else 'other'
+        return self.registry.key('nginx.http.method.%s' % method)
 
     def http_status(self, data, matched_filters=None):
         """
@@ -181,16 +496,16 @@ class NginxAccessLogsCollector(AbstractCollector):
         :param matched_filters: [] of matched filters
         """
         if 'status' in data:
-            metric_name = 'nginx.http.status.%sxx' % data['status'][0]
-            self.object.statsd.incr(metric_name)
-            if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
-
-            if data['status'] == '499':
-                metric_name = 'nginx.http.status.discarded'
-                self.object.statsd.incr(metric_name)
+            for metric_key in self.status_metrics[data['status']]:
+                self.statsd.incr(metric_key)
                 if matched_filters:
-                    self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+                    self.count_custom_filter(matched_filters, metric_key, 1, self.statsd.incr)
+
+    def _status_metrics(self, status):
+        metric_names = ('nginx.http.status.%sxx' % status[0],)
+        if status == '499':
+            metric_names += ('nginx.http.status.discarded',)
+        return tuple(self.registry.key(metric_name) for metric_name in metric_names)
 
     def http_version(self, data, matched_filters=None):
         """
@@ -203,28 +518,33 @@ class NginxAccessLogsCollector(AbstractCollector):
         :param matched_filters: [] of matched filters
         """
         if 'server_protocol' in data:
-            proto = data['server_protocol']
-            if not proto.startswith('HTTP'):
+            metric_key = self.version_metrics[data['server_protocol']]
+            if metric_key is None:
                 return
 
-            version = proto.split('/')[-1]
-
-            # Ordered roughly by expected popularity to reduce number of calls to `startswith`
-            if version.startswith('1.1'):
-                suffix = '1_1'
-            elif version.startswith('2.0'):
-                suffix = '2'
-            elif version.startswith('1.0'):
-                suffix = '1_0'
-            elif version.startswith('0.9'):
-                suffix = '0_9'
-            else:
-                suffix = version.replace('.', '_')
-
-            metric_name = 'nginx.http.v%s' % suffix
-            self.object.statsd.incr(metric_name)
+            self.statsd.incr(metric_key)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+                self.count_custom_filter(matched_filters, metric_key, 1, self.statsd.incr)
+
+    def _version_metric(self, proto):
+        if not proto.startswith('HTTP'):
+            return None
+
+        version = proto.split('/')[-1]
+
+        # Ordered roughly by expected popularity to reduce number of calls to `startswith`
+        if version.startswith('1.1'):
+            suffix = '1_1'
+        elif version.startswith('2.0'):
+            suffix = '2'
+        elif version.startswith('1.0'):
+            suffix = '1_0'
+        elif version.startswith('0.9'):
+            suffix = '0_9'
+        else:
+            suffix = version.replace('.', '_')
+
+        return self.registry.key('nginx.http.v%s' % suffix)
 
     def request_length(self, data, matched_filters=None):
         """
@@ -234,10 +554,10 @@ class NginxAccessLogsCollector(AbstractCollector):
         :param matched_filters: [] of matched filters
         """
         if 'request_length' in data:
-            metric_name, value = 'nginx.http.request.length', data['request_length']
-            self.object.statsd.average(metric_name, value)
+            metric_key, value = self.keys['nginx.http.request.length'], data['request_length']
+            self.statsd.average(metric_key, value)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.average)
+                self.count_custom_filter(matched_filters, metric_key, value, self.statsd.average)
 
     def body_bytes_sent(self, data, matched_filters=None):
         """
@@ -247,10 +567,10 @@ class NginxAccessLogsCollector(AbstractCollector):
         :param matched_filters: [] of matched filters
         """
         if 'body_bytes_sent' in data:
-            metric_name, value = 'nginx.http.request.body_bytes_sent', data['body_bytes_sent']
-            self.object.statsd.incr(metric_name, value)
+            metric_key, value = self.keys['nginx.http.request.body_bytes_sent'], data['body_bytes_sent']
+            self.statsd.incr(metric_key, value)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.incr)
+                self.count_custom_filter(matched_filters, metric_key, value, self.statsd.incr)
 
     def bytes_sent(self, data, matched_filters=None):
         """
@@ -260,10 +580,10 @@ class NginxAccessLogsCollector(AbstractCollector):
         :param matched_filters: [] of matched filters
         """
         if 'bytes_sent' in data:
-            metric_name, value = 'nginx.http.request.bytes_sent', data['bytes_sent']
-            self.object.statsd.incr(metric_name, value)
+            metric_key, value = self.keys['nginx.http.request.bytes_sent'], data['bytes_sent']
+            self.statsd.incr(metric_key, value)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.incr)
+                self.count_custom_filter(matched_filters, metric_key, value, self.statsd.incr)
 
     def gzip_ration(self, data, matched_filters=None):
         """
@@ -273,10 +593,10 @@ class NginxAccessLogsCollector(AbstractCollector):
         :param matched_filters: [] of matched filters
         """
         if 'gzip_ratio' in data:
-            metric_name, value = 'nginx.http.gzip.ratio', data['gzip_ratio']
-            self.object.statsd.average(metric_name, value)
+            metric_key, value = self.keys['nginx.http.gzip.ratio'], data['gzip_ratio']
+            self.statsd.average(metric_key, value)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.average)
+                self.count_custom_filter(matched_filters, metric_key, value, self.statsd.average)
 
     def request_time(self, data, matched_filters=None):
         """
@@ -290,10 +610,10 @@ class NginxAccessLogsCollector(AbstractCollector):
         :param matched_filters: [] of matched filters
         """
         if 'request_time' in data:
-            metric_name, value = 'nginx.http.request.time', sum(data['request_time'])
-            self.object.statsd.timer(metric_name, value)
+            metric_key, value = self.keys['nginx.http.request.time'], sum(data['request_time'])
+            self.statsd.timer(metric_key, value)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.timer)
+                self.count_custom_filter(matched_filters, metric_key, value, self.statsd.timer)
 
     def upstreams(self, data, matched_filters=None):
         """
@@ -338,27 +658,22 @@ class NginxAccessLogsCollector(AbstractCollector):
         upstream_response = False
         if 'upstream_status' in data:
             for status in data['upstream_status']: # upstream_status is parsed as a list
-                if status.isdigit():
-                    suffix = '%sxx' % status[0]
-                    metric_name = 'nginx.upstream.status.%s' % suffix
-                    upstream_response = True if suffix in ('2xx', '3xx') else False   # Set flag for upstream length processing
-                    self.object.statsd.incr(metric_name)
+                metric_key, success = self.upstream_status_metrics[status]
+                if metric_key is not None:
+                    upstream_response = success  # Set flag for upstream length processing
+                    self.statsd.incr(metric_key)
                     if matched_filters:
-                        self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+                        self.count_custom_filter(matched_filters, metric_key, 1, self.statsd.incr)
 
         if upstream_response and 'upstream_response_length' in data:
-            metric_name, value = 'nginx.upstream.response.length', data['upstream_response_length']
-            self.object.statsd.average(metric_name, value)
+            metric_key, value = self.keys['nginx.upstream.response.length'], data['upstream_response_length']
+            self.statsd.average(metric_key, value)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.average)
+                self.count_custom_filter(matched_filters, metric_key, value, self.statsd.average)
 
         # gauges
         upstream_switches = None
-        for metric_name, key_name in {
-            'nginx.upstream.connect.time': 'upstream_connect_time',
-            'nginx.upstream.response.time': 'upstream_response_time',
-            'nginx.upstream.header.time': 'upstream_header_time'
-        }.iteritems():
+        for metric_key, key_name in self.upstream_timers:
             if key_name in data:
                 values = data[key_name]
 
@@ -368,44 +683,55 @@ class NginxAccessLogsCollector(AbstractCollector):
 
                 # store all values
                 value = sum(values)
-                self.object.statsd.timer(metric_name, value)
+                self.statsd.timer(metric_key, value)
                 if matched_filters:
-                    self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.timer)
+                    self.count_custom_filter(matched_filters, metric_key, value, self.statsd.timer)
 
         # log upstream switches
-        metric_name, value = 'nginx.upstream.next.count', 0 if upstream_switches is None else upstream_switches
-        self.object.statsd.incr(metric_name, value)
+        metric_key = self.keys['nginx.upstream.next.count']
+        value = 0 if upstream_switches is None else upstream_switches
+        self.statsd.incr(metric_key, value)
         if matched_filters:
-            self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.incr)
+            self.count_custom_filter(matched_filters, metric_key, value, self.statsd.incr)
 
         # cache
         if 'upstream_cache_status' in data:
-            cache_status = data['upstream_cache_status']
-            cache_status_lower = cache_status.lower()
-            if cache_status_lower in self.valid_cache_statuses:
-                metric_name = 'nginx.cache.%s' % cache_status_lower
-                self.object.statsd.incr(metric_name)
+            metric_key = self.cache_metrics[data['upstream_cache_status']]
+            if metric_key is not None:
+                self.statsd.incr(metric_key)
                 if matched_filters:
-                    self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+                    self.count_custom_filter(matched_filters, metric_key, 1, self.statsd.incr)
 
         # log total upstream requests
-        metric_name = 'nginx.upstream.request.count'
-        self.object.statsd.incr(metric_name)
+        metric_key = self.keys['nginx.upstream.request.count']
+        self.statsd.incr(metric_key)
         if matched_filters:
-            self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+            self.count_custom_filter(matched_filters, metric_key, 1, self.statsd.incr)
+
+    def _upstream_status_metric(self, status):
+        if not status.isdigit():
+            return None, False
+
+        suffix = '%sxx' % status[0]
+        return self.registry.key('nginx.upstream.status.%s' % suffix), suffix in ('2xx', '3xx')
+
+    def _cache_metric(self, cache_status):
+        cache_status_lower = cache_status.lower()
+        if cache_status_lower not in self.valid_cache_statuses:
+            return None
+        return self.registry.key('nginx.cache.%s' % cache_status_lower)
 
-    @staticmethod
-    def count_custom_filter(matched_filters, metric_name, value, method):
+    def count_custom_filter(self, matched_filters, metric_key, value, method):
         """
         Collect custom metric
 
         :param matched_filters: [] of matched filters
-        :param metric_name: str metric name
+        :param metric_key: registry key of the metric
         :param value: int/float value
         :param method: function to call
         :return:
         """
         for log_filter in matched_filters:
-            if log_filter.metric == metric_name:
-                full_metric_name = '%s||%s' % (log_filter.metric, log_filter.filter_rule_id)
-                method(full_metric_name, value)
+            custom_metric_key = self.filter_keys.get((metric_key, log_filter.filter_rule_id))
+            if custom_metric_key is not None:
+                method(custom_metric_key, value)
@@ -3,8 +3,9 @@ from amplify.agent.collectors.abstract import AbstractCollector
 from amplify.agent.objects.nginx.log.error import NginxErrorLogParser
 
 from amplify.agent.common.context import context
+from amplify.agent.common.util.budget import WorkBudget, DEFAULT_MAX_TIME, DEFAULT_MAX_LINES
 from amplify.agent.pipelines.abstract import Pipeline
-from amplify.agent.pipelines.file import FileTail
+from amplify.agent.pipelines.file import FileTail, FileTailSubscriber, save_offsets
 from amplify.agent.objects.nginx.config.config import ERROR_LOG_LEVELS
 
 __author__ = "Mike Belov"
@@ -31,6 +32,12 @@ class NginxErrorLogsCollector(AbstractCollector):
         self.level = level
         self.parser = NginxErrorLogParser()
         self.tail = tail if tail is not None else FileTail(filename)
+        nginx_config = context.app_config['containers'].get('nginx', {})
+        self.budget = WorkBudget(
+            max_time=float(nginx_config.get('log_collect_time', DEFAULT_MAX_TIME)),
+            max_lines=int(nginx_config.get('log_collect_lines', DEFAULT_MAX_LINES))
+        )
+        self.backlog = 0  # unread bytes left by the last collect
         self.register(self.error_log_parsed)
 
     def collect(self):
@@ -38,6 +45,7 @@ class NginxErrorLogsCollector(AbstractCollector):
         if ERROR_LOG_LEVELS.index(self.level) <= 3:
             self.init_counters()  # set all error counters to 0
 
+        self.budget.start()
         count = 0
         for line in self.tail:
             count += 1
@@ -50,6 +58,25 @@ class NginxErrorLogsCollector(AbstractCollector):
             if error:
                 super(NginxErrorLogsCollector, self).collect(error)
 
+            # the budget is checked every 1000 of lines
+            if count % 1000 == 0 and not self.budget.spend(1000):
+                break
+
+        if isinstance(self.tail, (FileTail, FileTailSubscriber)):
+            save_offsets()
+
+        # the rest is read by the next collect
+        if hasattr(self.tail, 'unread_size'):
+            backlog = self.backlog = self.tail.unread_size()
+            # the gauge is the object's, so it's the total of all of its logs
+            self.object.statsd.agent(
+                'amplify.agent.nginx_elog.backlog', sum(collector.backlog for collector in self.siblings())
+            )
+            if self.budget.exhausted:
+                context.log.debug('%s left %s bytes of %s for the next collect' % (
+                    self.object.definition_hash, backlog, self.tail.name
+                ))
+
         tail_name = self.tail.name if isinstance(self.tail, Pipeline) else 'list'
         context.log.debug('%s processed %s lines from %s' % (self.object.definition_hash, count, tail_name))
 
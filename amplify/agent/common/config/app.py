@@ -19,6 +19,7 @@ class Config(AbstractConfig):
             pid=os.getcwd() + '/amplify_agent.pid',
             cpu_limit=10.0,
             cpu_sleep=0.2,
+            state_dir=None,  # log offsets are not saved between runs if not set
         ),
         containers=dict(
         ),
@@ -84,3 +85,9 @@ class SandboxConfig(Config):
 
 class ProductionConfig(Config):
     write_new = True
+
+    config_changes = dict(
+        daemon=dict(
+            state_dir='/var/run/amplify-agent',  # created by the init script
+        )
+    )
@@ -148,7 +148,12 @@ class Context(Singleton):
                 listener_address = listener_definition.get('address')
                 # ...if there is an address...
                 if listener_address is not None:
-                    # ...try to format and save the ipv4 address into the context store.
+                    # ...save unix socket addresses as is (e.g. "unix:/var/run/amplify-agent/syslog.sock")...
+                    if net.unix_address(listener_address):
+                        self.listeners.add(listener_address)
+                        continue
+
+                    # ...or try to format and save the ipv4 address into the context store.
                     try:
                         _, _, formatted_address = net.ipv4_address(address=listener_address, full_format=True)
                         self.listeners.add(formatted_address)
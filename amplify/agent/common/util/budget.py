@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import time
+
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+DEFAULT_MAX_TIME = 2.0  # seconds
+DEFAULT_MAX_LINES = 1000000
+DEFAULT_SLICE_TIME = 0.05  # seconds of work between yields
+
+
+class WorkBudget(object):
+    """
+    Time and line limits of a single collect
+
+    Work is spent in slices: after every slice of slice_time seconds the greenlet yields (time.sleep(0) is
+    gevent.sleep(0) when time is patched), so other greenlets run while a large backlog is processed.
+    When the budget is exhausted the collector stops and leaves the rest of the data for the next collect.
+    """
+
+    def __init__(self, max_time=DEFAULT_MAX_TIME, max_lines=DEFAULT_MAX_LINES, slice_time=DEFAULT_SLICE_TIME):
+        """
+        :param max_time: float max seconds of a collect (0 - unlimited)
+        :param max_lines: int max lines of a collect (0 - unlimited)
+        :param slice_time: float seconds of work between yields
+        """
+        self.max_time = max_time
+        self.max_lines = max_lines
+        self.slice_time = slice_time
+        self.start()
+
+    def start(self):
+        now = time.time()
+        self.started = now
+        self.slice_started = now
+        self.lines = 0
+        self.exhausted = False
+
+    def spend(self, lines):
+        """
+        Counts processed lines, yields if the current slice is over
+
+        :param lines: int number of lines processed since the last call
+        :return: bool True if there is budget left
+        """
+        self.lines += lines
+
+        now = time.time()
+        if now - self.slice_started >= self.slice_time:
+            time.sleep(0)
+            self.slice_started = now = time.time()
+
+        if (self.max_lines and self.lines >= self.max_lines) or \
+                (self.max_time and now - self.started >= self.max_time):
+            self.exhausted = True
+        return not self.exhausted
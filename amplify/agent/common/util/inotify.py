@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import errno
+import os
+import struct
+import sys
+
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+# see inotify(7)
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len (followed by a name of len bytes)
+
+_libc = []  # loaded on first use
+
+
+def libc():
+    """
+    :return: ctypes libc with inotify functions or None if inotify is not available
+    """
+    if not _libc:
+        lib = None
+        if sys.platform.startswith('linux'):
+            try:
+                lib = ctypes.CDLL(None, use_errno=True)
+                if not hasattr(lib, 'inotify_init1'):
+                    lib = None
+            except (OSError, AttributeError):
+                lib = None
+        _libc.append(lib)
+    return _libc[0]
+
+
+def available():
+    return libc() is not None
+
+
+class Inotify(object):
+    """
+    Non-blocking inotify instance
+    """
+
+    def __init__(self):
+        lib = libc()
+        if lib is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+
+        self.lib = lib
+        self.fd = lib.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """
+        :param path: str path of a file or a directory
+        :param mask: int mask of events
+        :return: int watch descriptor
+        """
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding())
+
+        wd = self.lib.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.lib.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """
+        Reads all queued events without blocking
+
+        :return: [] of (int wd, int mask, str name)
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            if not data:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                events.append((wd, mask, data[offset:offset + length].rstrip('\0')))
+                offset += length
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+DEFAULT_MAX_SIZE = 1024
+
+
+class InternTable(object):
+    """
+    Bounded table of canonical values computed from raw strings, e.g. 'GET' -> 'nginx.http.method.get'
+
+    Every raw value is converted only once, the following lookups are a single dict hit.
+    When the table is full, new raw values are converted on every lookup and not stored,
+    so hostile input (random methods, statuses, etc) can't grow it.
+    """
+
+    def __init__(self, func, max_size=DEFAULT_MAX_SIZE):
+        """
+        :param func: function which converts a raw value to the canonical one
+        :param max_size: int max number of stored values
+        """
+        self.func = func
+        self.max_size = max_size
+        self.table = {}
+        self.overflows = 0
+
+    def __getitem__(self, raw):
+        try:
+            return self.table[raw]
+        except KeyError:
+            pass
+
+        value = self.func(raw)
+        if len(self.table) < self.max_size:
+            self.table[raw] = value
+        else:
+            self.overflows += 1
+        return value
+
+    def __len__(self):
+        return len(self.table)
@@ -59,3 +59,15 @@ def ipv4_address(address=None, host='', port='80', full_format=False, silent=Fal
     result = (parts[0], parts[1], ':'.join(parts))
 
     return result if full_format else result[:2]
+
+
+def unix_address(address):
+    """
+    Helper function that gets a unix socket path from an nginx style address (e.g. "unix:/var/run/syslog.sock").
+
+    :param address: String address
+    :return: String path of the socket or None if it's not a unix socket address
+    """
+    if address and address.startswith('unix:'):
+        return address[len('unix:'):] or None
+    return None
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import time
+import traceback
+
+from collections import deque
+from multiprocessing import Process, Pipe
+from threading import Lock
+
+from amplify.agent.common.context import context
+
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class ProcessPoolError(Exception):
+    pass
+
+
+def _worker(connection):
+    """
+    Worker process loop: receives (func, args) tasks and sends back (ok, result) until None is received
+    """
+    while True:
+        try:
+            task = connection.recv()
+        except (EOFError, IOError):
+            break
+
+        if task is None:
+            break
+
+        func, args = task
+        try:
+            result = (True, func(args))
+        except Exception:
+            result = (False, traceback.format_exc())
+        connection.send(result)
+
+
+class ProcessPool(object):
+    """
+    Pool of worker processes
+
+    Unlike multiprocessing.Pool it doesn't use helper threads, so it works with gevent-patched threading:
+    results are polled and the waiting greenlet sleeps, letting other greenlets run while workers are busy.
+    """
+
+    def __init__(self, processes, poll_interval=0.01):
+        self.processes = processes
+        self.poll_interval = poll_interval
+        self.workers = []  # [(process, connection)]
+        self.lock = Lock()
+
+    def start(self):
+        for _ in xrange(self.processes):
+            connection, worker_connection = Pipe()
+            process = Process(target=_worker, args=(worker_connection,))
+            process.daemon = True
+            process.start()
+            worker_connection.close()
+            self.workers.append((process, connection))
+        context.log.debug('started %s pool workers' % self.processes)
+
+    def stop(self):
+        for process, connection in self.workers:
+            try:
+                connection.send(None)
+                connection.close()
+            except (EOFError, IOError):
+                pass
+
+        for process, connection in self.workers:
+            process.join(1.0)
+            if process.is_alive():
+                process.terminate()
+
+        self.workers = []
+
+    def map(self, func, tasks):
+        """
+        Applies func to every task in worker processes
+
+        :param func: module level function (it's pickled by reference)
+        :param tasks: [] of picklable arguments
+        :return: [] of results in the order of tasks
+        """
+        with self.lock:
+            if not self.workers:
+                self.start()
+
+            try:
+                return self._map(func, tasks)
+            except (EOFError, IOError, OSError) as e:
+                # a worker died - the pool can't be trusted anymore
+                self.stop()
+                raise ProcessPoolError('pool worker failed: %s' % e)
+
+    def _map(self, func, tasks):
+        results = [None] * len(tasks)
+        pending = deque(enumerate(tasks))
+        idle = [connection for process, connection in self.workers]
+        busy = {}  # connection -> task index
+        errors = []
+
+        while pending or busy:
+            while pending and idle:
+                connection = idle.pop()
+                index, args = pending.popleft()
+                connection.send((func, args))
+                busy[connection] = index
+
+            for connection in busy.keys():
+                if connection.poll():
+                    ok, result = connection.recv()
+                    index = busy.pop(connection)
+                    idle.append(connection)
+                    if ok:
+                        results[index] = result
+                    else:
+                        errors.append(result)
+
+            if busy:
+                time.sleep(self.poll_interval)
+
+        if errors:
+            raise ProcessPoolError('%s of %s tasks failed:\n%s' % (len(errors), len(tasks), errors[0]))
+
+        return results
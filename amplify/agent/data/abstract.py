@@ -14,3 +14,14 @@ class CommonDataClient(object):
         self.object = object
         self.current = {}
         self.delivery = {}
+
+    def swap(self, fresh):
+        """
+        Hands off the current buffer and starts the fresh one.
+        Buffers are not referenced anywhere else, so the delivered one is not copied.
+
+        :param fresh: new empty buffer
+        :return: previous buffer
+        """
+        delivery, self.current = self.current, fresh
+        return delivery
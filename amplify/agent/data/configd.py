@@ -1,6 +1,4 @@
 # -*- coding: utf-8 -*-
-import copy
-
 from amplify.agent.data.abstract import CommonDataClient
 
 
@@ -31,8 +29,7 @@ class ConfigdClient(CommonDataClient):
             return {'object': self.object.definition}
             # Always return object definitions in case there are children and the definition is required to attached
 
-        delivery = copy.deepcopy(self.current)
-        self.current = {}
+        delivery = self.swap({})
         return {
             'object': self.object.definition,
             'config': delivery,
@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import copy
 import hashlib
 import time
 
@@ -82,8 +81,7 @@ class EventdClient(CommonDataClient):
         if not self.current:
             return {'object': self.object.definition}
 
-        delivery = copy.deepcopy(self.current)
-        self.current = {}
+        delivery = self.swap({})
 
         return {
             'object': self.object.definition,
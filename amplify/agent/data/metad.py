@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import copy
 from collections import defaultdict
 
 from amplify.agent.data.abstract import CommonDataClient
@@ -26,7 +25,6 @@ class MetadClient(CommonDataClient):
 
     def flush(self):
         if self.current:
-            delivery = copy.deepcopy(self.current)
-            delivery.update(agent=self.context.version)
-            self.current = defaultdict(dict)
-            return delivery
+            # current meta is the dict of the meta collector, which it updates in place on every collect:
+            # the shallow copy detaches it, nested values are not modified (default_meta builds new ones every time)
+            return dict(self.swap(defaultdict(dict)), agent=self.context.version)
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
-import copy
 import time
 
 from collections import defaultdict
+from functools import partial
+
+from amplify.agent.data.abstract import CommonDataClient
+from amplify.agent.data.timer import (
+    SketchTimer, ExactTimer, timer_ranks, DEFAULT_ACCURACY, DEFAULT_MAX_BINS, TIMER_MODES, DEFAULT_TIMER_MODE
+)
 
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
@@ -12,19 +17,229 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
-class StatsdClient(object):
+DEFAULT_REGISTRY_SIZE = 10000
+
+
+def timer_factory(timer_mode=DEFAULT_TIMER_MODE, accuracy=DEFAULT_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+    """
+    Returns a picklable function creating empty timers (it's passed to pool workers with batches)
+
+    :return: ExactTimer class if timer_mode is "exact", partial of SketchTimer otherwise
+    """
+    if timer_mode == 'exact':
+        return ExactTimer
+    return partial(SketchTimer, accuracy=accuracy, max_bins=max_bins)
+
+
+class MetricRegistry(object):
+    """
+    Per-object table of metric names with dense integer ids and precomputed wire names
+
+    Collectors with hot paths (e.g. access logs) resolve names to ids once and then count by ids,
+    flush takes wire names ('C|nginx.http.method.get', 'G|nginx.http.request.length') from the registry
+    instead of formatting them every time.
+    When the registry is full, new names are not registered and are used as keys themselves.
+
+    StatsdClient keeps its current values by metric names (collectors, tests and merges of batches from other
+    registries read and write them by names), so ids given to it are turned back into names with a list lookup.
+    The per-line work is done in StatsdBatch by ids, StatsdClient only sees one merge per collect.
+    """
+
+    def __init__(self, max_size=DEFAULT_REGISTRY_SIZE):
+        self.max_size = max_size
+        self.ids = {}
+        self.names = []
+        self.counter_names = []  # by id
+        self.gauge_names = []  # by id
+        self.timer_names = []  # by id, created on first use
+
+    def __len__(self):
+        return len(self.names)
+
+    def key(self, metric_name):
+        """
+        :param metric_name: str metric name
+        :return: int id of the metric or the name itself if the registry is full
+        """
+        metric_id = self.ids.get(metric_name)
+        if metric_id is not None:
+            return metric_id
+
+        if len(self.names) >= self.max_size:
+            return metric_name
+
+        metric_id = len(self.names)
+        self.ids[metric_name] = metric_id
+        self.names.append(metric_name)
+        self.counter_names.append('C|%s' % metric_name)
+        self.gauge_names.append('G|%s' % metric_name)
+        self.timer_names.append(None)
+        return metric_id
+
+    def name(self, key):
+        """
+        :param key: int id or str metric name
+        :return: str metric name
+        """
+        return self.names[key] if key.__class__ is int else key
+
+    def counter_name(self, metric_name):
+        metric_id = self.key(metric_name)
+        return self.counter_names[metric_id] if metric_id.__class__ is int else 'C|%s' % metric_name
+
+    def gauge_name(self, metric_name):
+        metric_id = self.key(metric_name)
+        return self.gauge_names[metric_id] if metric_id.__class__ is int else 'G|%s' % metric_name
+
+    def timer_name(self, metric_name):
+        """
+        :return: (mean, count, max, median, 95 percentile) wire names
+        """
+        metric_id = self.key(metric_name)
+        if metric_id.__class__ is int and self.timer_names[metric_id] is not None:
+            return self.timer_names[metric_id]
+
+        names = (
+            'G|%s' % metric_name,
+            'C|%s.count' % metric_name,
+            'G|%s.max' % metric_name,
+            'G|%s.median' % metric_name,
+            'G|%s.pctl95' % metric_name,
+        )
+        if metric_id.__class__ is int:
+            self.timer_names[metric_id] = names
+        return names
+
+
+class GaugeSlot(object):
+    """
+    Running aggregate of a gauge: the last stamp and value, sum and count of all values
+    """
+    __slots__ = ('stamp', 'value', 'total', 'count')
+
+    def __init__(self, stamp, value):
+        self.stamp = stamp
+        self.value = value
+        self.total = value
+        self.count = 1
+
+    def add(self, stamp, value):
+        self.stamp = stamp
+        self.value = value
+        self.total += value
+        self.count += 1
+
+
+class AverageSlot(object):
+    """
+    Running aggregate of an average: sum and count of all values
+    """
+    __slots__ = ('total', 'count')
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        self.total += value
+        self.count += 1
+
+    def extend(self, values):
+        for value in values:
+            self.total += value
+            self.count += 1
+
+    def merge(self, other):
+        """
+        :param other: AverageSlot
+        """
+        self.total += other.total
+        self.count += other.count
+
+
+class StatsdBatch(object):
+    """
+    Local accumulator with the same API as StatsdClient for counters, averages and timers.
+    Used to aggregate a lot of values (e.g. from log lines) and merge them to StatsdClient at once.
+    Values are keyed by metric keys of the registry (see MetricRegistry.key), metric names work too.
+    Averages and timers are kept as running aggregates (AverageSlot, timers of new_timer), so a batch takes
+    the same memory per metric however many values it gets (except for exact timers).
+    """
+
+    def __init__(self, registry=None, new_timer=None):
+        self.registry = registry if registry is not None else MetricRegistry()
+        self.new_timer = new_timer if new_timer is not None else timer_factory()
+        self.counters = defaultdict(int)
+        self.averages = defaultdict(AverageSlot)
+        self.timers = defaultdict(self.new_timer)
+
+    def incr(self, metric_key, value=None, **kwargs):
+        self.counters[metric_key] += 1 if value is None else value
+
+    def average(self, metric_key, value):
+        self.averages[metric_key].add(value)
+
+    def timer(self, metric_key, value):
+        self.timers[metric_key].add(value)
+
+    def update(self, other):
+        """
+        Adds values of another batch to this one
+
+        :param other: StatsdBatch
+        """
+        if other.registry is self.registry:
+            translate = lambda key: key
+        else:
+            # e.g. a batch from a pool worker
+            translate = lambda key: self.registry.key(other.registry.name(key))
+
+        for metric_key, value in other.counters.iteritems():
+            self.counters[translate(metric_key)] += value
+
+        for metric_key, slot in other.averages.iteritems():
+            self.averages[translate(metric_key)].merge(slot)
+
+        for metric_key, timer in other.timers.iteritems():
+            self.timers[translate(metric_key)].merge(timer)
+
+
+class StatsdClient(CommonDataClient):
     def __init__(self, address=None, port=None, interval=None, object=None):
         # Import context as a class object to avoid circular import on statsd.  This could be refactored later.
         from amplify.agent.common.context import context
         self.context = context
 
+        super(StatsdClient, self).__init__(object=object)
         self.address = address
         self.port = port
-        self.object = object
         self.interval = interval
+        self.registry = MetricRegistry()
         self.current = defaultdict(dict)
         self.delivery = defaultdict(dict)
 
+        statsd_config = context.app_config.get('statsd', {})
+        self.timer_accuracy = float(statsd_config.get('timer_accuracy', DEFAULT_ACCURACY))
+        self.timer_max_bins = int(statsd_config.get('timer_max_bins', DEFAULT_MAX_BINS))
+        timer_mode = statsd_config.get('timer_mode', DEFAULT_TIMER_MODE)
+        self.timer_mode = timer_mode if timer_mode in TIMER_MODES else DEFAULT_TIMER_MODE
+
+    @property
+    def new_timer(self):
+        """
+        Function creating empty timers of the current mode, batches use it too so their timers can be merged
+        """
+        return timer_factory(self.timer_mode, self.timer_accuracy, self.timer_max_bins)
+
+    def _timer(self, metric_name):
+        """
+        Returns the timer storage of a metric, creating it if needed
+        """
+        timers = self.current['timer']
+        if metric_name not in timers:
+            timers[metric_name] = self.new_timer()
+        return timers[metric_name]
+
     def latest(self, metric_name, value, stamp=None):
         """
         Stores the most recent value of a gauge
@@ -35,20 +250,28 @@ class StatsdClient(object):
         """
         timestamp = stamp or int(time.time())
         gauges = self.current['gauge']
-        if metric_name not in gauges or timestamp > gauges[metric_name][0][0]:
-            gauges[metric_name] = [(timestamp, value)]
+        if metric_name not in gauges or timestamp > gauges[metric_name].stamp:
+            gauges[metric_name] = GaugeSlot(timestamp, value)
 
     def average(self, metric_name, value):
         """
         Same thing as histogram but without p95
 
-        :param metric_name:  metric name
+        :param metric_name:  metric name or its registry id
         :param value:  metric value
         """
-        if metric_name in self.current['average']:
-            self.current['average'][metric_name].append(value)
-        else:
-            self.current['average'][metric_name] = [value]
+        if metric_name.__class__ is int:
+            metric_name = self.registry.names[metric_name]
+        self._average(metric_name).add(value)
+
+    def _average(self, metric_name):
+        """
+        Returns the running aggregate of an average metric, creating it if needed
+        """
+        averages = self.current['average']
+        if metric_name not in averages:
+            averages[metric_name] = AverageSlot()
+        return averages[metric_name]
 
     def timer(self, metric_name, value):
         """
@@ -60,23 +283,28 @@ class StatsdClient(object):
         Sort the data set by value from highest to lowest and discard the highest 5% of the sorted samples.
         The next highest sample is the 95th percentile value for the data set.
 
-        :param metric_name: metric name
+        Samples are counted in a fixed-size sketch (see SketchTimer), so median and 95 percentile are
+        within "timer_accuracy" (1% by default) relative error of the exact values.
+        With "timer_mode = exact" all samples are kept (see ExactTimer) and the values are exact.
+
+        :param metric_name: metric name or its registry id
         :param value: metric value
         """
-        if metric_name in self.current['timer']:
-            self.current['timer'][metric_name].append(value)
-        else:
-            self.current['timer'][metric_name] = [value]
+        if metric_name.__class__ is int:
+            metric_name = self.registry.names[metric_name]
+        self._timer(metric_name).add(value)
 
     def incr(self, metric_name, value=None, rate=None, stamp=None):
         """
         Simple counter with rate
 
-        :param metric_name: metric name
+        :param metric_name: metric name or its registry id
         :param value: metric value
         :param rate: rate
         :param stamp: timestamp (current timestamp will be used if this is not specified)
         """
+        if metric_name.__class__ is int:
+            metric_name = self.registry.names[metric_name]
         timestamp = stamp or int(time.time())
 
         if value is None:
@@ -102,6 +330,23 @@ class StatsdClient(object):
         else:
             self.current['counter'][metric_name][-1] = [last_stamp, last_value + value]
 
+    def merge(self, batch):
+        """
+        Merges locally aggregated values
+
+        :param batch: StatsdBatch
+        """
+        name = batch.registry.name
+
+        for metric_key, value in batch.counters.iteritems():
+            self.incr(name(metric_key), value)
+
+        for metric_key, slot in batch.averages.iteritems():
+            self._average(name(metric_key)).merge(slot)
+
+        for metric_key, timer in batch.timers.iteritems():
+            self._timer(name(metric_key)).merge(timer)
+
     def agent(self, metric_name, value, stamp=None):
         """
         Agent metrics
@@ -110,7 +355,7 @@ class StatsdClient(object):
         :param stamp: timestamp (current timestamp will be used if this is not specified)
         """
         timestamp = stamp or int(time.time())
-        self.current['gauge'][metric_name] = [(timestamp, value)]
+        self.current['gauge'][metric_name] = GaugeSlot(timestamp, value)
 
     def gauge(self, metric_name, value, delta=False, prefix=False, stamp=None):
         """
@@ -122,37 +367,35 @@ class StatsdClient(object):
         """
         timestamp = stamp or int(time.time())
 
-        if metric_name in self.current['gauge']:
-            if delta:
-                last_stamp, last_value = self.current['gauge'][metric_name][-1]
-                new_value = last_value + value
-            else:
-                new_value = value
-            self.current['gauge'][metric_name].append((timestamp, new_value))
+        gauges = self.current['gauge']
+        if metric_name in gauges:
+            slot = gauges[metric_name]
+            slot.add(timestamp, slot.value + value if delta else value)
         else:
-            self.current['gauge'][metric_name] = [(timestamp, value)]
+            gauges[metric_name] = GaugeSlot(timestamp, value)
 
     def flush(self):
         if not self.current:
             return {'object': self.object.definition}
 
         results = {}
-        delivery = copy.deepcopy(self.current)
-        self.current = defaultdict(dict)
+        delivery = self.swap(defaultdict(dict))
+        registry = self.registry
 
         # histogram
         if 'timer' in delivery:
             timers = {}
             timestamp = int(time.time())
-            for metric_name, metric_values in delivery['timer'].iteritems():
-                if len(metric_values):
-                    metric_values.sort()
-                    length = len(metric_values)
-                    timers['G|%s' % metric_name] = [[timestamp, sum(metric_values) / float(length)]]
-                    timers['C|%s.count' % metric_name] = [[timestamp, length]]
-                    timers['G|%s.max' % metric_name] = [[timestamp, metric_values[-1]]]
-                    timers['G|%s.median' % metric_name] = [[timestamp, metric_values[int(round(length / 2 - 1))]]]
-                    timers['G|%s.pctl95' % metric_name] = [[timestamp, metric_values[-int(round(length * .05))]]]
+            for metric_name, timer in delivery['timer'].iteritems():
+                if len(timer):
+                    length = len(timer)
+                    median_rank, pctl95_rank = timer_ranks(length)
+                    mean_name, count_name, max_name, median_name, pctl95_name = registry.timer_name(metric_name)
+                    timers[mean_name] = [[timestamp, timer.total / float(length)]]
+                    timers[count_name] = [[timestamp, length]]
+                    timers[max_name] = [[timestamp, timer.max]]
+                    timers[median_name] = [[timestamp, timer.value_at(median_rank)]]
+                    timers[pctl95_name] = [[timestamp, timer.value_at(pctl95_rank)]]
             results['timer'] = timers
 
         # counters
@@ -167,35 +410,28 @@ class StatsdClient(object):
 
                 # Condense the list of lists 'v' into a list of a single element.  Remember that we are using lists
                 # instead of tuples because we need mutability during self.incr().
-                counters['C|%s' % k] = [[last_stamp, total_value]]
+                counters[registry.counter_name(k)] = [[last_stamp, total_value]]
 
             results['counter'] = counters
 
         # gauges
         if 'gauge' in delivery:
             gauges = {}
-            for k, v in delivery['gauge'].iteritems():
-                # Aggregate all observed gauges into a single record.
-                last_stamp = v[-1][0]  # Use the oldest timestamp.
-                total_value = 0
-                for timestamp, value in v:
-                    total_value += value
-
-                # Condense list of tuples 'v' into a list of a single tuple using an average value.
-                gauges['G|%s' % k] = [(last_stamp, float(total_value)/len(v))]
+            for k, slot in delivery['gauge'].iteritems():
+                # Use the last timestamp and the average value of all observed gauges.
+                gauges[registry.gauge_name(k)] = [(slot.stamp, float(slot.total) / slot.count)]
             results['gauge'] = gauges
 
         # avg
         if 'average' in delivery:
             averages = {}
             timestamp = int(time.time())  # Take a new timestamp here because it is not collected previously.
-            for metric_name, metric_values in delivery['average'].iteritems():
-                if len(metric_values):
-                    length = len(metric_values)
-                    averages['G|%s' % metric_name] = [[timestamp, sum(metric_values) / float(length)]]
+            for metric_name, slot in delivery['average'].iteritems():
+                if slot.count:
+                    averages[registry.gauge_name(metric_name)] = [[timestamp, slot.total / float(slot.count)]]
             results['average'] = averages
 
         return {
-            'metrics': copy.deepcopy(results),
+            'metrics': results,
             'object': self.object.definition
         }
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import math
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    # optional, samples are sorted in pure python without it
+    numpy = None
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+DEFAULT_ACCURACY = 0.01  # 1% relative error of median and 95 percentile
+DEFAULT_MAX_BINS = 2048
+MIN_VALUE = 1e-9  # smaller values are counted as zeros
+
+TIMER_MODES = ('sketch', 'exact')
+DEFAULT_TIMER_MODE = 'sketch'
+
+
+def timer_ranks(length):
+    """
+    Positions of median and 95 percentile in sorted values.
+    Same as the list indexing StatsdClient has always used: values[int(round(length / 2 - 1))] for median
+    and values[-int(round(length * .05))] for 95 percentile.
+
+    :param length: int number of values
+    :return: (int median rank, int 95 percentile rank)
+    """
+    median = int(round(length // 2 - 1)) % length
+    pctl95 = -int(round(length * .05)) % length
+    return median, pctl95
+
+
+class SketchTimer(object):
+    """
+    Fixed-size streaming sketch of timer values (DDSketch: log-bucketed histogram)
+
+    Values are counted in buckets with boundaries growing as powers of gamma = (1 + accuracy) / (1 - accuracy),
+    so any value returned by value_at() is within "accuracy" relative error of the exact value of the same rank
+    (up to float rounding):
+        |value_at(rank) - exact| <= accuracy * |exact|
+    Values closer to zero than MIN_VALUE are counted as zeros. Count, total (mean) and max are exact.
+
+    Memory is bounded by max_bins buckets: if there are more of them the lowest buckets are collapsed, so only
+    the accuracy of the smallest values is affected.
+    Sketches with the same accuracy can be merged.
+    """
+    __slots__ = ('accuracy', 'gamma', 'log_gamma', 'max_bins', 'bins', 'negative_bins', 'zero_count',
+                 'count', 'total', 'min', 'max')
+
+    def __init__(self, accuracy=DEFAULT_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+
+        self.bins = {}  # bucket index -> count
+        self.negative_bins = {}
+        self.zero_count = 0
+
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+        if value > MIN_VALUE:
+            bins = self.bins
+        elif value < -MIN_VALUE:
+            bins = self.negative_bins
+            value = -value
+        else:
+            self.zero_count += 1
+            return
+
+        index = int(math.ceil(math.log(value) / self.log_gamma))
+        bins[index] = bins.get(index, 0) + 1
+        if len(bins) > self.max_bins:
+            self._collapse(bins)
+
+    def extend(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        """
+        Adds values of another sketch with the same accuracy
+
+        :param other: SketchTimer
+        """
+        if other.gamma != self.gamma:
+            raise ValueError('can not merge sketches with different accuracy')
+
+        if not other.count:
+            return
+
+        self.count += other.count
+        self.total += other.total
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.zero_count += other.zero_count
+
+        for bins, other_bins in ((self.bins, other.bins), (self.negative_bins, other.negative_bins)):
+            for index, count in other_bins.iteritems():
+                bins[index] = bins.get(index, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+
+    def _collapse(self, bins):
+        """
+        Merges the lowest buckets to fit max_bins
+        """
+        indexes = sorted(bins)
+        excess = indexes[:len(indexes) - self.max_bins]
+        target = indexes[len(excess)]
+        for index in excess:
+            bins[target] += bins.pop(index)
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def value_at(self, rank):
+        """
+        Returns the value which would be at the position "rank" of sorted values
+
+        :param rank: int 0..count-1
+        :return: float
+        """
+        if rank <= 0:
+            return self.min
+        if rank >= self.count - 1:
+            return self.max
+
+        buckets = [
+            (-self._value(index), self.negative_bins[index]) for index in sorted(self.negative_bins, reverse=True)
+        ]
+        buckets.append((0.0, self.zero_count))
+        buckets.extend((self._value(index), self.bins[index]) for index in sorted(self.bins))
+
+        seen = 0
+        for value, count in buckets:
+            seen += count
+            if seen > rank:
+                return min(max(value, self.min), self.max)
+
+        return self.max
+
+
+class ExactTimer(object):
+    """
+    Timer values stored as unboxed doubles in array('d')
+
+    Values are sorted once per flush (numpy.sort if numpy is available) and total is summed in sorted order,
+    so median, 95 percentile and mean are the same bit for bit as StatsdClient computed them from sorted lists.
+    """
+    __slots__ = ('samples', 'ordered')
+
+    def __init__(self):
+        self.samples = array('d')
+        self.ordered = None  # sorted samples, until more are added
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def count(self):
+        return len(self.samples)
+
+    @property
+    def total(self):
+        ordered = self._sorted()
+        if numpy is not None:
+            # cumsum adds values one by one like sum() does (numpy.sum adds them pairwise)
+            return float(numpy.cumsum(ordered)[-1]) if len(ordered) else 0
+        return sum(ordered)
+
+    @property
+    def max(self):
+        return max(self.samples) if self.samples else None
+
+    @property
+    def min(self):
+        return min(self.samples) if self.samples else None
+
+    def add(self, value):
+        self.samples.append(value)
+        self.ordered = None
+
+    def extend(self, values):
+        self.samples.extend(values)
+        self.ordered = None
+
+    def merge(self, other):
+        """
+        Adds values of another exact timer
+
+        :param other: ExactTimer
+        """
+        self.samples.extend(other.samples)
+        self.ordered = None
+
+    def _sorted(self):
+        if self.ordered is None:
+            if numpy is not None:
+                self.ordered = numpy.sort(numpy.frombuffer(self.samples, dtype=numpy.float64))
+            else:
+                self.ordered = sorted(self.samples)
+        return self.ordered
+
+    def value_at(self, rank):
+        """
+        Returns the value which would be at the position "rank" of sorted values
+
+        :param rank: int 0..count-1
+        :return: float
+        """
+        return float(self._sorted()[rank])
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 import re
 
+from collections import OrderedDict
+
+from amplify.agent.common.context import context
+
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
 __credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
@@ -66,3 +70,193 @@ class Filter(object):
                 return False
 
         return True
+
+
+class FilterMatcher(object):
+    """
+    Matches parsed lines against a list of filters at once
+
+    Every distinct (key, value) condition of all filters is evaluated only once per line:
+        - plain strings (values which are not valid regexes) are looked up in a dict
+        - literal regexes (no special chars) are matched as prefixes, looked up in a dict by prefix length
+        - other regexes of the same key are combined into one alternation, so lines which match none of them
+          cost a single regex call
+
+    Results can be memoized in a bounded LRU cache keyed by the values of all keys used by the filters.
+    The cache switches itself off if the hit ratio is too low (high cardinality keys, like $request_uri).
+    """
+
+    special_chars = frozenset('.^$*+?{}[]\\|()')
+    max_groups = 99  # python re supports less than 100 groups in a regex
+
+    # patterns which would change their meaning inside of a combined regex
+    uncombinable = re.compile(r'\\[1-9]|\(\?P[=<]|\(\?\(|\(\?[iLmsux]')
+
+    cache_min_lookups = 1000  # number of lookups before the hit ratio is checked
+    cache_min_hit_ratio = 0.5
+
+    def __init__(self, filters, cache_size=0):
+        self.filters = list(filters)
+        self.keys = set()
+
+        self.conditions = {}  # (key, value) -> condition index
+        self.exact = {}  # key -> {value: [condition indexes]}
+        self.prefixes = {}  # key -> [(prefix length, {prefix: [condition indexes]})]
+        self.regexes = {}  # key -> [(regex or combined regex, [(condition index, regex)])]
+
+        self.compiled = []
+        for log_filter in self.filters:
+            conditions = []
+            for key, value in log_filter.data.iteritems():
+                conditions.append((self._add_condition(key, value), log_filter._negated_conditions[key]))
+            self.compiled.append((log_filter, tuple(log_filter.data), conditions))
+
+        for key in self.prefixes:
+            self.prefixes[key] = sorted(self.prefixes[key].iteritems())
+        for key in self.regexes:
+            self.regexes[key] = self._combine(self.regexes[key])
+
+        self.cache_keys = tuple(sorted(self.keys))
+        self.cache_size = cache_size
+        self.cache = OrderedDict() if cache_size else None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @property
+    def cache_hit_ratio(self):
+        lookups = self.cache_hits + self.cache_misses
+        return float(self.cache_hits) / lookups if lookups else 0.0
+
+    def _add_condition(self, key, value):
+        pattern = value.pattern if isinstance(value, RE_TYPE) else value
+        condition_id = (key, isinstance(value, RE_TYPE), pattern)
+        if condition_id in self.conditions:
+            return self.conditions[condition_id]
+
+        index = len(self.conditions)
+        self.conditions[condition_id] = index
+        self.keys.add(key)
+
+        if not isinstance(value, RE_TYPE):
+            self.exact.setdefault(key, {}).setdefault(value, []).append(index)
+        elif not value.flags & ~re.UNICODE and not self.special_chars.intersection(pattern):
+            by_length = self.prefixes.setdefault(key, {}).setdefault(len(pattern), {})
+            by_length.setdefault(pattern, []).append(index)
+        else:
+            self.regexes.setdefault(key, []).append((index, value))
+
+        return index
+
+    def _combine(self, conditions):
+        """
+        Groups regex conditions into combined alternations
+
+        :param conditions: [] of (condition index, regex)
+        :return: [] of (regex, [(condition index, regex)])
+        """
+        result, group, groups = [], [], 0
+        for index, regex in conditions:
+            if self.uncombinable.search(regex.pattern):
+                result.append((regex, [(index, regex)]))
+                continue
+
+            # capture groups of the pattern itself and the marker group
+            needed = regex.groups + 1
+            if group and groups + needed > self.max_groups:
+                result.append(self._combined_regex(group))
+                group, groups = [], 0
+
+            group.append((index, regex))
+            groups += needed
+
+        if group:
+            result.append(self._combined_regex(group))
+        return result
+
+    @staticmethod
+    def _combined_regex(group):
+        if len(group) == 1:
+            return group[0][1], group
+
+        combined = '|'.join('(?:%s)(?P<_%d>)' % (regex.pattern, i) for i, (index, regex) in enumerate(group))
+        return re.compile(combined), group
+
+    def match(self, parsed):
+        """
+        Checks which filters match a parsed line
+
+        :param parsed: {} of parsed line
+        :return: [] of matched filters in the original order (shouldn't be modified, it could be cached)
+        """
+        cache = self.cache
+        if cache is None:
+            return self._match(parsed)
+
+        values = tuple(str(parsed[key]) if key in parsed else None for key in self.cache_keys)
+        result = cache.pop(values, None)
+        if result is not None:
+            self.cache_hits += 1
+            cache[values] = result
+            return result
+
+        self.cache_misses += 1
+        result = cache[values] = self._match(parsed)
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+        if self.cache_hits + self.cache_misses == self.cache_min_lookups and \
+                self.cache_hit_ratio < self.cache_min_hit_ratio:
+            context.log.debug(
+                'filter cache disabled, hit ratio %.2f for keys %s' % (self.cache_hit_ratio, self.cache_keys)
+            )
+            self.cache = None
+
+        return result
+
+    def _match(self, parsed):
+        matched_conditions = set()
+        missing = False
+
+        for key in self.keys:
+            if key not in parsed:
+                missing = True
+                continue
+            value = str(parsed[key])
+
+            exact = self.exact.get(key)
+            if exact and value in exact:
+                matched_conditions.update(exact[value])
+
+            for length, prefixes in self.prefixes.get(key, ()):
+                prefix = value[:length]
+                if prefix in prefixes:
+                    matched_conditions.update(prefixes[prefix])
+
+            for regex, group in self.regexes.get(key, ()):
+                regex_match = regex.match(value)
+                if not regex_match:
+                    continue
+                if len(group) == 1:
+                    matched_conditions.add(group[0][0])
+                    continue
+
+                # alternatives before the matched one don't match, the following ones should be checked
+                position = int(regex_match.lastgroup[1:])
+                matched_conditions.add(group[position][0])
+                for index, single_regex in group[position + 1:]:
+                    if single_regex.match(value):
+                        matched_conditions.add(index)
+
+        result = []
+        for log_filter, keys, conditions in self.compiled:
+            # if the key isn't in parsed, then the filter is irrelevant
+            if missing and not all(key in parsed for key in keys):
+                continue
+
+            for index, negated in conditions:
+                if (index in matched_conditions) == negated:
+                    break
+            else:
+                result.append(log_filter)
+
+        return result
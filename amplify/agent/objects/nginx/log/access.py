@@ -14,6 +14,126 @@ __email__ = "dedm@nginx.com"
 
 
 REQUEST_RE = re.compile(r'(?P<request_method>[A-Z]+) (?P<request_uri>/.*) (?P<server_protocol>.+)')
+IDENTIFIER_RE = re.compile(r'[a-zA-Z_]\w*\Z')
+
+
+class AccessLogRecord(object):
+    """
+    Base class for compact parsed lines: every log format gets a subclass with a slot per key.
+    Records can be read like parsed dicts ("key in record", record[key], record.get(key), iteration over keys),
+    keys which were not set (missing or skipped values) are absent.
+    """
+    __slots__ = ()
+
+    fields = frozenset()
+
+    __setitem__ = object.__setattr__
+
+    def __contains__(self, key):
+        return key in self.fields and hasattr(self, key)
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __iter__(self):
+        for key in self.__slots__:
+            if hasattr(self, key):
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.fields else default
+
+    def keys(self):
+        return list(self)
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in self)
+
+    def __eq__(self, other):
+        if isinstance(other, AccessLogRecord):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.as_dict())
+
+
+def compile_record_class(keys, name='AccessLogRecord'):
+    """
+    Generates a record class for a list of keys
+
+    :param keys: [] of str keys
+    :param name: str class name
+    :return: AccessLogRecord subclass or None if keys can't be slots
+    """
+    fields = ['malformed']
+    for key in keys:
+        if key not in fields:
+            fields.append(key)
+    if 'request' in fields:
+        fields.extend(key for key in ('request_method', 'request_uri', 'server_protocol') if key not in fields)
+
+    if any(not IDENTIFIER_RE.match(key) or hasattr(AccessLogRecord, key) for key in fields):
+        return None
+
+    return type(name, (AccessLogRecord,), {'__slots__': tuple(fields), 'fields': frozenset(fields)})
+
+
+def _time_converter(value):
+    """
+    Converts raw time variable to a list of floats, returns None if the value should be skipped
+
+    :param value: str raw value (e.g. "0.010" or "2.001, 0.345")
+    :return: [] of floats or None
+    """
+    if value == '-':
+        return None
+
+    array_value = []
+    for x in value.replace(' ', '').split(','):
+        x = float(x)
+        # workaround for an old nginx bug with time. ask lonerr@ for details
+        if x <= 10000000:
+            array_value.append(x)
+    return array_value or None
+
+
+def _comma_separated_converter(value):
+    """
+    Converts raw comma separated variable to a list of values
+
+    :param value: str raw value (e.g. "200, 502")
+    :return: [] of str
+    """
+    if ',' in value:
+        return value.replace(' ', '').split(',')  # remove spaces and split values into list
+    return [value]
+
+
+def _typed_converter(func):
+    """
+    Wraps a type function so that non-parsable values (for example gzip ratio can be '-') become 0
+
+    :param func: type function (int, float...)
+    :return: function
+    """
+    def convert(value):
+        try:
+            return func(value)
+        except ValueError:
+            return 0
+    return convert
 
 
 class NginxAccessLogParser(object):
@@ -59,17 +179,55 @@ class NginxAccessLogParser(object):
         'upstream_status'
     ]
 
-    def __init__(self, raw_format=None):
+    # chars which nginx escapes in variable values (along with control and non-ascii chars)
+    escaped_chars = ('"', '\\')
+
+    # variables which don't contain whitespaces
+    token_variables = (
+        'remote_addr',
+        'remote_port',
+        'server_addr',
+        'server_port',
+        'server_name',
+        'host',
+        'http_host',
+        'scheme',
+        'request_method',
+        'server_protocol',
+        'request_time',
+        'request_id',
+        'msec',
+        'time_iso8601',
+        'upstream_cache_status',
+        'ssl_protocol',
+        'ssl_cipher',
+    )
+
+    # variables which come from the client and can contain whitespaces (nginx accepts them in the request line,
+    # $uri is decoded), lines are split by their delimiters only if the delimiter is not found again
+    client_variables = (
+        'remote_user',
+        'request_uri',
+        'uri',
+        'args',
+    )
+
+    def __init__(self, raw_format=None, max_line_length=None):
         """
         Takes raw format and generates regex
         :param raw_format: raw log format
+        :param max_line_length: int lines longer than this are skipped (None - no limit)
         """
         self.raw_format = self.combined_format if raw_format is None else raw_format
+        self.max_line_length = max_line_length
+        self.projection = None  # set of keys to decode, None - all keys
 
         self.keys = []
+        self.literals = []  # literal separators around keys, always len(self.keys) + 1 items
         self.regex_string = r''
         self.regex = None
         current_key = None
+        current_literal = ['']
 
         # preprocess raw format and if we have trailing spaces in format we should remove them
         self.raw_format = prep_raw(self.raw_format).rstrip()
@@ -79,6 +237,7 @@ class NginxAccessLogParser(object):
             Finalizes key:
             1) removes $ and {} from it
             2) adds a regex for the key to the regex_string
+            3) stores the literal which precedes the key
             """
             chars_to_remove = ['$', '{', '}']
             plain_key = current_key.translate(None, ''.join(chars_to_remove))
@@ -94,6 +253,19 @@ class NginxAccessLogParser(object):
                 regex_var_name = plain_key
             self.regex_string += '(?P<%s>%s)' % (regex_var_name, rxp)
 
+            self.literals.append(current_literal[0])
+            current_literal[0] = ''
+
+        def add_literal(char):
+            """
+            Adds a literal char to the regex_string and to the current literal
+            """
+            current_literal[0] += char
+            if char.isalpha() or char.isdigit():
+                self.regex_string += char
+            else:
+                self.regex_string += '\%s' % char
+
         for char in self.raw_format:
             if current_key:
                 if char.isalpha() or char.isdigit() or char == '_' or (char == '{' and current_key == '$'):
@@ -109,31 +281,339 @@ class NginxAccessLogParser(object):
                     else:
                         # otherwise - add char to regex
                         current_key = None
-                        if char.isalpha() or char.isdigit():
-                            self.regex_string += char
-                        else:
-                            self.regex_string += '\%s' % char
+                        add_literal(char)
             else:
                 # if there's no current key
                 if char == '$':
                     current_key = char
                 else:
-                    if char.isalpha() or char.isdigit():
-                        self.regex_string += char
-                    else:
-                        self.regex_string += '\%s' % char
+                    add_literal(char)
 
         # key can be the last one element in a string
         if current_key:
             finalize_key()
 
+        self.literals.append(current_literal[0])
+
         self.regex = re.compile(self.regex_string)
+        self.batch_regex = re.compile(self._batch_regex_string(), re.MULTILINE)
+        self.overlong_regex = re.compile(
+            r'^[^\n]{%s,}\n?' % (self.max_line_length + 1), re.MULTILINE
+        ) if self.max_line_length else None
+        self.decoder = self._compile_decoder()
+        self.delimiters, self.validators, self.recheck = self._compile_splitter()
+        self.record_class = compile_record_class(self.keys)
+
+    def _batch_regex_string(self):
+        """
+        Builds a regex which matches whole lines of a multi-line buffer.
+        It is the same as the line regex, but values can't cross line ends and trailing spaces of a line are
+        ignored as if the line was stripped.
+
+        :return: str regex
+        """
+        def escape(literal):
+            return ''.join(char if char.isalpha() or char.isdigit() else '\\%s' % char for char in literal)
+
+        regex_string = '^'
+        for i, key in enumerate(self.keys):
+            rxp = self.common_variables.get(key, self.default_variable)[0]
+            rxp = rxp.replace('\\s', ' \\t')  # \s is used only inside char classes
+            if i == len(self.keys) - 1 and not self.literals[-1] and rxp == self.default_variable[0]:
+                rxp = '.*\\S'
+            regex_string += '%s(%s)' % (escape(self.literals[i]), rxp)
+        regex_string += '%s[^\\n]*$' % escape(self.literals[-1])
+        return regex_string
+
+    def project(self, keys=None):
+        """
+        Limits parsing results to the given keys, so values nobody uses are not converted and stored.
+        $request is always decoded, because it is required to detect malformed requests.
 
-    def parse(self, line):
+        :param keys: iterable of keys (None - all keys)
+        """
+        if keys is None:
+            self.projection = None
+        else:
+            self.projection = set(keys)
+            self.projection.add('request')
+        self.decoder = self._compile_decoder()
+
+    def _is_delimited(self, key, delimiter):
+        """
+        Checks that a delimiter can't appear inside the value of a key, so the first occurrence of the delimiter
+        is always the end of the value
+
+        :param key: str key
+        :param delimiter: str literal which follows the key in the format
+        :return: bool
+        """
+        if not delimiter:
+            return False
+
+        if self._is_escaped(delimiter):
+            return True
+
+        rxp = self.common_variables.get(key, self.default_variable)[0]
+        if rxp == self.default_variable[0]:
+            return (key in self.token_variables or key in self.client_variables) and delimiter[0].isspace()
+
+        return not re.match('(?:%s)\Z' % rxp, delimiter[0])
+
+    def _is_escaped(self, delimiter):
+        """
+        nginx escapes some chars in variables, so they can be found only in literals
+
+        :param delimiter: str literal
+        :return: bool True if the literal contains such chars
+        """
+        return any(char in self.escaped_chars or not ' ' <= char < '\x7f' for char in delimiter)
+
+    def _compile_splitter(self):
+        """
+        Prepares delimiters and validators for the linear parser.
+        Formats with keys which are not clearly delimited are parsed only with the regex.
+
+        :return: ([] of delimiters, [] of validators, [] of bools - the delimiter should be found once)
+                 or (None, None, None)
+        """
+        if not self.keys:
+            return None, None, None
+
+        # the last key is either the tail of the line or ends with the last occurrence of the trailing literal
+        delimiters = self.literals[1:]
+        for key, delimiter in zip(self.keys, delimiters[:-1]):
+            if not self._is_delimited(key, delimiter):
+                return None, None, None
+
+        validators = []
+        for key in self.keys:
+            rxp = self.common_variables.get(key, self.default_variable)[0]
+            validators.append(None if rxp == self.default_variable[0] else re.compile('(?:%s)\Z' % rxp))
+
+        # a value of a client variable could contain its delimiter
+        recheck = [
+            key in self.client_variables and not self._is_escaped(delimiter)
+            for key, delimiter in zip(self.keys, delimiters[:-1])
+        ]
+        recheck.append(False)  # the last delimiter is searched from the end anyway
+
+        return delimiters, validators, recheck
+
+    def split(self, line):
+        """
+        Cuts the line into raw values by literal delimiters in a single pass
+
+        :param line: log line
+        :return: [] of raw values in the order of keys or None if the line should be parsed with the regex
+        """
+        prefix = self.literals[0]
+        if not line.startswith(prefix):
+            return None
+
+        values = []
+        last = len(self.delimiters) - 1
+        start = len(prefix)
+        for i, delimiter in enumerate(self.delimiters):
+            if i < last:
+                end = line.find(delimiter, start)
+            elif delimiter:
+                end = line.rfind(delimiter, start)
+            else:
+                end = len(line)
+
+            # empty value or missing delimiter
+            if end <= start:
+                return None
+
+            # delimiter might be escaped inside the value (e.g. escape=json)
+            if delimiter and line[end - 1] == '\\':
+                return None
+
+            # or be a part of the value of a client variable
+            if self.recheck[i] and line.find(delimiter, end + len(delimiter)) != -1:
+                return None
+
+            value = line[start:end]
+            validator = self.validators[i]
+            if validator is not None and not validator.match(value):
+                return None
+
+            values.append(value)
+            start = end + len(delimiter)
+
+        return values
+
+    def _compile_decoder(self):
+        """
+        Compiles the format into a list of decoding steps, so that all key-specific decisions are made only once
+
+        Every step is a tuple of (group index, key, converter), where converter is None for plain string values.
+        Converters return None if the value should be skipped.  Duplicate variables are decoded only once - from the
+        first occurrence, which is the one named after the key in the regex.  Keys out of the projection are skipped.
+
+        :return: [] of steps
+        """
+        decoder = []
+        seen = set()
+        for index, key in enumerate(self.keys):
+            if key in seen or (self.projection is not None and key not in self.projection):
+                continue
+            seen.add(key)
+
+            func = self.common_variables.get(key, self.default_variable)[1]
+            if key.endswith('_time'):
+                converter = _time_converter
+            elif key in self.comma_separated_keys:
+                converter = _comma_separated_converter
+            elif func is str:
+                converter = None
+            else:
+                converter = _typed_converter(func)
+
+            decoder.append((index, key, converter))
+        return decoder
+
+    def parse(self, line, record=False):
         """
         Parses the line and if there are some special fields - parse them too
         For example we can get HTTP method and HTTP version from request
 
+        Lines are cut by delimiters first and the regex is used only for ambiguous formats or lines
+
+        :param line: log line
+        :param record: bool return a compact AccessLogRecord instead of a dict (if the format allows it)
+        :return: dict with parsed info
+        """
+        if self.max_line_length and len(line) > self.max_line_length:
+            context.default_log.debug(
+                'skipped line of %s chars (max line length is %s)' % (len(line), self.max_line_length)
+            )
+            return None
+
+        values = self.split(line) if self.delimiters is not None else None
+
+        if values is None:
+            common = self.regex.match(line)
+
+            if not common:
+                context.default_log.debug(
+                    'could not parse line "%s" with regex "%s"' % (
+                        line, self.regex_string
+                    )
+                )
+                return None
+
+            values = common.groups()
+
+        return self.decode(values, record=record)
+
+    def parse_batch(self, buffer, record=False):
+        """
+        Parses a buffer of many lines with a single regex pass over it.
+        Lines which can't be parsed are skipped.
+
+        :param buffer: str of lines separated by new lines (or [] of lines)
+        :param record: bool return compact AccessLogRecords instead of dicts (if the format allows it)
+        :return: [] of dicts with parsed info
+        """
+        if not isinstance(buffer, basestring):
+            buffer = '\n'.join(buffer)
+
+        if self.overlong_regex is not None:
+            buffer, skipped = self.overlong_regex.subn('', buffer)
+            if skipped:
+                context.default_log.debug(
+                    'skipped %s lines (max line length is %s)' % (skipped, self.max_line_length)
+                )
+
+        results = []
+        decode = self.decode
+        for match in self.batch_regex.finditer(buffer):
+            try:
+                results.append(decode(match.groups(), record=record))
+            except:
+                context.default_log.debug('could not parse line "%s"' % match.group(0), exc_info=True)
+        return results
+
+    def decode(self, values, record=False):
+        """
+        Converts raw values to a parsed result
+
+        :param values: [] of raw values in the order of keys
+        :param record: bool return a compact AccessLogRecord instead of a dict (if the format allows it)
+        :return: dict with parsed info
+        """
+        if record and self.record_class is not None:
+            return self._decode_record(values)
+
+        result = {'malformed': False}
+
+        for index, key, converter in self.decoder:
+            value = values[index]
+            if converter is not None:
+                value = converter(value)
+                if value is None:
+                    continue
+            result[key] = value
+
+        if 'request' in result:
+            self._split_request(result)
+
+        return result
+
+    def _decode_record(self, values):
+        """
+        Same as decode(), but fills a record (attributes are set directly, it's faster than record[key])
+
+        :param values: [] of raw values in the order of keys
+        :return: AccessLogRecord
+        """
+        result = self.record_class()
+        result.malformed = False
+
+        for index, key, converter in self.decoder:
+            value = values[index]
+            if converter is not None:
+                value = converter(value)
+                if value is None:
+                    continue
+            setattr(result, key, value)
+
+        request = getattr(result, 'request', None)
+        if request is not None:
+            parts = request.split(' ')
+            if len(parts) == 3 and len(parts[0]) >= 3:
+                result.request_method, result.request_uri, result.server_protocol = parts
+            else:
+                self._split_request(result)
+
+        return result
+
+    @staticmethod
+    def _split_request(result):
+        """
+        Splits $request into method, uri and protocol and marks the result as malformed if it can't be done
+
+        :param result: {} of parsed info
+        """
+        try:
+            method, uri, proto = result['request'].split(' ')
+            result['request_method'] = method
+            result['request_uri'] = uri
+            result['server_protocol'] = proto
+        except:
+            result['malformed'] = True
+            method = ''
+
+        if not result['malformed'] and len(method) < 3:
+            result['malformed'] = True
+
+    def parse_legacy(self, line):
+        """
+        Original key-by-key implementation of parse(), which interprets the format for every line.
+        Kept as a reference for differential testing of the compiled decoder.
+
         :param line: log line
         :return: dict with parsed info
         """
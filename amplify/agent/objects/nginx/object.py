@@ -12,8 +12,10 @@ from amplify.agent.objects.abstract import AbstractObject
 from amplify.agent.objects.nginx.binary import nginx_v
 from amplify.agent.objects.nginx.config.config import NginxConfig
 from amplify.agent.objects.nginx.filters import Filter
-from amplify.agent.pipelines.syslog import SyslogTail
-from amplify.agent.pipelines.file import FileTail
+from amplify.agent.pipelines.syslog import (
+    SyslogTail, DEFAULT_RCVBUF, DEFAULT_BUFFER_SIZE, DEFAULT_MAX_BATCH, DEFAULT_SOCKET_MODE
+)
+from amplify.agent.pipelines.file import shared_tail, CATCHUP_SIZE, MAX_BACKLOG, MAX_PENDING
 
 
 __author__ = "Mike Belov"
@@ -181,19 +183,35 @@ class NginxObject(AbstractObject):
         :return: Pipeline
         """
         tail = None
+        nginx_config = context.app_config['containers'].get('nginx', {})
         try:
             if name.startswith('syslog'):
                 address_bucket = name.split(',', 1)[0]
-                host, port, address = net.ipv4_address(
-                    address=address_bucket.split('=')[1], full_format=True, silent=True
-                )
-                # Right now we assume AFNET address/port...e.g. no support for unix sockets
+                server = address_bucket.split('=', 1)[1]
+                socket_path = net.unix_address(server)
+                if socket_path:
+                    # unix datagram socket, listeners are defined as "unix:/path" as well
+                    address = server
+                else:
+                    host, port, address = net.ipv4_address(address=server, full_format=True, silent=True)
 
                 if address in context.listeners:
-                    port = int(port)  # socket requires integer port
-                    tail = SyslogTail(address=(host, port))
+                    tail = SyslogTail(
+                        address=socket_path or (host, int(port)),  # socket requires integer port
+                        buffer_size=int(nginx_config.get('syslog_buffer_size', DEFAULT_BUFFER_SIZE)),
+                        rcvbuf=int(nginx_config.get('syslog_rcvbuf', DEFAULT_RCVBUF)),
+                        max_batch=int(nginx_config.get('syslog_max_batch', DEFAULT_MAX_BATCH)),
+                        socket_mode=int(str(nginx_config.get('syslog_socket_mode', '%o' % DEFAULT_SOCKET_MODE)), 8),
+                        statsd=self.statsd  # the listener reports its stats
+                    )
             else:
-                tail = FileTail(name)
+                # collectors of the same file share a single reader
+                tail = shared_tail(
+                    name,
+                    max_pending=int(nginx_config.get('log_max_pending', MAX_PENDING)),
+                    catchup_size=int(nginx_config.get('log_catchup_size', CATCHUP_SIZE)),
+                    max_backlog=int(nginx_config.get('log_max_backlog', MAX_BACKLOG))
+                )
         except Exception as e:
             context.log.error(
                 'failed to initialize pipeline for "%s" due to %s (maybe has no rights?)' % (name, e.__class__.__name__)
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
+import json
+import mmap
+import os
 import time
-from os import stat
+import weakref
+from collections import deque
+from os import stat, fstat
 
 from amplify.agent.common.context import context
+from amplify.agent.common.util import inotify
 
 from amplify.agent.pipelines.abstract import Pipeline
 
@@ -18,11 +24,309 @@ __email__ = "dedm@nginx.com"
 # this one is used to store offset between objects' reloads
 OFFSET_CACHE = {}
 
+# (st_dev, st_ino) of tailed files, saved with offsets
+FILE_IDS = {}
+
+# live tails by file name, their consumed offsets are checkpointed instead of the read ones
+TAILS = weakref.WeakValueDictionary()
+
+# inotify dispatcher shared by all watched files, created on first use
+WATCH_DISPATCHER = []
+
+# offset checkpoints by state file name, loaded on first use
+CHECKPOINTS = {}
+
+# shared readers of files tailed by several collectors by (st_dev, st_ino)
+SHARED_TAILS = {}
+
+OFFSETS_FILENAME = 'offsets.json'
+MAX_BACKLOG = 64 * 1024 * 1024  # 64 MB, max unread data to replay after a restart
+
+CHUNK_SIZE = 1024 * 1024  # 1 MB
+CATCHUP_SIZE = 32 * 1024 * 1024  # 32 MB, unread data to read with mmap
+MAX_PENDING = 64 * 1024 * 1024  # 64 MB, max data read for a subscriber of a shared tail and not consumed yet
+
+
+def read_range(filename, start, end, size=CHUNK_SIZE):
+    """
+    Reads complete lines between two offsets of a file in chunks of about "size" bytes.
+    Offsets should be line-aligned (see FileTail.read_ranges), the last new line of every chunk is removed.
+
+    :param filename: str file name
+    :param start: int offset of the first line
+    :param end: int offset after the new line of the last line
+    :param size: int chunk size in bytes
+    :return: generator of str chunks
+    """
+    with open(filename, 'r') as fh:
+        fh.seek(start)
+        position = start
+        remainder = ''
+
+        while position < end:
+            data = fh.read(min(size, end - position))
+            if not data:
+                break
+            position += len(data)
+
+            if remainder:
+                data = remainder + data
+
+            last = data.rfind('\n')
+            if last == -1:
+                remainder = data
+                continue
+
+            remainder = data[last + 1:]
+            yield data[:last]
+
+
+class OffsetCheckpoint(object):
+    """
+    Offsets of tailed files with their devices and inodes, saved to a state file so a restarted agent
+    continues reading where the previous one stopped
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.saved = None  # state written last time
+        self.restored = self._read()
+
+    def _read(self):
+        try:
+            with open(self.filename, 'r') as f:
+                state = json.load(f)
+            return state if isinstance(state, dict) else {}
+        except (IOError, ValueError):
+            return {}
+
+    def restore(self, filename, st):
+        """
+        :param filename: str file name
+        :param st: os.stat_result of the file
+        :return: int saved offset, 0 if the file was rotated or truncated since, None if nothing is saved
+        """
+        saved = self.restored.get(filename)
+        if not isinstance(saved, dict):
+            return None
+
+        same_file = (saved.get('dev'), saved.get('inode')) == (st.st_dev, st.st_ino)
+        offset = saved.get('offset')
+        if same_file and isinstance(offset, (int, long)) and 0 <= offset <= st.st_size:
+            return offset
+        return 0
+
+    def save(self, offsets, file_ids):
+        """
+        Atomically replaces the state file (if the state has changed)
+
+        :param offsets: {} of file name -> offset
+        :param file_ids: {} of file name -> (st_dev, st_ino)
+        """
+        state = dict(
+            (filename, {'offset': offset, 'dev': file_ids[filename][0], 'inode': file_ids[filename][1]})
+            for filename, offset in offsets.iteritems() if filename in file_ids
+        )
+        if state == self.saved:
+            return
+
+        tmp_filename = '%s.tmp' % self.filename
+        with open(tmp_filename, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, self.filename)
+        self.saved = state
+
+
+def get_checkpoint():
+    """
+    :return: OffsetCheckpoint in the state directory or None if the state directory is not configured
+    """
+    state_dir = context.app_config.get('daemon', {}).get('state_dir')
+    if not state_dir:
+        return None
+
+    filename = os.path.join(state_dir, OFFSETS_FILENAME)
+    if filename not in CHECKPOINTS:
+        CHECKPOINTS[filename] = OffsetCheckpoint(filename)
+    return CHECKPOINTS[filename]
+
+
+def save_offsets():
+    """
+    Checkpoints offsets of all tailed files (called by collectors after every collect)
+
+    Lines which were read but not handed to a collector yet (the rest of a block, chunks queued for subscribers
+    of a shared tail) would be lost after a restart, so consumed offsets of live tails are saved instead
+    of the read ones.
+    """
+    checkpoint = get_checkpoint()
+    if checkpoint is None:
+        return
+
+    offsets = dict(OFFSET_CACHE)
+    for filename, tail in TAILS.items():
+        offsets[filename] = tail.consumed_offset()
+    for reader in SHARED_TAILS.values():
+        offsets[reader.tail.filename] = reader.consumed_offset()
+
+    try:
+        checkpoint.save(offsets, FILE_IDS)
+    except (IOError, OSError) as e:
+        context.log.error('failed to save log offsets to %s: %s' % (checkpoint.filename, e))
+        context.log.debug('additional info:', exc_info=True)
+
+
+class WatchDispatcher(object):
+    """
+    Single inotify instance shared by all watched files (the number of inotify instances per user is limited,
+    see fs.inotify.max_user_instances): events are read once and passed to watchers by watch descriptor
+    """
+
+    def __init__(self):
+        self.inotify = inotify.Inotify()
+        self.watchers = {}  # wd -> set of FileWatchers (a path watched twice has the same wd)
+
+    def add_watch(self, watcher, path, mask):
+        wd = self.inotify.add_watch(path, mask)
+        self.watchers.setdefault(wd, set()).add(watcher)
+        return wd
+
+    def rm_watch(self, watcher, wd):
+        watchers = self.watchers.get(wd)
+        if watchers is None:
+            return
+
+        watchers.discard(watcher)
+        if not watchers:
+            del self.watchers[wd]
+            self.inotify.rm_watch(wd)
+
+    def poll(self):
+        """
+        Reads queued events and passes them to watchers
+        """
+        for wd, mask, name in self.inotify.read_events():
+            if mask & inotify.IN_Q_OVERFLOW:
+                # events were lost, everything has to be checked
+                for watchers in self.watchers.values():
+                    for watcher in watchers:
+                        watcher.verify = True
+                continue
+
+            for watcher in list(self.watchers.get(wd, ())):
+                watcher.handle(wd, mask, name)
+
+            if mask & inotify.IN_IGNORED:
+                # the watch was removed by the kernel (e.g. the file was deleted)
+                self.watchers.pop(wd, None)
+
+
+def get_dispatcher():
+    """
+    :return: WatchDispatcher shared by all FileWatchers
+    """
+    if not WATCH_DISPATCHER:
+        WATCH_DISPATCHER.append(WatchDispatcher())
+    return WATCH_DISPATCHER[0]
+
+
+class FileWatcher(object):
+    """
+    Watches a file for writes and rotations with inotify
+
+    The file is watched for modifications, its directory for a new file with the same name,
+    so a rotation is known as soon as the new file appears and nothing is read while nothing is written.
+
+    Events can be missed (the queue overflows), so the inode is verified by the tail if the file was moved
+    or deleted, after an overflow and every "verify_interval" polls anyway.
+    """
+    file_events = inotify.IN_MODIFY | inotify.IN_MOVE_SELF | inotify.IN_DELETE_SELF
+    directory_events = inotify.IN_CREATE | inotify.IN_MOVED_TO
+    verify_interval = 10
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.basename = os.path.basename(filename)
+        self.dispatcher = get_dispatcher()
+        self.dispatcher.poll()  # queued events are about files watched before
+        self.directory_wd = self.dispatcher.add_watch(
+            self, os.path.dirname(os.path.abspath(filename)), self.directory_events
+        )
+        try:
+            self.file_wd = self.dispatcher.add_watch(self, filename, self.file_events)
+        except:
+            self.dispatcher.rm_watch(self, self.directory_wd)
+            raise
+
+        self.modified = True  # lines could be written before the watch was added
+        self.rotated = False
+        self.verify = False  # the inode should be checked
+        self.polls = 0
+
+    def handle(self, wd, mask, name):
+        """
+        Processes an event of one of the watches
+        """
+        if wd == self.file_wd:
+            if mask & inotify.IN_MODIFY:
+                self.modified = True
+            if mask & (inotify.IN_MOVE_SELF | inotify.IN_DELETE_SELF):
+                self.verify = True
+        elif wd == self.directory_wd and name == self.basename:
+            self.rotated = True
+
+    def poll(self):
+        """
+        Processes queued events
+        """
+        self.dispatcher.poll()
+        self.polls += 1
+        if self.polls % self.verify_interval == 0:
+            self.verify = True
+
+    def changed(self):
+        """
+        :return: bool True if the file was written or rotated since it was read to the end (or should be checked)
+        """
+        self.poll()
+        return self.modified or self.rotated or self.verify
+
+    def rewatch(self):
+        """
+        Watches the new file after a rotation
+        """
+        self.dispatcher.rm_watch(self, self.file_wd)
+        self.file_wd = self.dispatcher.add_watch(self, self.filename, self.file_events)
+        self.rotated = False
+        self.verify = False
+        self.modified = True
+
+    def close(self):
+        self.dispatcher.rm_watch(self, self.file_wd)
+        self.dispatcher.rm_watch(self, self.directory_wd)
+
 
 class FileTail(Pipeline):
     """
     Creates an iterable object that returns only unread lines.
 
+    The file is read in blocks of "block_size" bytes which are split to lines at once. A partially written line
+    at the end of the file is not returned, it is read again with the rest of it next time,
+    so the offset always points to the beginning of a line.
+
+    On Linux the file is watched with inotify (see FileWatcher): reads are skipped while nothing is written,
+    rotations are detected from events (the inode is only checked now and then, see FileWatcher) and lines left
+    in the rotated file are read before the new one.
+    Elsewhere (or if the watch can't be added) rotations are checked by inode on every read.
+
+    If "catchup_size" or more bytes are unread (e.g. after a restart), read_chunks() maps the unread part of the file
+    and takes chunks straight from the mapping, then goes back to normal reads.
+
+    A new tail starts at the end of the file, unless an offset saved by the previous run of the agent is found
+    in the state directory (see save_offsets). Then up to "max_backlog" unread bytes are replayed.
+
     Based on some code of Pygtail
     pygtail - a python "port" of logtail2
     Copyright (C) 2011 Brad Greenlee <brad@footle.org>
@@ -30,21 +334,36 @@ class FileTail(Pipeline):
     https://raw.githubusercontent.com/bgreenlee/pygtail/master/pygtail/core.py
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, block_size=CHUNK_SIZE, watch=True, catchup_size=CATCHUP_SIZE,
+                 max_backlog=MAX_BACKLOG):
         super(FileTail, self).__init__(name='file:%s' % filename)
         self.filename = filename
+        self.block_size = block_size
+        self.catchup_size = catchup_size
+        self.max_backlog = max_backlog
         self._fh = None
+        self._rotated_fh = None  # the rotated file, until lines left in it are read
+        self._lines = deque()  # lines of the last block not returned by the iterator yet
+        self._lines_size = 0  # bytes in _lines (with new lines)
 
-        # open a file and seek to the end
+        # open a file and seek to the end (or to the offset saved by the previous run)
         if self.filename not in OFFSET_CACHE:
             with open(self.filename, "r") as f:
-                f.seek(0, 2)
-                self._offset = OFFSET_CACHE[self.filename] = f.tell()
+                self._offset = OFFSET_CACHE[self.filename] = self._restore_offset(f)
         else:
             self._offset = OFFSET_CACHE[self.filename]
 
         # save inode to determine rotations
-        self._inode = self._st_ino()
+        self._update_inode()
+
+        self.watcher = None
+        if watch and inotify.available():
+            try:
+                self.watcher = FileWatcher(self.filename)
+            except (OSError, IOError) as e:
+                context.log.debug('could not watch "%s" with inotify, polling it: %s' % (self.filename, e))
+
+        TAILS[self.filename] = self
 
     def __del__(self):
         try:
@@ -52,22 +371,64 @@ class FileTail(Pipeline):
                 self._fh.close()
         except StopIteration:
             pass
+        finally:
+            if self._rotated_fh is not None:
+                self._rotated_fh.close()
+            if self.watcher is not None:
+                self.watcher.close()
 
     def __iter__(self):
-        self._filehandle()
+        # rotations are checked on every block read
         return self
 
+    def _restore_offset(self, fh):
+        """
+        :param fh: file handle
+        :return: int saved offset (moved forward to replay at most max_backlog bytes) or the end of the file
+        """
+        st = fstat(fh.fileno())
+        checkpoint = get_checkpoint()
+        offset = checkpoint.restore(self.filename, st) if checkpoint is not None else None
+        if offset is None:
+            return st.st_size
+
+        if st.st_size - offset > self.max_backlog:
+            context.log.debug('skipping %s bytes of %s backlog' % (st.st_size - offset - self.max_backlog, self.filename))
+            # skip to the beginning of a line
+            fh.seek(st.st_size - self.max_backlog - 1)
+            fh.readline()
+            offset = fh.tell()
+        return offset
+
     def _st_ino(self):
         return stat(self.filename).st_ino
 
     def _update_inode(self):
-        self._inode = self._st_ino()
+        st = stat(self.filename)
+        self._inode = st.st_ino
+        FILE_IDS[self.filename] = (st.st_dev, st.st_ino)
 
     def _file_was_rotated(self):
         """
         Checks that file was rotated
         :return: bool
         """
+        if self.watcher is not None:
+            self.watcher.poll()
+            if self.watcher.rotated:
+                return True
+            if not self.watcher.verify:
+                return False
+
+            try:
+                new_inode = self._st_ino()
+            except OSError:
+                # moved or deleted, the old file is read until a new one appears
+                return False
+
+            self.watcher.verify = False
+            return new_inode != self._inode
+
         # wait for new file
         tries = 0
         new_inode = self._inode
@@ -93,14 +454,19 @@ class FileTail(Pipeline):
     def __next__(self):
         """
         Return the next line in the file, updating the offset.
+        The offset is moved by blocks, so it also covers lines of the current block which are not returned yet
+        (the consumed offset does not).
         """
-        try:
-            line = self._get_next_line()
-        except StopIteration:
-            # we've reached the end of the file;
-            self._update_offset()
-            raise
-        return line
+        if not self._lines:
+            block = self._read_block(self.block_size)
+            if block is None:
+                raise StopIteration
+            self._lines.extend(block.split('\n'))
+            self._lines_size = len(block) + 1
+
+        line = self._lines.popleft()
+        self._lines_size -= len(line) + 1
+        return line.rstrip()
 
     def readlines(self):
         """
@@ -108,6 +474,225 @@ class FileTail(Pipeline):
         """
         return [line for line in self]
 
+    def read_batch(self, size=None):
+        """
+        Reads a block of unread lines, updating the offset.
+
+        :param size: int block size in bytes (self.block_size by default)
+        :return: [] of str lines (without trailing whitespace), empty if there are no new complete lines
+        """
+        if self._lines:
+            # lines which the iterator has read already
+            lines = [line.rstrip() for line in self._lines]
+            self._lines.clear()
+            self._lines_size = 0
+            return lines
+
+        block = self._read_block(size or self.block_size)
+        if block is None:
+            return []
+        return [line.rstrip() for line in block.split('\n')]
+
+    def read_chunks(self, size=None):
+        """
+        Reads unread lines in chunks of about "size" bytes, updating the offset.
+        Every chunk ends with a complete line (the last new line is removed), a partially written line at the end
+        of the file is left for the next read.
+
+        :param size: int chunk size in bytes (self.block_size by default)
+        :return: generator of str chunks
+        """
+        size = size or self.block_size
+        if self._lines:
+            # lines which the iterator has read already
+            chunk = '\n'.join(self._lines)
+            self._lines.clear()
+            self._lines_size = 0
+            yield chunk
+
+        if self.catchup_size and self._rotated_fh is None and self.unread_size() >= self.catchup_size:
+            for chunk in self._read_mapped(size):
+                yield chunk
+
+        while True:
+            block = self._read_block(size)
+            if block is None:
+                break
+            yield block
+
+    def _read_mapped(self, size):
+        """
+        Reads unread complete lines in chunks of about "size" bytes from a memory mapping of the file,
+        updating the offset
+
+        :param size: int chunk size in bytes
+        :return: generator of str chunks
+        """
+        fh = self._filehandle()
+        fileno = fh.fileno()
+        file_size = fstat(fileno).st_size
+        map_start = self._offset - self._offset % mmap.ALLOCATIONGRANULARITY
+        mapping = mmap.mmap(fileno, file_size - map_start, access=mmap.ACCESS_READ, offset=map_start)
+        context.log.debug('catching up %s bytes of %s' % (file_size - self._offset, self.filename))
+
+        try:
+            position = self._offset - map_start
+            limit = file_size - map_start
+            while position < limit:
+                # pages of a truncated file can't be accessed anymore (SIGBUS), so it's checked before every chunk
+                if fstat(fileno).st_size < map_start + limit:
+                    context.log.debug('%s was truncated while catching up' % self.filename)
+                    break
+
+                end = mapping.rfind('\n', position, min(position + size, limit))
+                if end == -1:
+                    # a line longer than the chunk
+                    end = mapping.find('\n', position + size, limit)
+                    if end == -1:
+                        break
+
+                chunk = mapping[position:end]
+                position = end + 1
+                self._offset = OFFSET_CACHE[self.filename] = map_start + position
+                yield chunk
+        finally:
+            mapping.close()
+            fh.seek(self._offset)
+
+    def _read_block(self, size):
+        """
+        Reads complete lines from the offset, at least "size" bytes of them if the file has enough,
+        and moves the offset after the last new line
+
+        :param size: int block size in bytes
+        :return: str lines without the last new line or None if there are no new complete lines
+        """
+        if self.watcher is not None and self._rotated_fh is None and not self.watcher.changed():
+            return None
+
+        fh = self._filehandle()
+
+        if self._rotated_fh is not None:
+            block = self._read_lines(self._rotated_fh, size)
+            if block is not None:
+                return block
+            self._rotated_fh.close()
+            self._rotated_fh = None
+
+        block = self._read_lines(fh, size)
+        if block is None:
+            if self.watcher is not None:
+                self.watcher.modified = False  # read to the end
+            return None
+
+        self._offset = OFFSET_CACHE[self.filename] = self._offset + len(block) + 1
+        return block
+
+    @staticmethod
+    def _read_lines(fh, size):
+        """
+        Reads complete lines from the current position of a file, at least "size" bytes of them
+        if the file has enough. A partially written line at the end is returned to the file.
+
+        :param fh: file handle
+        :param size: int block size in bytes
+        :return: str lines without the last new line or None if there are no complete lines
+        """
+        start = fh.tell()
+        data = fh.read(size)
+        end = data.rfind('\n')
+
+        # a line longer than the block
+        while end == -1:
+            more = fh.read(size)
+            if not more:
+                break
+            data += more
+            end = data.rfind('\n')
+
+        if end + 1 < len(data):
+            fh.seek(start + end + 1)
+
+        return data[:end] if end != -1 else None
+
+    def unread_size(self):
+        """
+        :return: int number of bytes which were not read yet
+        """
+        return max(fstat(self._filehandle().fileno()).st_size - self._offset, 0)
+
+    def consumed_offset(self):
+        """
+        :return: int offset of the first line which was not handed out yet (the read offset minus lines left
+                 of the last block)
+        """
+        return max(self._offset - self._lines_size, 0)
+
+    def read_ranges(self, count):
+        """
+        Splits unread complete lines into up to "count" line-aligned byte ranges of about the same size and
+        marks them as read. Lines can be read later with read_range(), even by another process.
+
+        :param count: int number of ranges
+        :return: [] of (start, end) offsets
+        """
+        fh = self._filehandle()
+        start = self._offset
+        end = self._last_line_end(fh, start)
+        if end <= start:
+            fh.seek(start)
+            return []
+
+        ranges = []
+        step = max((end - start) // count, 1)
+        range_start = start
+        for i in xrange(1, count):
+            # move the boundary to the beginning of the next line
+            fh.seek(start + step * i - 1)
+            fh.readline()
+            boundary = fh.tell()
+
+            if boundary >= end:
+                break
+            if boundary > range_start:
+                ranges.append((range_start, boundary))
+                range_start = boundary
+        ranges.append((range_start, end))
+
+        self._offset = OFFSET_CACHE[self.filename] = end
+        fh.seek(end)
+        return ranges
+
+    def rewind(self, offset):
+        """
+        Moves the offset back to the beginning of a line marked as read by read_ranges(), so lines after it
+        are read again
+
+        :param offset: int offset between the current one and the end of the last read_ranges() call
+        """
+        self._offset = OFFSET_CACHE[self.filename] = offset
+        if not self._is_closed():
+            self._fh.seek(offset)
+
+    @staticmethod
+    def _last_line_end(fh, start, size=64 * 1024):
+        """
+        Finds the end of the last complete line of a file
+
+        :param fh: file handle
+        :param start: int offset to search from
+        :return: int offset after the last new line (or start if there are no new lines)
+        """
+        position = fstat(fh.fileno()).st_size
+        while position > start:
+            block_start = max(position - size, start)
+            fh.seek(block_start)
+            last = fh.read(position - block_start).rfind('\n')
+            if last != -1:
+                return block_start + last + 1
+            position = block_start
+        return start
+
     def _is_closed(self):
         if not self._fh:
             return True
@@ -121,22 +706,275 @@ class FileTail(Pipeline):
         file_was_rotated = self._file_was_rotated()
 
         if not self._fh or self._is_closed() or file_was_rotated:
-            if not self._is_closed():
+            if file_was_rotated and self.watcher is not None and not self._is_closed():
+                # lines left in the rotated file are read before the new one
+                if self._rotated_fh is not None:
+                    self._rotated_fh.close()
+                self._rotated_fh = self._fh
+            elif not self._is_closed():
                 self._fh.close()
 
             if file_was_rotated:
                 self._update_inode()
                 self._offset = OFFSET_CACHE[self.filename] = 0
+                if self.watcher is not None:
+                    self.watcher.rewatch()
 
             self._fh = open(self.filename, "r")
             self._fh.seek(self._offset)
         return self._fh
 
-    def _update_offset(self):
-        self._offset = OFFSET_CACHE[self.filename] = self._filehandle().tell()
 
-    def _get_next_line(self):
-        line = self._fh.readline()
-        if not line:
-            raise StopIteration
+def shared_tail(filename, max_pending=MAX_PENDING, **kwargs):
+    """
+    Subscribes to the shared reader of a file: every file (even if it's referenced by several names) is read
+    once and its lines are passed to every subscriber
+
+    :param filename: str file name
+    :param max_pending: int max bytes queued for a subscriber
+    :param kwargs: FileTail arguments, used if the file is not read yet
+    :return: FileTailSubscriber
+    """
+    # files could be rotated since their readers were registered
+    for key, reader in SHARED_TAILS.items():
+        if reader.file_id != key:
+            del SHARED_TAILS[key]
+            SHARED_TAILS[reader.file_id] = reader
+
+    st = stat(filename)
+    key = (st.st_dev, st.st_ino)
+    if key not in SHARED_TAILS:
+        SHARED_TAILS[key] = SharedFileTail(FileTail(filename, **kwargs), max_pending=max_pending)
+    return SHARED_TAILS[key].subscribe()
+
+
+class SharedFileTail(object):
+    """
+    Single reader of a file which queues chunks of new lines for all of its subscribers.
+
+    The file is read only when a subscriber has consumed everything queued for it. If a subscriber falls behind
+    by max_pending bytes, nothing is read until it catches up, so the unread data stays in the file
+    (and its offset is not moved) instead of piling up in memory.
+
+    A large backlog can be split into ranges instead (see read_ranges): the collector of the subscriber which
+    asked for them parses every range once for all subscribers with parse arguments and queues the results
+    for them, the others get chunks of the ranges.
+    """
+
+    def __init__(self, tail, max_pending=MAX_PENDING):
+        """
+        :param tail: FileTail
+        :param max_pending: int max bytes queued for a subscriber
+        """
+        self.tail = tail
+        self.max_pending = max_pending
+        self.subscribers = []
+
+    @property
+    def file_id(self):
+        return FILE_IDS.get(self.tail.filename)
+
+    def subscribe(self):
+        subscriber = FileTailSubscriber(self)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+        if not self.subscribers:
+            for key, reader in SHARED_TAILS.items():
+                if reader is self:
+                    del SHARED_TAILS[key]
+
+    def consumed_offset(self):
+        """
+        :return: int offset of the first line which was not consumed by every subscriber
+        """
+        behind = max([subscriber.pending_size + subscriber.lines_size for subscriber in self.subscribers] or [0])
+        return max(self.tail.consumed_offset() - behind, 0)
+
+    def read_ranges(self, count):
+        """
+        Splits unread lines into ranges (see FileTail.read_ranges), unless a subscriber is too far behind
+
+        :param count: int number of ranges
+        :return: [] of (start, end) offsets
+        """
+        for subscriber in self.subscribers:
+            if subscriber.pending_size >= self.max_pending:
+                return []
+        return self.tail.read_ranges(count)
+
+    def queue_ranges(self, ranges):
+        """
+        Queues chunks of parsed ranges for subscribers which can't take parsed results
+
+        :param ranges: [] of (start, end) offsets
+        """
+        readers = [subscriber for subscriber in self.subscribers if subscriber.parse_args is None]
+        if not readers:
+            return
+
+        for start, end in ranges:
+            for chunk in read_range(self.tail.filename, start, end, self.tail.block_size):
+                for subscriber in readers:
+                    subscriber.chunks.append(chunk)
+                    subscriber.pending_size += len(chunk) + 1
+
+    def fill(self, size=None):
+        """
+        Reads about "size" bytes of new lines and queues them for every subscriber
+
+        :param size: int bytes to read (tail block size by default)
+        :return: bool True if anything was read
+        """
+        for subscriber in self.subscribers:
+            if subscriber.pending_size >= self.max_pending:
+                return False
+
+        size = size or self.tail.block_size
+        read = 0
+        chunks = self.tail.read_chunks(size)
+        try:
+            for chunk in chunks:
+                for subscriber in self.subscribers:
+                    subscriber.chunks.append(chunk)
+                    subscriber.pending_size += len(chunk) + 1
+                read += len(chunk) + 1
+                if read >= size:
+                    break
+        finally:
+            chunks.close()
+
+        return read > 0
+
+
+class FileTailSubscriber(Pipeline):
+    """
+    Collector's view of a shared file: the same API as FileTail (lines, chunks, ranges, unread size) over the chunks
+    queued for this subscriber
+    """
+
+    def __init__(self, shared):
+        """
+        :param shared: SharedFileTail
+        """
+        super(FileTailSubscriber, self).__init__(name='file:%s' % shared.tail.filename)
+        self.shared = shared
+        self.filename = shared.tail.filename
+        self.chunks = deque()  # chunks read from the file and not consumed yet
+        self.pending_size = 0  # bytes in chunks
+        self._lines = deque()  # lines of the last chunk not returned by the iterator yet
+        self.lines_size = 0  # bytes in _lines (with new lines)
+        self.parse_args = None  # arguments of the collector's range parser, ranges are parsed for it by others
+        self.parsed = deque()  # (lines, result, size) of ranges parsed for this subscriber
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._lines:
+            for chunk in self.read_chunks():
+                self._lines.extend(chunk.split('\n'))
+                self.lines_size = len(chunk) + 1
+                break
+            if not self._lines:
+                raise StopIteration
+
+        line = self._lines.popleft()
+        self.lines_size -= len(line) + 1
         return line.rstrip()
+
+    def readlines(self):
+        return [line for line in self]
+
+    def read_chunks(self, size=None):
+        """
+        Returns queued chunks, reading the file when the queue is empty
+
+        :param size: int bytes to read at once (tail block size by default)
+        :return: generator of str chunks
+        """
+        if self._lines:
+            # lines which the iterator has read already
+            chunk = '\n'.join(self._lines)
+            self._lines.clear()
+            self.lines_size = 0
+            yield chunk
+
+        while True:
+            if not self.chunks:
+                self.shared.fill(size)
+                if not self.chunks:
+                    break
+
+            chunk = self.chunks.popleft()
+            self.pending_size -= len(chunk) + 1
+            yield chunk
+
+    def read_ranges(self, count):
+        """
+        Splits unread lines of the file into ranges for all subscribers: the caller parses them for every
+        subscriber of range_subscribers() (passing results with put_parsed) and then calls ranges_parsed()
+
+        :param count: int number of ranges
+        :return: [] of (start, end) offsets, empty if chunks queued for this subscriber are to be consumed first
+        """
+        if self.chunks or self._lines:
+            return []
+        return self.shared.read_ranges(count)
+
+    def range_subscribers(self):
+        """
+        :return: [] of FileTailSubscribers which take parsed ranges
+        """
+        return [subscriber for subscriber in self.shared.subscribers if subscriber.parse_args is not None]
+
+    def put_parsed(self, lines, result, size):
+        """
+        Queues a range parsed by another subscriber's collector
+
+        :param lines: int number of lines
+        :param result: parse result
+        :param size: int size of the range in bytes
+        """
+        self.parsed.append((lines, result, size))
+        self.pending_size += size
+
+    def take_parsed(self):
+        """
+        :return: [] of (lines, result) of ranges parsed for this subscriber
+        """
+        parsed = []
+        while self.parsed:
+            lines, result, size = self.parsed.popleft()
+            self.pending_size -= size
+            parsed.append((lines, result))
+        return parsed
+
+    def ranges_parsed(self, ranges):
+        """
+        Hands parsed ranges to subscribers which don't take parsed results
+
+        :param ranges: [] of (start, end) offsets
+        """
+        self.shared.queue_ranges(ranges)
+
+    def rewind(self, offset):
+        self.shared.tail.rewind(offset)
+
+    def unread_size(self):
+        """
+        :return: int number of bytes queued for this subscriber or not read from the file yet
+        """
+        return self.pending_size + self.shared.tail.unread_size()
+
+    def stop(self):
+        self.chunks.clear()
+        self.parsed.clear()
+        self.pending_size = 0
+        self._lines.clear()
+        self.lines_size = 0
+        self.shared.unsubscribe(self)
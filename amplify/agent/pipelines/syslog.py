@@ -1,17 +1,21 @@
 """
-Asyncore implementation of a syslog interface.  Adapted from "Tiny Syslog Server in Python" (
-https://gist.github.com/marcelom/4218010) using Asyncore (https://docs.python.org/2/library/asyncore.html).  Some
-inspiration for asyncore implementation derived from pymotw (https://pymotw.com/2/asyncore/).
+Non-blocking implementation of a syslog interface.  Originally adapted from "Tiny Syslog Server in Python" (
+https://gist.github.com/marcelom/4218010) using Asyncore, now the socket is drained in a tight non-blocking loop
+every time it becomes readable, waiting on the gevent hub (epoll on Linux) in between.
 
-SyslogTail spawns coroutine which in turns spawns an asyncore implemented syslog server and handler/cache and returns
+SyslogTail spawns coroutine which in turns spawns a syslog server and handler/cache and returns
 the received messages when iterated.
 """
 # -*- coding: utf-8 -*-
-import copy
-import asyncore
+import errno
+import os
 import socket
+import stat
+import time
 from collections import deque
 
+import gevent
+from gevent import select
 from threading import current_thread
 from amplify.agent.common.util.threads import spawn
 
@@ -35,53 +39,227 @@ __email__ = "grant.hulegaard@nginx.com"
 
 SYSLOG_ADDRESSES = set()
 
+DEFAULT_CHUNK_SIZE = 8192
+DEFAULT_RCVBUF = 4 * 1024 * 1024  # 4 MB, the kernel caps it with net.core.rmem_max
+DEFAULT_MAX_BATCH = 1000  # datagrams read per drain, other greenlets run in between
+DEFAULT_BATCH_LINES = 1000  # lines per chunk returned by SyslogTail.read_chunks()
+DEFAULT_BUFFER_SIZE = 16 * 1024 * 1024  # 16 MB of messages received between two collects
+DEFAULT_SOCKET_MODE = 0o660  # unix socket writable by the agent user and group
+
 
 class AmplifyAddresssAlreadyInUse(AmplifyException):
     description = "Couldn't start socket listener because address already in use"
 
 
-class SyslogServer(asyncore.dispatcher):
-    """Simple socket server that creates a socket and listens for and caches UDP packets"""
+def kernel_drops(sock):
+    """
+    Reads the number of datagrams the kernel dropped for a UDP socket (Linux only)
+
+    :param sock: socket
+    :return: int number of dropped datagrams or None if unknown
+    """
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for filename in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            with open(filename) as f:
+                for line in f:
+                    fields = line.split()
+                    # sl local_address rem_address st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode ref
+                    # pointer drops
+                    if len(fields) > 12 and fields[9] == inode:
+                        return int(fields[12])
+        except (IOError, ValueError):
+            pass
+    return None
+
+
+class SyslogBuffer(object):
+    """
+    Messages received between two reads, bounded by their total size in bytes
+
+    The deque grows with the traffic and is dropped as a whole when read, so memory is only taken during bursts and
+    never exceeds max_size (plus per-string overhead). When it's full the oldest messages are dropped and counted.
+    """
+
+    def __init__(self, max_size=DEFAULT_BUFFER_SIZE):
+        self.max_size = max_size
+        self.lines = deque()
+        self.size = 0  # bytes in lines
+        self.peak = 0  # max size reached
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.lines)
 
-    def __init__(self, cache, address, chunk_size=8192):
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __getitem__(self, index):
+        return self.lines[index]
+
+    def append(self, line):
+        """
+        :param line: str message
+        :return: int number of old messages dropped to fit it
+        """
+        self.lines.append(line)
+        self.size += len(line)
+
+        dropped = 0
+        while self.size > self.max_size:
+            self.size -= len(self.lines.popleft())
+            dropped += 1
+
+        self.dropped += dropped
+        if self.size > self.peak:
+            self.peak = self.size
+        return dropped
+
+    def extend(self, lines):
+        """
+        :param lines: iterable of str messages
+        :return: int number of old messages dropped to fit them
+        """
+        return sum(self.append(line) for line in lines)
+
+    def popleft(self):
+        line = self.lines.popleft()
+        self.size -= len(line)
+        return line
+
+    def clear(self):
+        self.lines.clear()
+        self.size = 0
+
+
+class SyslogServer(object):
+    """
+    Non-blocking datagram socket server that drains all pending datagrams at once and caches them
+
+    The address is either (host, port) of a UDP socket or a path of a unix datagram socket
+    (nginx "syslog:server=unix:/path"), which avoids the IP stack for local nginx.
+    The unix socket gets socket_mode permissions (0660 by default), so nginx workers can only send to it
+    if their user is in the group of the agent user (or socket_mode allows others to write).
+    """
+
+    def __init__(self, cache, address, chunk_size=DEFAULT_CHUNK_SIZE, rcvbuf=DEFAULT_RCVBUF,
+                 max_batch=DEFAULT_MAX_BATCH, socket_mode=DEFAULT_SOCKET_MODE):
         # Explicitly passed shared cache object
         self.cache = cache
 
         # Custom constants
         self.chunk_size = chunk_size
-
-        # Old-style class super
-        asyncore.dispatcher.__init__(self)
-
-        # asyncore server init
-        self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)  # asyncore socket wrapper
-        self.bind(address)  # bind afore wrapped socket to address
+        self.max_batch = max_batch
+
+        # counters
+        self.received = 0
+        self.overflows = 0  # messages pushed out of the full cache (see SyslogBuffer)
+        self.truncated = 0  # datagrams longer than chunk_size
+
+        self.path = address if isinstance(address, basestring) else None
+        self.socket = socket.socket(socket.AF_UNIX if self.path else socket.AF_INET, socket.SOCK_DGRAM)
+        if rcvbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.socket.setblocking(0)
+
+        if self.path:
+            self._remove_stale_socket()
+            self.socket.bind(self.path)
+            os.chmod(self.path, socket_mode)
+        else:
+            self.socket.bind(address)
         self.address = self.socket.getsockname()  # use socket api to retrieve address (address we actually bound to)
         SYSLOG_ADDRESSES.add(self.address)
-        context.log.debug('Syslog server binding to %s' % str(self.address))
+        context.log.debug('Syslog server binding to %s (SO_RCVBUF %s)' % (
+            str(self.address), self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        ))
 
-    def handle_read(self):
-        """Called when a read event happens on the socket"""
-        data = bytes.decode(self.recv(self.chunk_size).strip())
+    def _remove_stale_socket(self):
+        """Removes a socket file left by a previous run, anything else at the path is left alone"""
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.unlink(self.path)
+        except OSError:
+            pass
+
+    @property
+    def dropped(self):
+        """
+        Senders to a unix socket get EAGAIN instead of kernel drops, so only the cache overflows are counted for it
+
+        :return: int messages lost by the kernel (socket buffer overflows) or pushed out of the full cache
+        """
+        return (kernel_drops(self.socket) or 0) + self.overflows
+
+    def wait(self, timeout):
+        """
+        Waits until there are datagrams to read, letting other greenlets run
+
+        :param timeout: float seconds
+        :return: bool True if the socket is readable
+        """
+        readable, _, _ = select.select([self.socket], [], [], timeout)
+        return bool(readable)
+
+    def drain(self):
+        """
+        Reads pending datagrams without blocking, up to max_batch of them
+
+        :return: int number of datagrams read (max_batch if more could be pending)
+        """
+        count = 0
+        while count < self.max_batch:
+            try:
+                # one more byte to see if a datagram didn't fit
+                data = self.socket.recv(self.chunk_size + 1)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            count += 1
+            if len(data) > self.chunk_size:
+                self.truncated += 1
+                data = data[:self.chunk_size]
+            self.handle(data)
+
+        self.received += count
+        return count
+
+    def handle(self, data):
+        """Caches a single syslog message"""
+        data = bytes.decode(data.strip())
         try:
             log_record = data.split('amplify: ', 1)[1]  # this implicitly relies on the nginx syslog format specifically
-            self.cache.append(log_record)
+            self.overflows += self.cache.append(log_record)
         except Exception as e:
             context.log.error('error handling syslog message (address:%s, message:"%s")' % (self.address, data))
             context.log.debug('additional info:', exc_info=True)
 
     def close(self):
         context.log.debug('SyslogServer closing')
-        asyncore.dispatcher.close(self)
+        self.socket.close()
+        if self.path:
+            self._remove_stale_socket()
 
 
 class SyslogListener(AbstractManager):
-    """This is just a container to manage the SyslogServer listen/handle loop."""
+    """
+    This is just a container to manage the SyslogServer wait/drain loop.
+
+    If a statsd client is given, the listener reports its stats (see stats()) to it about once per statsd
+    interval, named by the listener address, so listeners of several logs don't overwrite each other.
+    """
     name = 'syslog_listener'
 
-    def __init__(self, cache, address, **kwargs):
+    def __init__(self, cache, address, rcvbuf=DEFAULT_RCVBUF, max_batch=DEFAULT_MAX_BATCH,
+                 socket_mode=DEFAULT_SOCKET_MODE, statsd=None, **kwargs):
         super(SyslogListener, self).__init__(**kwargs)
-        self.server = SyslogServer(cache, address)
+        self.server = SyslogServer(cache, address, rcvbuf=rcvbuf, max_batch=max_batch, socket_mode=socket_mode)
+        self.statsd = statsd
+        self.peak = 0  # max size of caches taken by readers since the last stats()
+        self.reported = dict(received=0, dropped=0, truncated=0)  # counters at the last stats()
+        self.reported_at = time.time()
 
     def start(self):
         current_thread().name = self.name
@@ -90,25 +268,75 @@ class SyslogListener(AbstractManager):
         self.running = True
 
         while self.running:
-            self._wait(0.1)
-            # This means that we don't increment every time a UDP message is handled, but rather every listen "period"
-            context.inc_action_id()
-            asyncore.loop(timeout=self.interval, count=10)
-            # count is arbitrary since timeout is unreliable at breaking asyncore.loop
+            try:
+                # interval only limits how long a stopped listener can wait, datagrams are read as soon as they come
+                if self.server.wait(self.interval):
+                    # This means that we don't increment every time a UDP message is handled, but rather every wakeup
+                    context.inc_action_id()
+
+                    # a flood is read in batches, so it doesn't starve other greenlets
+                    while self.server.drain() >= self.server.max_batch:
+                        gevent.sleep(0)
+
+                report_interval = self.statsd.interval or self.interval if self.statsd is not None else None
+                if report_interval and time.time() - self.reported_at >= report_interval:
+                    self.report()
+            except (select.error, socket.error, ValueError):
+                if not self.running:
+                    break  # the socket was closed by stop()
+                raise
+
+    def stats(self):
+        """
+        Counters of the listener since the last call
+
+        :return: {} of 'received', 'dropped', 'truncated' numbers of messages and 'buffer.peak' size in bytes
+        """
+        result = {'buffer.peak': max(self.peak, self.server.cache.peak)}
+        self.peak = 0
+
+        for name in self.reported:
+            value = getattr(self.server, name)
+            result[name] = max(value - self.reported[name], 0)
+            self.reported[name] = value
+        return result
+
+    def report(self):
+        """
+        Sends stats to statsd: numbers of messages as counters, the peak size as a gauge
+        """
+        address = self.server.address if self.server.path else '%s:%s' % self.server.address[:2]
+        for name, value in self.stats().iteritems():
+            metric_name = 'amplify.agent.syslog.%s||%s' % (name, address)
+            if name == 'buffer.peak':
+                self.statsd.agent(metric_name, value)
+            else:
+                self.statsd.incr(metric_name, value)
+        self.reported_at = time.time()
 
     def stop(self):
+        self.running = False
         self.server.close()
         context.teardown_thread_id()
         super(SyslogListener, self).stop()
 
 
 class SyslogTail(Pipeline):
-    """Generalized Pipeline wrapper to provide a developer API for interacting with UDP listener."""
-    def __init__(self, address, maxlen=10000, **kwargs):
+    """
+    Generalized Pipeline wrapper to provide a developer API for interacting with UDP or unix datagram listener.
+
+    The listener appends messages to the current cache. Readers take the whole cache at once and give the listener
+    a new empty one (greenlets don't switch in between, so no message is lost or seen twice) - nothing is copied.
+
+    The cache holds up to buffer_size bytes, so it should be about the peak rate times the collect interval.
+    The peak size of caches is reported by the listener with the number of received, dropped and truncated messages
+    (see SyslogListener.stats).
+    """
+    def __init__(self, address, buffer_size=DEFAULT_BUFFER_SIZE, **kwargs):
         super(SyslogTail, self).__init__(name='syslog:%s' % str(address))
         self.kwargs = kwargs  # only have to record this due to new listener fail-over logic
-        self.maxlen = maxlen
-        self.cache = deque(maxlen=self.maxlen)
+        self.buffer_size = buffer_size
+        self.cache = SyslogBuffer(max_size=self.buffer_size)
         self.address = address  # This stores the address that we were passed
         self.listener = None
         self.listener_setup_attempts = 0
@@ -129,6 +357,38 @@ class SyslogTail(Pipeline):
         self.running = True
 
     def __iter__(self):
+        return iter(self._take())
+
+    def read_chunks(self, batch_lines=DEFAULT_BATCH_LINES):
+        """
+        Returns received messages in chunks for the batch parser (see NginxAccessLogParser.parse_batch)
+
+        :param batch_lines: int max number of lines in a chunk
+        :return: generator of str chunks of lines joined with new lines
+        """
+        lines = self._take()
+        try:
+            while lines:
+                yield '\n'.join([lines.popleft() for _ in xrange(min(batch_lines, len(lines)))])
+        finally:
+            if lines:
+                # not consumed (e.g. the collect budget is over), left for the next read before newer messages
+                dropped = lines.extend(self.cache)
+                self._set_cache(lines)
+                if self.listener:
+                    self.listener.server.overflows += dropped
+
+    def _set_cache(self, cache):
+        self.cache = cache
+        if self.listener:
+            self.listener.server.cache = cache
+
+    def _take(self):
+        """
+        Swaps the cache with an empty one
+
+        :return: deque of received messages
+        """
         if not self.listener and self.listener_setup_attempts < 3:
             try:
                 self._setup_listener(**self.kwargs)
@@ -154,10 +414,22 @@ class SyslogTail(Pipeline):
                     )
                     context.log.debug('additional info:', exc_info=True)
 
-        current_cache = copy.deepcopy(self.cache)
+        current_cache = self.cache
+        self._set_cache(SyslogBuffer(max_size=self.buffer_size))
         context.log.debug('SyslogTail returned %s lines captured from %s' % (len(current_cache), self.name))
-        self.cache.clear()
-        return iter(current_cache)
+        if self.listener:
+            self.listener.peak = max(self.listener.peak, current_cache.peak)
+            server = self.listener.server
+            context.log.debug('%s received %s, dropped %s, truncated %s messages' % (
+                self.name, server.received, server.dropped, server.truncated
+            ))
+        return current_cache
+
+    def stats(self):
+        """
+        :return: {} of stats of the listener since the last call (see SyslogListener.stats), empty without listener
+        """
+        return self.listener.stats() if self.listener else {}
 
     def _setup_listener(self, **kwargs):
         if self.address in SYSLOG_ADDRESSES:
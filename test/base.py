@@ -7,6 +7,7 @@ import imp
 import pytest
 import random
 import shutil
+import weakref
 
 from unittest import TestCase
 
@@ -60,6 +61,10 @@ class BaseTestCase(TestCase):
 
         import amplify.agent.pipelines.file
         amplify.agent.pipelines.file.OFFSET_CACHE = {}
+        amplify.agent.pipelines.file.FILE_IDS = {}
+        amplify.agent.pipelines.file.CHECKPOINTS = {}
+        amplify.agent.pipelines.file.SHARED_TAILS = {}
+        amplify.agent.pipelines.file.TAILS = weakref.WeakValueDictionary()
 
     def teardown_method(self, method):
         pass
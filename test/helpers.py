@@ -33,3 +33,8 @@ class DummyRootObject(DummyObject):
 def collected_metric(matcher=None):
     matcher = anything() if matcher is None else wrap_matcher(matcher)
     return only_contains(contains(greater_than(1476820876), matcher))
+
+
+def collected_gauge(matcher=None):
+    matcher = anything() if matcher is None else wrap_matcher(matcher)
+    return has_properties(stamp=greater_than(1476820876), value=matcher)
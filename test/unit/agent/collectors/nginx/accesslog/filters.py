@@ -221,3 +221,60 @@ class LogsFiltersTestCase(NginxCollectorTestCase):
         # check our metric
         assert_that(counter['C|nginx.http.status.2xx'][0][1], equal_to(1))
         assert_that(counter['C|nginx.http.status.2xx||2'][0][1], equal_to(1))
+
+    def test_projection(self):
+        collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
+        parsed = collector.parser.parse(self.lines[0])
+        assert_that(parsed, has_key('status'))
+        assert_that(parsed, has_key('request_method'))
+        assert_that(parsed, not_(has_key('http_user_agent')))
+        assert_that(parsed, not_(has_key('http_referer')))
+
+    def test_projection_follows_filters(self):
+        collector = NginxAccessLogsCollector(object=self.fake_object, tail=self.lines)
+        assert_that(collector.parser.parse(self.lines[0]), not_(has_key('http_user_agent')))
+
+        self.fake_object.filters = [
+            Filter(filter_rule_id=1, metric='nginx.http.method.get', data=[['$http_user_agent', '~', '.*Chrome.*']])
+        ]
+        collector.collect()
+        assert_that(collector.parser.parse(self.lines[0]), has_key('http_user_agent'))
+
+        counter = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counter['C|nginx.http.method.get||1'][0][1], equal_to(3))
+
+    def test_filter_cache_metrics(self):
+        self.fake_object.filters = [
+            Filter(filter_rule_id=1, metric='nginx.http.method.get', data=[['$status', '~', '200']]),
+        ]
+        collector = NginxAccessLogsCollector(object=self.fake_object, tail=self.lines)
+        collector.collect()
+
+        gauge = self.fake_object.statsd.flush()['metrics']['gauge']
+        assert_that(gauge['G|amplify.agent.filters.cache.size'][0][1], equal_to(4))
+        assert_that(gauge['G|amplify.agent.filters.cache.hit_ratio'][0][1], equal_to(2.0 / 6))
+
+        # cache is reset with filters
+        self.fake_object.filters = []
+        collector.collect()
+        assert_that(collector.filter_matcher.cache, has_length(0))
+
+    def test_filter_cache_metrics_of_all_logs(self):
+        self.fake_object.filters = [
+            Filter(filter_rule_id=1, metric='nginx.http.method.get', data=[['$status', '~', '200']]),
+        ]
+        for lines in (self.lines * 2, self.lines[:3]):
+            collector = NginxAccessLogsCollector(object=self.fake_object, tail=list(lines))
+            self.fake_object.collectors.append(collector)
+            collector.collect()
+
+        # the object gauges are computed over both matchers
+        matchers = [collector.filter_matcher for collector in self.fake_object.collectors]
+        hits = sum(matcher.cache_hits for matcher in matchers)
+        lookups = hits + sum(matcher.cache_misses for matcher in matchers)
+        gauge = self.fake_object.statsd.flush()['metrics']['gauge']
+        assert_that(gauge['G|amplify.agent.filters.cache.size'][0][1], equal_to(
+            sum(len(matcher.cache) for matcher in matchers)
+        ))
+        assert_that(gauge['G|amplify.agent.filters.cache.hit_ratio'][0][1], equal_to(float(hits) / lookups))
+        assert_that(matchers[1].cache_hit_ratio, is_not(equal_to(float(hits) / lookups)))
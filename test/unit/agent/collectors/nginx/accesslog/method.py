@@ -116,7 +116,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # histogram
         histogram = metrics['timer']
         assert_that(histogram, has_item('nginx.upstream.response.time'))
-        assert_that(histogram['nginx.upstream.response.time'], equal_to([2.001 + 0.345]))
+        assert_that(histogram['nginx.upstream.response.time'], has_properties(count=1, max=2.001 + 0.345))
 
     def test_empty_upstreams(self):
         log_format = '$remote_addr - $remote_user [$time_local] ' + \
@@ -202,7 +202,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # histogram
         histogram = metrics['timer']
         assert_that(histogram, has_item('nginx.upstream.response.time'))
-        assert_that(histogram['nginx.upstream.response.time'], equal_to([2.001 + 0.345]))
+        assert_that(histogram['nginx.upstream.response.time'], has_properties(count=1, max=2.001 + 0.345))
 
     def test_upstream_status_and_length(self):
         log_format = '$remote_addr - $remote_user [$time_local] ' + \
@@ -238,12 +238,12 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # averages
         averages = metrics['average']
         assert_that(averages, has_item('nginx.upstream.response.length'))
-        assert_that(averages['nginx.upstream.response.length'][0], equal_to(20))
+        assert_that(averages['nginx.upstream.response.length'], has_properties(total=20, count=1))
 
         # histogram
         histogram = metrics['timer']
         assert_that(histogram, has_item('nginx.upstream.response.time'))
-        assert_that(histogram['nginx.upstream.response.time'], equal_to([2.001 + 0.345]))
+        assert_that(histogram['nginx.upstream.response.time'], has_properties(count=1, max=2.001 + 0.345))
 
     def test_upstream_status_and_length2(self):
         """
@@ -281,10 +281,30 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # averages
         averages = metrics['average']
         assert_that(averages, has_item('nginx.upstream.response.length'))
-        assert_that(averages['nginx.upstream.response.length'][0], equal_to(40))
+        assert_that(averages['nginx.upstream.response.length'], has_properties(total=40, count=1))
 
         # histogram
         histogram = metrics['timer']
         assert_that(histogram, has_item('nginx.upstream.response.time'))
-        assert_that(histogram['nginx.upstream.response.time'], equal_to([2.001 + 0.345]))
+        assert_that(histogram['nginx.upstream.response.time'], has_properties(count=1, max=2.001 + 0.345))
 
+
+    def test_metric_names_are_interned(self):
+        collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
+        for _ in xrange(3):
+            collector.http_method({'request_method': 'GET'})
+            collector.http_method({'request_method': 'PROPFIND'})
+            collector.http_status({'status': '499'})
+
+        registry = self.fake_object.statsd.registry
+        assert_that(collector.method_metrics.table, equal_to({
+            'GET': registry.key('nginx.http.method.get'), 'PROPFIND': registry.key('nginx.http.method.other')
+        }))
+        assert_that(collector.status_metrics.table, equal_to({
+            '499': (registry.key('nginx.http.status.4xx'), registry.key('nginx.http.status.discarded'))
+        }))
+
+        counter = self.fake_object.statsd.current['counter']
+        assert_that(counter['nginx.http.method.get'][0][1], equal_to(3))
+        assert_that(counter['nginx.http.method.other'][0][1], equal_to(3))
+        assert_that(counter['nginx.http.status.discarded'][0][1], equal_to(3))
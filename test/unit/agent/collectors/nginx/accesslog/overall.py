@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
+import os
+
 from hamcrest import *
 
+from amplify.agent.collectors.nginx import accesslog
 from amplify.agent.collectors.nginx.accesslog import NginxAccessLogsCollector
+from amplify.agent.objects.nginx.filters import Filter
+from amplify.agent.pipelines.file import FileTail
 from test.base import NginxCollectorTestCase
 
 __author__ = "Mike Belov"
@@ -12,8 +17,36 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
+def without_stamps(metrics):
+    """
+    Flushed metrics without timestamps and agent gauges, to compare results of different collects
+    """
+    return dict(
+        (metric_type, dict((name, [value for stamp, value in points]) for name, points in values.iteritems()))
+        for metric_type, values in metrics.iteritems() if metric_type != 'gauge'  # agent metrics
+    )
+
+
 class LogsOverallTestCase(NginxCollectorTestCase):
 
+    def setup_method(self, method):
+        super(LogsOverallTestCase, self).setup_method(method)
+        self.log_files = []
+
+    def teardown_method(self, method):
+        for log_file in self.log_files:
+            if os.path.exists(log_file):
+                os.remove(log_file)
+        super(LogsOverallTestCase, self).teardown_method(method)
+
+    def new_log_file(self, log_file):
+        """
+        Creates an empty log file, which is removed after the test
+        """
+        open(log_file, 'w').close()
+        self.log_files.append(log_file)
+        return log_file
+
     def test_combined(self):
         lines = [
             '178.23.225.78 - - [18/Jun/2015:17:22:25 +0000] "GET /img/docker.png HTTP/1.1" 304 0 ' +
@@ -346,3 +379,166 @@ class LogsOverallTestCase(NginxCollectorTestCase):
         assert_that(counter['C|nginx.upstream.request.count'][0][1], equal_to(3))
         assert_that(counter['C|nginx.cache.miss'][0][1], equal_to(1))
         assert_that(counter['C|nginx.cache.hit'][0][1], equal_to(1))
+
+    def test_file_tail_chunks(self):
+        log_file = self.new_log_file('log/access_chunks.log')
+
+        collector = NginxAccessLogsCollector(object=self.fake_object, tail=FileTail(log_file))
+        with open(log_file, 'a') as f:
+            for i in xrange(1000):
+                f.write('127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /%s HTTP/1.1" 200 10 "-" "curl"\n' % i)
+            f.write('garbage\n')
+        collector.collect()
+
+        counter = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counter['C|nginx.http.method.get'][0][1], equal_to(1000))
+        assert_that(counter['C|nginx.http.request.body_bytes_sent'][0][1], equal_to(10000))
+
+    def test_budget_carry_over(self):
+        log_file = self.new_log_file('log/access_budget.log')
+
+        collector = NginxAccessLogsCollector(object=self.fake_object, tail=FileTail(log_file, block_size=1024))
+        collector.budget.max_lines = 100
+        with open(log_file, 'a') as f:
+            for i in xrange(1000):
+                f.write('127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /%s HTTP/1.1" 200 10 "-" "curl"\n' % i)
+
+        # the first collect stops after the budget, the rest stays in the tail
+        collector.collect()
+        metrics = self.fake_object.statsd.flush()['metrics']
+        first = metrics['counter']['C|nginx.http.method.get'][0][1]
+        assert_that(first, all_of(greater_than_or_equal_to(100), less_than(1000)))
+        assert_that(metrics['gauge']['G|amplify.agent.nginx_alog.backlog'][0][1], greater_than(0))
+        assert_that(collector.budget.exhausted, equal_to(True))
+
+        collector.budget.max_lines = 0
+        collector.collect()
+        metrics = self.fake_object.statsd.flush()['metrics']
+        assert_that(metrics['counter']['C|nginx.http.method.get'][0][1], equal_to(1000 - first))
+        assert_that(metrics['gauge']['G|amplify.agent.nginx_alog.backlog'][0][1], equal_to(0))
+
+    def test_backlog_of_all_logs(self):
+        for name in ('log/access_backlog_1.log', 'log/access_backlog_2.log'):
+            log_file = self.new_log_file(name)
+            collector = NginxAccessLogsCollector(object=self.fake_object, tail=FileTail(log_file, block_size=256))
+            collector.budget.max_lines = 1
+            self.fake_object.collectors.append(collector)
+            with open(log_file, 'a') as f:
+                for i in xrange(10):
+                    f.write('127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /%s HTTP/1.1" 200 10 "-" "curl"\n' % i)
+
+        for collector in self.fake_object.collectors:
+            collector.collect()
+
+        # the object gauge is the total of its logs
+        backlogs = [collector.tail.unread_size() for collector in self.fake_object.collectors]
+        assert_that(backlogs, only_contains(greater_than(0)))
+        metrics = self.fake_object.statsd.flush()['metrics']
+        assert_that(metrics['gauge']['G|amplify.agent.nginx_alog.backlog'][0][1], equal_to(sum(backlogs)))
+
+    def test_batch_equals_per_line(self):
+        log_format = '$remote_addr - $remote_user [$time_local] ' + \
+                     '"$request" $status $body_bytes_sent "$http_referer" "$http_user_agent" ' + \
+                     'rt=$request_time ut="$upstream_response_time" cs=$upstream_cache_status'
+
+        lines = [
+            '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "GET /foo/ HTTP/1.1" 200 11078 ' +
+            '"http://www.rambler.ru/" "Mozilla/5.0 (Windows; U; Windows NT 5.1" rt=0.010 ut="2.001, 0.345" cs=MISS',
+
+            '1.2.3.4 - - [22/Jan/2010:20:34:21 +0300] "GET /foo/ HTTP/1.1" 300 1078 ' +
+            '"http://www.rambler.ru/" "Mozilla/5.0 (Windows; U; Windows NT 5.1" rt=0.020 ut="2.002" cs=HIT',
+
+            '1.2.3.4 - - [22/Jan/2010:20:34:22 +0300] "POST /bar/ HTTP/1.0" 502 0 ' +
+            '"-" "curl" rt=0.730 ut="0.700" cs=-',
+
+            'garbage',
+        ]
+
+        self.fake_object.filters = [
+            Filter(filter_rule_id=1, metric='nginx.http.request.time', data=[['$request_method', '~', 'GET']]),
+            Filter(filter_rule_id=2, metric='nginx.http.method.get', data=[['$status', '!~', '200']]),
+        ]
+
+        # batched collect
+        collector = NginxAccessLogsCollector(object=self.fake_object, log_format=log_format, tail=lines)
+        collector.collect()
+        batched = without_stamps(self.fake_object.statsd.flush()['metrics'])
+
+        # same lines sent to statsd one by one
+        collector.init_counters()
+        for line in lines:
+            parsed = collector.parser.parse(line)
+            if parsed:
+                collector.collect_parsed(parsed)
+        per_line = without_stamps(self.fake_object.statsd.flush()['metrics'])
+
+        assert_that(batched, equal_to(per_line))
+        assert_that(batched['counter']['C|nginx.http.method.get||2'], equal_to([1]))
+
+    def test_parse_workers(self):
+        log_file = self.new_log_file('log/access_workers.log')
+
+        self.fake_object.filters = [
+            Filter(filter_rule_id=1, metric='nginx.http.method.get', data=[['$request_uri', '~', '/1.*']]),
+        ]
+
+        collectors = []
+        for parse_workers in (0, 3):
+            collector = NginxAccessLogsCollector(object=self.fake_object, tail=FileTail(log_file))
+            collector.parse_workers = parse_workers
+            collector.parse_workers_min_size = 0
+            collectors.append(collector)
+
+        with open(log_file, 'a') as f:
+            for i in xrange(1000):
+                f.write(
+                    '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /%s HTTP/1.1" %s %s "-" "curl"\n' %
+                    (i, 200 + i % 4 * 100, i)
+                )
+            f.write('garbage\n')
+
+        results = []
+        for collector in collectors:
+            collector.collect()
+            results.append(without_stamps(self.fake_object.statsd.flush()['metrics']))
+
+        sequential, parallel = results
+        assert_that(parallel, equal_to(sequential))
+        assert_that(parallel['counter']['C|nginx.http.method.get'], equal_to([1000]))
+        assert_that(parallel['counter']['C|nginx.http.method.get||1'], equal_to([111]))
+
+    def test_parse_ranges_budget(self):
+        log_file = self.new_log_file('log/access_ranges_budget.log')
+
+        class BrokenPool(object):
+            def map(self, function, tasks):
+                raise OSError('no workers')
+
+        pool = accesslog.PARSE_POOL.get(3)
+        accesslog.PARSE_POOL[3] = BrokenPool()
+        try:
+            collector = NginxAccessLogsCollector(object=self.fake_object, tail=FileTail(log_file))
+            collector.parse_workers = 3
+            collector.parse_workers_min_size = 0
+            collector.budget.max_lines = 100
+            with open(log_file, 'a') as f:
+                for i in xrange(900):
+                    f.write('127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /%s HTTP/1.1" 200 10 "-" "curl"\n' % i)
+
+            # ranges are parsed in the collector until the budget is exhausted, the rest is read again
+            collector.collect()
+            metrics = self.fake_object.statsd.flush()['metrics']
+            first = metrics['counter']['C|nginx.http.method.get'][0][1]
+            assert_that(first, all_of(greater_than_or_equal_to(100), less_than(900)))
+            assert_that(metrics['gauge']['G|amplify.agent.nginx_alog.backlog'][0][1], greater_than(0))
+
+            collector.budget.max_lines = 0
+            collector.collect()
+            metrics = self.fake_object.statsd.flush()['metrics']
+            assert_that(metrics['counter']['C|nginx.http.method.get'][0][1], equal_to(900 - first))
+            assert_that(metrics['gauge']['G|amplify.agent.nginx_alog.backlog'][0][1], equal_to(0))
+        finally:
+            if pool is None:
+                del accesslog.PARSE_POOL[3]
+            else:
+                accesslog.PARSE_POOL[3] = pool
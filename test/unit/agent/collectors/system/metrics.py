@@ -7,7 +7,7 @@ from hamcrest import *
 from amplify.agent.collectors.system.metrics import SystemMetricsCollector
 from amplify.agent.managers.system import SystemManager
 from test.base import BaseTestCase, container_test
-from test.helpers import collected_metric
+from test.helpers import collected_metric, collected_gauge
 
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
@@ -98,14 +98,14 @@ class SystemMetricsCollectorTestCase(BaseTestCase):
             starts_with('system.io.wait_r|'),
             starts_with('system.io.wait_w|')
         ):
-            assert_that(metrics['gauge'], has_entry(gauge, collected_metric()))
+            assert_that(metrics['gauge'], has_entry(gauge, collected_gauge()))
 
     def test_agent_memory_info(self):
         collector = self.get_collector()
         metrics = collector.object.statsd.current
         assert_that(metrics, has_key('gauge'))
-        assert_that(metrics['gauge'], has_entries('amplify.agent.mem.rss', collected_metric(greater_than(0))))
-        assert_that(metrics['gauge'], has_entries('amplify.agent.mem.vms', collected_metric(greater_than(0))))
+        assert_that(metrics['gauge'], has_entries('amplify.agent.mem.rss', collected_gauge(greater_than(0))))
+        assert_that(metrics['gauge'], has_entries('amplify.agent.mem.vms', collected_gauge(greater_than(0))))
 
     def test_collect_only_alive_interfaces(self):
         collector = self.get_collector()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import time
+
+from hamcrest import *
+
+from amplify.agent.common.util.budget import WorkBudget
+from test.base import BaseTestCase
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class WorkBudgetTestCase(BaseTestCase):
+    def test_max_lines(self):
+        budget = WorkBudget(max_time=0, max_lines=2500)
+        assert_that(budget.spend(1000), equal_to(True))
+        assert_that(budget.spend(1000), equal_to(True))
+        assert_that(budget.spend(1000), equal_to(False))
+        assert_that(budget.exhausted, equal_to(True))
+
+        # a new collect has a new budget
+        budget.start()
+        assert_that(budget.exhausted, equal_to(False))
+        assert_that(budget.spend(1000), equal_to(True))
+
+    def test_max_time(self):
+        budget = WorkBudget(max_time=0.05, max_lines=0)
+        assert_that(budget.spend(1), equal_to(True))
+        time.sleep(0.06)
+        assert_that(budget.spend(1), equal_to(False))
+
+    def test_unlimited(self):
+        budget = WorkBudget(max_time=0, max_lines=0)
+        assert_that(budget.spend(10 ** 9), equal_to(True))
+
+    def test_yields_between_slices(self):
+        sleeps = []
+        budget = WorkBudget(max_time=0, max_lines=0, slice_time=0.01)
+
+        original_sleep = time.sleep
+        time.sleep = lambda seconds: sleeps.append(seconds)
+        try:
+            budget.spend(1)
+            assert_that(sleeps, empty())
+
+            budget.slice_started -= 0.02
+            budget.spend(1)
+            assert_that(sleeps, equal_to([0]))
+        finally:
+            time.sleep = original_sleep
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import os
+
+from hamcrest import *
+
+from amplify.agent.common.util import inotify
+from test.base import BaseTestCase
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class InotifyTestCase(BaseTestCase):
+    test_dir = 'log/inotify'
+
+    def setup_method(self, method):
+        super(InotifyTestCase, self).setup_method(method)
+        os.mkdir(self.test_dir)
+        self.inotify = inotify.Inotify()
+
+    def teardown_method(self, method):
+        self.inotify.close()
+        for filename in os.listdir(self.test_dir):
+            os.remove(os.path.join(self.test_dir, filename))
+        os.rmdir(self.test_dir)
+        super(InotifyTestCase, self).teardown_method(method)
+
+    def test_events(self):
+        filename = os.path.join(self.test_dir, 'access.log')
+        open(filename, 'w').close()
+
+        directory_wd = self.inotify.add_watch(self.test_dir, inotify.IN_CREATE | inotify.IN_MOVED_TO)
+        file_wd = self.inotify.add_watch(filename, inotify.IN_MODIFY | inotify.IN_MOVE_SELF)
+        assert_that(self.inotify.read_events(), empty())
+
+        with open(filename, 'a') as f:
+            f.write('line\n')
+        os.rename(filename, filename + '.1')
+        open(filename, 'w').close()
+
+        events = self.inotify.read_events()
+        assert_that(events, has_items(
+            (file_wd, inotify.IN_MODIFY, ''),
+            (file_wd, inotify.IN_MOVE_SELF, ''),
+            (directory_wd, inotify.IN_MOVED_TO, 'access.log.1'),
+            (directory_wd, inotify.IN_CREATE, 'access.log'),
+        ))
+        assert_that(self.inotify.read_events(), empty())
+
+    def test_missing_file(self):
+        assert_that(
+            calling(self.inotify.add_watch).with_args(os.path.join(self.test_dir, 'missing'), inotify.IN_MODIFY),
+            raises(OSError)
+        )
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from hamcrest import *
+
+from amplify.agent.common.util.intern import InternTable
+from test.base import BaseTestCase
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class InternTableTestCase(BaseTestCase):
+    def test_lookup(self):
+        calls = []
+
+        def convert(raw):
+            calls.append(raw)
+            return 'nginx.http.method.%s' % raw.lower()
+
+        table = InternTable(convert)
+        for _ in xrange(3):
+            assert_that(table['GET'], equal_to('nginx.http.method.get'))
+            assert_that(table['POST'], equal_to('nginx.http.method.post'))
+
+        assert_that(calls, equal_to(['GET', 'POST']))
+        assert_that(table['GET'], same_instance(table['GET']))
+
+    def test_max_size(self):
+        table = InternTable(lambda raw: raw.lower(), max_size=10)
+        for i in xrange(100):
+            assert_that(table['VALUE%s' % i], equal_to('value%s' % i))
+
+        assert_that(table, has_length(10))
+        assert_that(table.overflows, equal_to(90))
+        assert_that(table['VALUE0'], equal_to('value0'))
+        assert_that(table['VALUE99'], equal_to('value99'))
@@ -34,3 +34,9 @@ class NetTestCase(BaseTestCase):
         host, port = net.ipv4_address(address='*')
         assert_that(host, equal_to('*'))
         assert_that(port, equal_to('80'))
+
+    def test_unix_address(self):
+        assert_that(net.unix_address('unix:/var/run/amplify.sock'), equal_to('/var/run/amplify.sock'))
+        assert_that(net.unix_address('unix:'), equal_to(None))
+        assert_that(net.unix_address('127.0.0.1:514'), equal_to(None))
+        assert_that(net.unix_address(None), equal_to(None))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import os
+
+from hamcrest import *
+
+from amplify.agent.common.util.pool import ProcessPool, ProcessPoolError
+from test.base import BaseTestCase
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+def square(value):
+    return value * value, os.getpid()
+
+
+def fail(value):
+    raise ValueError(value)
+
+
+class ProcessPoolTestCase(BaseTestCase):
+    def setup_method(self, method):
+        super(ProcessPoolTestCase, self).setup_method(method)
+        self.pool = ProcessPool(2)
+
+    def teardown_method(self, method):
+        self.pool.stop()
+        super(ProcessPoolTestCase, self).teardown_method(method)
+
+    def test_map(self):
+        results = self.pool.map(square, range(10))
+        assert_that([value for value, pid in results], equal_to([i * i for i in xrange(10)]))
+        assert_that(os.getpid(), not_(is_in([pid for value, pid in results])))
+        assert_that(self.pool.workers, has_length(2))
+
+        # workers are reused
+        assert_that(self.pool.map(square, [3]), contains(contains(9, is_in([pid for value, pid in results]))))
+
+    def test_failed_task(self):
+        assert_that(calling(self.pool.map).with_args(fail, [1, 2]), raises(ProcessPoolError, 'ValueError'))
+        assert_that(self.pool.map(square, [2])[0][0], equal_to(4))
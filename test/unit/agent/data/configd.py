@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from hamcrest import *
+
+from test.base import NginxCollectorTestCase
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class ConfigdClientTestCase(NginxCollectorTestCase):
+    def test_configd_flush(self):
+        configd = self.fake_object.configd
+        configd.config(payload={'root': '/etc/nginx/nginx.conf'}, checksum='123')
+
+        delivery = configd.flush()
+        assert_that(delivery['config'], equal_to({'data': {'root': '/etc/nginx/nginx.conf'}, 'checksum': '123'}))
+        assert_that(configd.current, empty())
+        assert_that(configd.flush(), equal_to({'object': self.fake_object.definition}))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from hamcrest import *
+
+from test.base import NginxCollectorTestCase
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class EventdClientTestCase(NginxCollectorTestCase):
+    def test_eventd_flush(self):
+        eventd = self.fake_object.eventd
+        eventd.event(message='test')
+        eventd.event(message='test')
+        stored = eventd.current
+
+        delivery = eventd.flush()
+        assert_that(delivery['events'], contains(has_entries(message='test', counter=2)))
+        assert_that(eventd.current, empty())
+        assert_that(eventd.current, is_not(same_instance(stored)))
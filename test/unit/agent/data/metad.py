@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from hamcrest import *
+
+from amplify.agent.common.context import context
+from test.base import NginxCollectorTestCase
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class MetadClientTestCase(NginxCollectorTestCase):
+    def test_metad_flush(self):
+        meta = {'type': 'nginx', 'path': {'bin': '/usr/sbin/nginx'}}
+        self.fake_object.metad.meta(meta)
+
+        delivery = self.fake_object.metad.flush()
+        assert_that(delivery, equal_to({'type': 'nginx', 'path': {'bin': '/usr/sbin/nginx'}, 'agent': context.version}))
+        assert_that(meta, not_(has_key('agent')))  # collector's meta is not changed
+        assert_that(self.fake_object.metad.current, empty())
+        assert_that(self.fake_object.metad.flush(), none())
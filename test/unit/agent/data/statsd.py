@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import copy
+import gc
+import pickle
+import random
+
+from hamcrest import *
+
+from amplify.agent.data.statsd import StatsdClient, StatsdBatch, MetricRegistry, AverageSlot
+from amplify.agent.data.timer import SketchTimer, ExactTimer
+from test.base import NginxCollectorTestCase
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class StatsdClientTestCase(NginxCollectorTestCase):
+    def test_timer(self):
+        statsd = self.fake_object.statsd
+        values = [round(random.uniform(0.001, 3.0), 3) for _ in xrange(1001)]
+        for value in values:
+            statsd.timer('nginx.http.request.time', value)
+
+        timers = statsd.flush()['metrics']['timer']
+
+        # values the timer has always reported, computed from all samples
+        values.sort()
+        length = len(values)
+        exact = {
+            'C|nginx.http.request.time.count': length,
+            'G|nginx.http.request.time': sum(values) / float(length),
+            'G|nginx.http.request.time.max': values[-1],
+            'G|nginx.http.request.time.median': values[int(round(length / 2 - 1))],
+            'G|nginx.http.request.time.pctl95': values[-int(round(length * .05))],
+        }
+        assert_that(timers, has_length(len(exact)))
+        for metric_name, value in exact.iteritems():
+            assert_that(timers[metric_name][0][1], close_to(value, value * statsd.timer_accuracy))
+
+        assert_that(timers['C|nginx.http.request.time.count'][0][1], equal_to(length))
+        assert_that(timers['G|nginx.http.request.time.max'][0][1], equal_to(values[-1]))
+
+    def test_timer_single_value(self):
+        statsd = self.fake_object.statsd
+        statsd.timer('nginx.http.request.time', 0.5)
+
+        timers = statsd.flush()['metrics']['timer']
+        for suffix in ('', '.max', '.median', '.pctl95'):
+            assert_that(timers['G|nginx.http.request.time%s' % suffix][0][1], equal_to(0.5))
+
+    def test_timer_exact(self):
+        statsd = self.fake_object.statsd
+        statsd.timer_mode = 'exact'
+        values = [round(random.uniform(0.001, 3.0), 3) for _ in xrange(1001)]
+        for value in values:
+            statsd.timer('nginx.http.request.time', value)
+
+        assert_that(statsd.current['timer']['nginx.http.request.time'], has_length(1001))
+
+        timers = statsd.flush()['metrics']['timer']
+        values.sort()
+        assert_that(timers['G|nginx.http.request.time.median'][0][1], equal_to(values[499]))
+        assert_that(timers['G|nginx.http.request.time.pctl95'][0][1], equal_to(values[-50]))
+        assert_that(timers['G|nginx.http.request.time.max'][0][1], equal_to(values[-1]))
+
+    def test_gauge(self):
+        statsd = self.fake_object.statsd
+        for stamp, value in ((10, 1), (11, 2.5), (12, 4)):
+            statsd.gauge('nginx.http.conn.active', value, stamp=stamp)
+            statsd.gauge('nginx.http.conn.delta', value, delta=True, stamp=stamp)
+        statsd.latest('nginx.http.conn.latest', 3, stamp=20)
+        statsd.latest('nginx.http.conn.latest', 5, stamp=19)
+        statsd.agent('amplify.agent.status', 1, stamp=30)
+
+        slot = statsd.current['gauge']['nginx.http.conn.delta']
+        assert_that(slot, has_properties(stamp=12, value=7.5, total=12.0, count=3))
+
+        gauges = statsd.flush()['metrics']['gauge']
+        assert_that(gauges, equal_to({
+            'G|nginx.http.conn.active': [(12, (1 + 2.5 + 4) / 3.0)],
+            'G|nginx.http.conn.delta': [(12, (1 + 3.5 + 7.5) / 3.0)],
+            'G|nginx.http.conn.latest': [(20, 3.0)],
+            'G|amplify.agent.status': [(30, 1.0)],
+        }))
+
+    def test_average(self):
+        statsd = self.fake_object.statsd
+        values = [random.random() for _ in xrange(1000)]
+        for value in values:
+            statsd.average('nginx.http.request.length', value)
+
+        assert_that(statsd.current['average']['nginx.http.request.length'], has_properties(count=1000))
+
+        averages = statsd.flush()['metrics']['average']
+        assert_that(averages['G|nginx.http.request.length'][0][1], equal_to(sum(values) / float(len(values))))
+        assert_that(statsd.current, has_length(0))
+
+    def test_flush_swaps(self):
+        """
+        Flush hands off the current buffer: compare it with the deep copy the flush used to make
+        """
+        def fill(statsd):
+            for i in xrange(2000):
+                statsd.incr('nginx.http.status.%s' % i, stamp=1)
+                statsd.gauge('nginx.http.conn.%s' % i, i, stamp=1)
+                statsd.average('nginx.http.request.%s' % i, i)
+                for value in xrange(10):
+                    statsd.timer('nginx.upstream.response.time.%s' % i, value * 0.1)
+
+        def measure(flush):
+            gc.collect()
+            gc.disable()
+            try:
+                objects = len(gc.get_objects())
+                result = flush()
+                allocated = len(gc.get_objects()) - objects
+            finally:
+                gc.enable()
+            return result, allocated
+
+        statsd = self.fake_object.statsd
+        fill(statsd)
+        copied_statsd = StatsdClient(object=self.fake_object)
+        fill(copied_statsd)
+
+        def copy_and_flush():
+            # the copy of current values is alive until the end of the flush
+            delivery = copy.deepcopy(copied_statsd.current)
+            return delivery, copy.deepcopy(copied_statsd.flush())
+
+        (_, copied), copy_allocated = measure(copy_and_flush)
+        buffer = statsd.current
+        swapped, swap_allocated = measure(statsd.flush)
+
+        def values(metrics):
+            # flush timestamps of timers and averages may differ
+            return dict((name, points[0][1]) for bucket in metrics.itervalues() for name, points in bucket.iteritems())
+
+        assert_that(values(swapped['metrics']), equal_to(values(copied['metrics'])))
+        assert_that(statsd.current, is_not(same_instance(buffer)))
+        assert_that(statsd.current, empty())
+        assert_that(swap_allocated, less_than(copy_allocated))
+
+        # the buffer itself is handed off, not a copy of it
+        statsd.incr('nginx.http.status.1', stamp=1)
+        buffer = statsd.current
+        assert_that(statsd.swap({}), same_instance(buffer))
+
+
+class MetricRegistryTestCase(NginxCollectorTestCase):
+    def test_key(self):
+        registry = MetricRegistry(max_size=3)
+        assert_that(registry.key('nginx.http.method.get'), equal_to(0))
+        assert_that(registry.key('nginx.http.method.post'), equal_to(1))
+        assert_that(registry.key('nginx.http.method.get'), equal_to(0))
+        assert_that(registry.key('nginx.http.request.time'), equal_to(2))
+
+        # full registry uses names as keys
+        assert_that(registry.key('nginx.http.method.put'), equal_to('nginx.http.method.put'))
+        assert_that(registry, has_length(3))
+        assert_that(registry.name(1), equal_to('nginx.http.method.post'))
+        assert_that(registry.name('nginx.http.method.put'), equal_to('nginx.http.method.put'))
+
+    def test_wire_names(self):
+        registry = MetricRegistry(max_size=1)
+        assert_that(registry.counter_name('nginx.http.method.get'), equal_to('C|nginx.http.method.get'))
+        assert_that(registry.gauge_name('nginx.http.method.get'), equal_to('G|nginx.http.method.get'))
+        assert_that(registry.counter_name('nginx.http.method.get'), same_instance(registry.counter_names[0]))
+        assert_that(registry.timer_name('nginx.http.request.time'), equal_to((
+            'G|nginx.http.request.time',
+            'C|nginx.http.request.time.count',
+            'G|nginx.http.request.time.max',
+            'G|nginx.http.request.time.median',
+            'G|nginx.http.request.time.pctl95',
+        )))
+
+    def test_batch_update(self):
+        statsd = self.fake_object.statsd
+        batch = StatsdBatch(statsd.registry)
+        batch.incr(statsd.registry.key('nginx.http.method.get'))
+        batch.timer(statsd.registry.key('nginx.http.request.time'), 0.5)
+
+        # e.g. from a pool worker
+        other = StatsdBatch()
+        other.incr(other.registry.key('nginx.http.method.post'), 2)
+        other.incr(other.registry.key('nginx.http.method.get'), 3)
+        other.average(other.registry.key('nginx.http.request.length'), 10)
+
+        batch.update(other)
+        statsd.merge(batch)
+        statsd.incr(statsd.registry.key('nginx.http.method.get'))
+
+        counters = statsd.current['counter']
+        assert_that(counters['nginx.http.method.get'][0][1], equal_to(5))
+        assert_that(counters['nginx.http.method.post'][0][1], equal_to(2))
+        assert_that(statsd.current['average']['nginx.http.request.length'], has_properties(total=10, count=1))
+        assert_that(statsd.current['timer']['nginx.http.request.time'], has_properties(count=1, max=0.5))
+
+        metrics = statsd.flush()['metrics']
+        assert_that(metrics['counter']['C|nginx.http.method.get'], contains(contains(anything(), 5)))
+        assert_that(metrics['timer'], has_key('G|nginx.http.request.time.pctl95'))
+
+    def test_batch_aggregates(self):
+        statsd = self.fake_object.statsd
+        batch = StatsdBatch(statsd.registry, statsd.new_timer)
+        for i in xrange(1000):
+            batch.average('nginx.http.request.length', i)
+            batch.timer('nginx.http.request.time', i / 1000.0)
+
+        # running aggregates instead of lists of values
+        assert_that(batch.averages['nginx.http.request.length'], all_of(
+            instance_of(AverageSlot), has_properties(total=499500, count=1000)
+        ))
+        timer = batch.timers['nginx.http.request.time']
+        assert_that(timer, instance_of(SketchTimer))
+        assert_that(len(timer.bins), less_than(1000))
+
+        # e.g. from a pool worker
+        other = pickle.loads(pickle.dumps(batch, pickle.HIGHEST_PROTOCOL))
+        batch.update(other)
+        statsd.merge(batch)
+        assert_that(statsd.current['average']['nginx.http.request.length'], has_properties(count=2000))
+        assert_that(statsd.current['timer']['nginx.http.request.time'], has_properties(count=2000, max=0.999))
+
+    def test_batch_exact_timers(self):
+        statsd = self.fake_object.statsd
+        statsd.timer_mode = 'exact'
+        batch = StatsdBatch(statsd.registry, statsd.new_timer)
+        batch.timer('nginx.http.request.time', 0.5)
+        batch.timer('nginx.http.request.time', 0.25)
+        assert_that(batch.timers['nginx.http.request.time'], instance_of(ExactTimer))
+
+        statsd.merge(batch)
+        timers = statsd.flush()['metrics']['timer']
+        assert_that(timers['G|nginx.http.request.time.max'][0][1], equal_to(0.5))
+        assert_that(timers['C|nginx.http.request.time.count'][0][1], equal_to(2))
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+from hamcrest import *
+
+from amplify.agent.data import timer
+from amplify.agent.data.timer import SketchTimer, ExactTimer, timer_ranks
+from test.base import BaseTestCase
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class TimerRanksTestCase(BaseTestCase):
+    def test_same_as_list_indexing(self):
+        for length in xrange(1, 500):
+            values = range(length)
+            median, pctl95 = timer_ranks(length)
+            assert_that(median, equal_to(values[int(round(length / 2 - 1))]))
+            assert_that(pctl95, equal_to(values[-int(round(length * .05))]))
+
+
+class SketchTimerTestCase(BaseTestCase):
+    def samples(self, length, seed=1):
+        rnd = random.Random(seed)
+        return [round(rnd.lognormvariate(-3, 1.5), 3) for _ in xrange(length)]
+
+    def assert_accuracy(self, sketch, values):
+        values = sorted(values)
+        for rank in xrange(len(values)):
+            exact = values[rank]
+            error = abs(sketch.value_at(rank) - exact)
+            assert_that(error, less_than_or_equal_to(sketch.accuracy * abs(exact) * (1 + 1e-9)))
+
+    def test_accuracy(self):
+        for accuracy in (0.01, 0.05):
+            values = self.samples(2000) + [0.0, 0.0, -0.5]
+            sketch = SketchTimer(accuracy=accuracy)
+            sketch.extend(values)
+
+            assert_that(len(sketch), equal_to(len(values)))
+            assert_that(sketch.total, equal_to(sum(values)))
+            assert_that(sketch.max, equal_to(max(values)))
+            assert_that(sketch.min, equal_to(-0.5))
+            self.assert_accuracy(sketch, values)
+
+    def test_fixed_size(self):
+        sketch = SketchTimer(max_bins=256)
+        values = self.samples(10000)
+        sketch.extend(values)
+
+        assert_that(len(sketch.bins), equal_to(256))
+        assert_that(len(sketch), equal_to(10000))
+
+        # collapsing affects only the lowest values
+        values.sort()
+        assert_that(sketch.value_at(9500), close_to(values[9500], values[9500] * sketch.accuracy))
+
+    def test_merge(self):
+        first, second = self.samples(1000, seed=1), self.samples(1000, seed=2)
+        merged, sketch = SketchTimer(), SketchTimer()
+        merged.extend(first)
+        sketch.extend(second)
+        merged.merge(sketch)
+
+        assert_that(len(merged), equal_to(2000))
+        assert_that(merged.max, equal_to(max(first + second)))
+        self.assert_accuracy(merged, first + second)
+
+        assert_that(calling(merged.merge).with_args(SketchTimer(accuracy=0.05)), raises(ValueError))
+
+
+class ExactTimerTestCase(BaseTestCase):
+    def list_timer(self, values):
+        """
+        Timer values the way StatsdClient computed them from sorted lists
+        """
+        length = len(values)
+        ordered = sorted(values)
+        return {
+            'mean': sum(ordered) / float(length),
+            'count': length,
+            'max': ordered[-1],
+            'median': ordered[int(round(length / 2 - 1))],
+            'pctl95': ordered[-int(round(length * .05))],
+        }
+
+    def exact_timer(self, values):
+        exact = ExactTimer()
+        exact.extend(values[:len(values) / 2])
+        for value in values[len(values) / 2:]:
+            exact.add(value)
+
+        length = len(exact)
+        median_rank, pctl95_rank = timer_ranks(length)
+        return {
+            'mean': exact.total / float(length),
+            'count': length,
+            'max': exact.max,
+            'median': exact.value_at(median_rank),
+            'pctl95': exact.value_at(pctl95_rank),
+        }
+
+    def assert_same_as_lists(self):
+        rnd = random.Random(1)
+        for _ in xrange(300):
+            length = rnd.choice((1, 2, 3, 19, 20, 21, rnd.randint(1, 3000)))
+            distribution = rnd.choice((
+                lambda: rnd.random(),
+                lambda: round(rnd.lognormvariate(-3, 1.5), 3),
+                lambda: rnd.choice((0.001, 0.002, 0.5)),  # a lot of duplicates
+                lambda: rnd.uniform(-1, 1),
+            ))
+            values = [distribution() for _ in xrange(length)]
+
+            exact, expected = self.exact_timer(values), self.list_timer(values)
+            for key in expected:
+                # compare representations to check bit-for-bit equality
+                assert_that(repr(exact[key]), equal_to(repr(expected[key])), key)
+
+    @pytest.mark.skipif(timer.numpy is None, reason='numpy is not installed')
+    def test_same_as_lists(self):
+        self.assert_same_as_lists()
+
+    def test_same_as_lists_without_numpy(self):
+        numpy, timer.numpy = timer.numpy, None
+        try:
+            self.assert_same_as_lists()
+        finally:
+            timer.numpy = numpy
+
+    def test_sorted_once(self):
+        exact = ExactTimer()
+        exact.extend([0.3, 0.1, 0.2])
+        assert_that(exact.value_at(0), equal_to(0.1))
+        ordered = exact.ordered
+        assert_that(exact.total, equal_to(0.1 + 0.2 + 0.3))
+        assert_that(exact.ordered, same_instance(ordered))
+
+        exact.add(0.0)
+        assert_that(exact.value_at(0), equal_to(0.0))
+
+    def test_merge(self):
+        first, second = ExactTimer(), ExactTimer()
+        first.extend([0.3, 0.1])
+        second.extend([0.2])
+        first.merge(second)
+        assert_that(first, has_properties(count=3, max=0.3, min=0.1))
+        assert_that(first.value_at(1), equal_to(0.2))
+
@@ -3,7 +3,7 @@ import re
 
 from hamcrest import *
 
-from amplify.agent.objects.nginx.filters import Filter
+from amplify.agent.objects.nginx.filters import Filter, FilterMatcher
 from test.base import BaseTestCase
 
 __author__ = "Mike Belov"
@@ -58,3 +58,100 @@ class FiltersTestCase(BaseTestCase):
             data=[]
         )
         assert_that(filtr.empty, equal_to(True))
+
+
+class FilterMatcherTestCase(BaseTestCase):
+    filters = [
+        Filter(filter_rule_id=1, metric='m', data=[['$status', '~', '200']]),
+        Filter(filter_rule_id=2, metric='m', data=[['$status', '!~', '200']]),
+        Filter(filter_rule_id=3, metric='m', data=[['$status', '~', '200'], ['$request_method', '~', 'get']]),
+        Filter(filter_rule_id=4, metric='m', data=[['$request_uri', '~', '/img*']]),
+        Filter(filter_rule_id=5, metric='m', data=[['$request_uri', '~', '.*\.gif']]),
+        Filter(filter_rule_id=6, metric='m', data=[['$request_uri', '~', '/(api|img)/']]),
+        Filter(filter_rule_id=7, metric='m', data=[['$request_uri', '!~', '.*\.png']]),
+        Filter(filter_rule_id=8, metric='m', data=[['$request_uri', '~', '*.gif']]),  # not a regex
+        Filter(filter_rule_id=9, metric='m', data=[['$request_uri', '~', '(?i)/IMG']]),
+        Filter(filter_rule_id=10, metric='m', data=[['$request_uri', '~', '/(i)m\\1']]),
+        Filter(filter_rule_id=11, metric='m', data=[['$http_user_agent', '!~', 'curl']]),
+        Filter(filter_rule_id=12, metric='m', data=[['$body_bytes_sent', '~', '10']]),
+        Filter(filter_rule_id=13, metric='m', data=[['$upstream_cache_status', '~', '']]),
+    ]
+
+    lines = [
+        {'status': '200', 'request_method': 'GET', 'request_uri': '/img/1.gif', 'body_bytes_sent': 10},
+        {'status': '2001', 'request_method': 'POST', 'request_uri': '/api/1.png', 'body_bytes_sent': 101},
+        {'status': '404', 'request_method': 'GET', 'request_uri': '*.gif', 'http_user_agent': 'curl'},
+        {'status': '304', 'request_method': 'GET', 'request_uri': '/imi', 'upstream_cache_status': 'HIT'},
+        {'status': '500', 'request_method': 'HEAD', 'request_uri': '/IMG/1.gif', 'http_user_agent': 'Mozilla'},
+        {'request_method': 'GET'},
+    ]
+
+    def test_same_as_filters(self):
+        matcher = FilterMatcher(self.filters)
+        for parsed in self.lines:
+            expected = [log_filter for log_filter in self.filters if log_filter.match(parsed)]
+            assert_that(matcher.match(parsed), equal_to(expected))
+
+    def test_shared_conditions(self):
+        matcher = FilterMatcher(self.filters)
+        assert_that(len(matcher.conditions), equal_to(12))
+        assert_that(matcher.exact['request_uri'], has_key('*.gif'))
+        assert_that(matcher.prefixes['status'], equal_to([(3, {'200': [0]})]))
+
+    def test_many_regexes(self):
+        filters = [
+            Filter(filter_rule_id=i, metric='m', data=[['$request_uri', '~', '/%s/.*' % (i % 150)]])
+            for i in xrange(300)
+        ]
+        matcher = FilterMatcher(filters)
+        assert_that(len(matcher.regexes['request_uri']), equal_to(2))
+
+        for uri in ('/0/a', '/42/b', '/149/c', '/150/d', '/1'):
+            parsed = {'request_uri': uri}
+            expected = [log_filter for log_filter in filters if log_filter.match(parsed)]
+            assert_that(matcher.match(parsed), equal_to(expected))
+
+    def test_regexes_with_groups(self):
+        # 3 capture groups + a marker group per pattern: 24 of them fit into a combined regex
+        filters = [
+            Filter(filter_rule_id=i, metric='m', data=[['$request_uri', '~', '/(%s)/(a|b)(.*)' % i]])
+            for i in xrange(60)
+        ]
+        matcher = FilterMatcher(filters)
+        assert_that(len(matcher.regexes['request_uri']), equal_to(3))
+        for regex, group in matcher.regexes['request_uri']:
+            assert_that(regex.groups, less_than(100))
+
+        for uri in ('/0/a', '/42/bc', '/59/a/', '/60/a', '/1/c'):
+            parsed = {'request_uri': uri}
+            expected = [log_filter for log_filter in filters if log_filter.match(parsed)]
+            assert_that(matcher.match(parsed), equal_to(expected))
+
+    def test_cache(self):
+        matcher = FilterMatcher(self.filters, cache_size=3)
+        for parsed in self.lines + self.lines:
+            expected = [log_filter for log_filter in self.filters if log_filter.match(parsed)]
+            assert_that(matcher.match(parsed), equal_to(expected))
+
+        assert_that(len(matcher.cache), equal_to(3))
+        assert_that(matcher.cache_misses, equal_to(12))  # lines don't fit, LRU evicts them before the next hit
+
+        matcher.match(self.lines[-1])
+        assert_that(matcher.cache_hits, equal_to(1))
+        assert_that(matcher.cache_hit_ratio, equal_to(1.0 / 13))
+
+    def test_cache_switches_off(self):
+        filters = [Filter(filter_rule_id=1, metric='m', data=[['$request_uri', '~', '/img/.*']])]
+        matcher = FilterMatcher(filters, cache_size=100)
+        for i in xrange(matcher.cache_min_lookups):
+            matcher.match({'request_uri': '/img/%s' % i})
+        assert_that(matcher.cache, equal_to(None))
+        assert_that(matcher.match({'request_uri': '/img/1'}), equal_to(filters))
+
+    def test_cache_low_cardinality(self):
+        filters = [Filter(filter_rule_id=1, metric='m', data=[['$status', '~', '2..']])]
+        matcher = FilterMatcher(filters, cache_size=100)
+        for i in xrange(matcher.cache_min_lookups * 2):
+            assert_that(matcher.match({'status': str(200 + i % 5 * 100)}), has_length(int(i % 5 == 0)))
+        assert_that(matcher.cache, has_length(5))
+        assert_that(matcher.cache_hits, equal_to(matcher.cache_min_lookups * 2 - 5))
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
+import sys
+
 from hamcrest import *
 
-from amplify.agent.objects.nginx.log.access import NginxAccessLogParser
+from amplify.agent.objects.nginx.log.access import NginxAccessLogParser, AccessLogRecord
 from test.base import BaseTestCase, disabled_test
 
 __author__ = "Mike Belov"
@@ -375,3 +377,285 @@ class LogParserTestCase(BaseTestCase):
 
 
 
+
+class CompiledParserTestCase(BaseTestCase):
+    """
+    Differential tests of the compiled decoder against the original key-by-key parser
+    """
+    fixtures = [
+        (
+            None,
+            '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /basic_status HTTP/1.1" 200 110 "-" ' +
+            '"python-requests/2.2.1 CPython/2.7.6 Linux/3.13.0-48-generic"'
+        ),
+        (
+            '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" ' +
+            '"$http_user_agent" "$http_x_forwarded_for" "$host" "$request_time" $gzip_ratio',
+            '141.101.234.201 - - [03/Jul/2015:10:52:33 +0300] "POST /wp-login.php HTTP/1.1" 200 3809 ' +
+            '"http://estevmeste.ru/wp-login.php" "Mozilla/5.0 (Windows NT 6.0; rv:34.0) Gecko/20100101 Firefox/34.0" ' +
+            '"-" "estevmeste.ru" "0.001" -'
+        ),
+        (
+            '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" ' +
+            '"$http_user_agent" "$http_x_forwarded_for" "$host" "$request_time" $gzip_ratio',
+            '141.101.234.201 - - [03/Jul/2015:10:52:33 +0300] "POST /wp-login.php HTTP/1.1" 200 3809 ' +
+            '"http://estevmeste.ru/wp-login.php" "Mozilla/5.0 (Windows NT 6.0; rv:34.0) Gecko/20100101 Firefox/34.0" ' +
+            '"-" "estevmeste.ru" "1299760000.321" -'
+        ),
+        (
+            '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" ' +
+            '"$http_user_agent" "$http_x_forwarded_for" "$upstream_addr" "$upstream_cache_status" ' +
+            '$connection/$connection_requests',
+            '217.15.195.202 - - [03/Jul/2015:11:12:53 +0300] "GET /gsat/9854/5231/14 HTTP/1.1" 200 11901 "-" ' +
+            '"tile-fetcher/0.1" "-" "173.194.32.133:80" "MISS" 62277/22'
+        ),
+        (
+            '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" ' +
+            '"$http_user_agent" "$http_x_forwarded_for" rt="$request_time" ua="$upstream_addr" ' +
+            'us="$upstream_status" ut="$upstream_response_time" "$gzip_ratio"',
+            '127.0.0.1 - - [03/Jul/2015:14:09:38 +0000] "GET /basic_status HTTP/1.1" 200 100 "-" "curl/7.35.0" "-" ' +
+            'rt="0.000" ua="-" us="-" ut="-" "-"'
+        ),
+        (
+            '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" ' +
+            '"$http_user_agent" rt=$request_time ut="$upstream_response_time" cs=$upstream_cache_status ' +
+            'us=$upstream_status $upstream_response_length',
+            '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "GET /foo/ HTTP/1.1" 200 11078 "http://www.rambler.ru/" ' +
+            '"Mozilla/5.0 (Windows; U; Windows NT 5.1" rt=0.010 ut="2.001, 0.345" cs=MISS us=200, 502 20'
+        ),
+        (
+            '$remote_addr - [$time_local] $request_method $scheme "$request_uri"  $status $request_time ' +
+            '$body_bytes_sent  "$http_referer" "$http_user_agent" $host',
+            '85.25.210.234 - [17/Nov/2015:00:20:50 +0100] GET https "/robots.txt"  200 0.024 240  "-" ' +
+            '"Mozilla/5.0 (compatible; worldwebheritage.org/1.1; +crawl@worldwebheritage.org)" www.nakupni-dum-praha.cz'
+        ),
+        (
+            '"$time_local"\t"$remote_addr"\t"$http_host"\t"$request"\t"$status"\t"$body_bytes_sent\t' +
+            '"$http_referer"\t"$http_user_agent"\t"$http_x_forwarded_for"',
+            '"27/Jan/2016:12:30:04 -0800"\t"173.186.135.227"\t"leete.ru"\t' +
+            '"GET /img/_data/combined/j6vnc0.css HTTP/2.0"\t"200"\t"5909\t"https://leete.ru/img/"' +
+            '\t"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_3) AppleWebKit/537.36 (KHTML, like Gecko) ' +
+            'Chrome/47.0.2526.111 Safari/537.36"\t"-"'
+        ),
+        (
+            '{"time_local": "$time_local","browser": [{"modern_browser": "$modern_browser",' +
+            '"ancient_browser": "$ancient_browser","msie": "$msie"}],"core": [{"args": "$args","uri": "$uri"}]}',
+            '{"time_local": "27/Jan/2016:12:30:04 -0800","browser": [{"modern_browser": "-","ancient_browser": "1",' +
+            '"msie": "-"}],"core": [{"args": "-","uri": "/status"}]}'
+        ),
+        (
+            '"$upstream_addr" $upstream_status',
+            '"173.194.32.133:80, 173.194.32.133:81, 173.194.32.133:82" 200, 200, 200'
+        ),
+        (
+            '$remote_addr "$request" $status $remote_addr',
+            '10.0.0.1 "GET / HTTP/1.1" 200 10.0.0.1'
+        ),
+        (
+            '$remote_addr "$request" $status',
+            '10.0.0.1 "/xxx?q=1 GET POST" 400'
+        ),
+        (
+            '$remote_addr "$request" $status',
+            '10.0.0.1 "GET /" 400'
+        ),
+    ]
+
+    def test_compiled_equals_legacy(self):
+        for log_format, line in self.fixtures:
+            parser = NginxAccessLogParser(log_format)
+            assert_that(parser.parse(line), equal_to(parser.parse_legacy(line)))
+
+    def test_unparsable_line(self):
+        parser = NginxAccessLogParser()
+        assert_that(parser.parse('garbage'), equal_to(None))
+        assert_that(parser.parse_legacy('garbage'), equal_to(None))
+
+    def test_projection(self):
+        parser = NginxAccessLogParser()
+        line = '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /basic_status HTTP/1.1" 200 110 "-" "curl"'
+
+        parser.project(['status'])
+        assert_that(parser.parse(line), equal_to({
+            'malformed': False,
+            'status': '200',
+            'request': 'GET /basic_status HTTP/1.1',
+            'request_method': 'GET',
+            'request_uri': '/basic_status',
+            'server_protocol': 'HTTP/1.1'
+        }))
+
+        parser.project()
+        assert_that(parser.parse(line), equal_to(parser.parse_legacy(line)))
+
+    def test_decoder_skips_duplicates(self):
+        parser = NginxAccessLogParser('$remote_addr "$request" $status $remote_addr')
+        assert_that([key for index, key, converter in parser.decoder], equal_to(['remote_addr', 'request', 'status']))
+
+
+class LinearParserTestCase(BaseTestCase):
+    def test_linear_formats(self):
+        for log_format, line in CompiledParserTestCase.fixtures:
+            parser = NginxAccessLogParser(log_format)
+            if parser.delimiters is None:
+                continue
+
+            values = parser.split(line)
+            if values is not None:
+                assert_that(values, equal_to(list(parser.regex.match(line).groups())))
+
+    def test_combined_is_linear(self):
+        parser = NginxAccessLogParser()
+        assert_that(parser.delimiters, not_none())
+
+        line = '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /basic_status HTTP/1.1" 200 110 "-" ' + \
+               '"python-requests/2.2.1 CPython/2.7.6 Linux/3.13.0-48-generic"'
+        assert_that(parser.split(line), equal_to([
+            '127.0.0.1', '-', '02/Jul/2015:14:49:48 +0000', 'GET /basic_status HTTP/1.1', '200', '110', '-',
+            'python-requests/2.2.1 CPython/2.7.6 Linux/3.13.0-48-generic'
+        ]))
+
+    def test_ambiguous_formats(self):
+        for log_format in (
+            '$remote_addr$remote_user',  # no delimiter
+            '$request $status',  # $request contains spaces
+            '$remote_addr:$remote_port',  # ipv6 addresses contain colons
+            '"$upstream_addr" $upstream_status $upstream_response_length',  # comma separated lists contain spaces
+        ):
+            parser = NginxAccessLogParser(log_format)
+            assert_that(parser.delimiters, equal_to(None))
+
+    def test_client_variables_with_spaces(self):
+        # $remote_user comes from the Authorization header
+        parser = NginxAccessLogParser()
+        line = '1.2.3.4 - a [b [22/Jan/2010:19:34:21 +0300] "GET /foo/ HTTP/1.1" 200 11078 "-" "curl"'
+        assert_that(parser.split(line), equal_to(None))
+        assert_that(parser.parse(line), has_entries(remote_user='a [b', time_local='22/Jan/2010:19:34:21 +0300'))
+        assert_that(parser.parse(line), equal_to(parser.parse_legacy(line)))
+
+        # nginx accepts spaces in the request line, $uri is decoded
+        for log_format, line in (
+            ('$request_uri $status $remote_addr', '/foo bar 200 1.2.3.4'),
+            ('$uri $status $remote_addr', '/foo bar 200 1.2.3.4'),
+            ('$args $status $remote_addr', 'a=b c 200 1.2.3.4'),
+        ):
+            parser = NginxAccessLogParser(log_format)
+            assert_that(parser.delimiters, not_none())
+            assert_that(parser.split(line), equal_to(None))
+            assert_that(parser.parse(line), equal_to(parser.parse_legacy(line)))
+            assert_that(list(parser.parse_batch(line)), equal_to([parser.parse(line)]))
+
+    def test_fallback_to_regex(self):
+        parser = NginxAccessLogParser('$remote_addr $status "$http_user_agent" $body_bytes_sent')
+        assert_that(parser.delimiters, not_none())
+
+        # status is validated
+        line = '127.0.0.1 2OO "curl" 100'
+        assert_that(parser.split(line), equal_to(None))
+        assert_that(parser.parse(line), equal_to(None))
+
+        # escaped delimiter
+        line = '127.0.0.1 200 "curl \\" 1" 100'
+        assert_that(parser.split(line), equal_to(None))
+        assert_that(parser.parse(line)['http_user_agent'], equal_to('curl \\" 1'))
+
+    def test_max_line_length(self):
+        line = '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /%s HTTP/1.1" 200 110 "-" "curl"' % ('a' * 1000)
+
+        parser = NginxAccessLogParser(max_line_length=2048)
+        assert_that(parser.parse(line), not_none())
+
+        parser = NginxAccessLogParser(max_line_length=512)
+        assert_that(parser.parse(line), equal_to(None))
+
+
+class BatchParserTestCase(BaseTestCase):
+    def test_batch_equals_parse(self):
+        for log_format, line in CompiledParserTestCase.fixtures:
+            parser = NginxAccessLogParser(log_format)
+            parsed = parser.parse(line)
+            expected = [parsed] if parsed else []
+            assert_that(parser.parse_batch('\n'.join([line, line])), equal_to(expected * 2))
+
+    def test_skips_bad_lines(self):
+        parser = NginxAccessLogParser()
+        line = '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /basic_status HTTP/1.1" 200 110 "-" "curl"'
+
+        parsed = parser.parse_batch([line, 'garbage', '', line + '   \r', line])
+        assert_that(parsed, has_length(3))
+        for result in parsed:
+            assert_that(result, equal_to(parser.parse(line)))
+
+    def test_trailing_spaces(self):
+        parser = NginxAccessLogParser('$remote_addr $status $server_name   ')
+        parsed = parser.parse_batch('127.0.0.1 200 example.com   \n127.0.0.1 200 example.com')
+        assert_that(parsed, has_length(2))
+        assert_that(parsed[0]['server_name'], equal_to('example.com'))
+        assert_that(parsed[1]['server_name'], equal_to('example.com'))
+
+    def test_max_line_length(self):
+        parser = NginxAccessLogParser('$remote_addr "$request" $status', max_line_length=100)
+        lines = [
+            '127.0.0.1 "GET / HTTP/1.1" 200',
+            '127.0.0.1 "GET /%s HTTP/1.1" 200' % ('a' * 100),
+            '127.0.0.1 "POST / HTTP/1.1" 200',
+        ]
+        parsed = parser.parse_batch(lines)
+        assert_that(parsed, has_length(2))
+        assert_that(parsed[1]['request_method'], equal_to('POST'))
+
+
+class RecordParserTestCase(BaseTestCase):
+    line = '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /basic_status HTTP/1.1" 200 110 "-" ' + \
+           '"python-requests/2.2.1 CPython/2.7.6 Linux/3.13.0-48-generic"'
+
+    def test_record_equals_dict(self):
+        for log_format, line in CompiledParserTestCase.fixtures:
+            parser = NginxAccessLogParser(log_format)
+            parsed, record = parser.parse(line), parser.parse(line, record=True)
+            assert_that(record, equal_to(parsed))
+            if record is not None:
+                assert_that(sorted(record), equal_to(sorted(parsed)))
+                for key in parsed:
+                    assert_that(record[key], equal_to(parsed[key]))
+
+    def test_record_access(self):
+        parser = NginxAccessLogParser('$remote_addr "$request" $request_time $status')
+        record = parser.parse('127.0.0.1 "GET / HTTP/1.1" - 200', record=True)
+
+        assert_that(record, instance_of(AccessLogRecord))
+        assert_that(record.request_method, equal_to('GET'))
+        assert_that(record['status'], equal_to('200'))
+        assert_that(record.get('status'), equal_to('200'))
+        assert_that(record, has_length(7))
+
+        # skipped values and unknown keys are absent
+        for key in ('request_time', 'upstream_status', 'get', 'keys', 'fields'):
+            assert_that(key in record, equal_to(False))
+            assert_that(record.get(key), equal_to(None))
+            assert_that(calling(record.__getitem__).with_args(key), raises(KeyError))
+
+    def test_batch_records(self):
+        parser = NginxAccessLogParser()
+        records = parser.parse_batch([self.line, 'garbage', self.line], record=True)
+        assert_that(records, equal_to([parser.parse(self.line)] * 2))
+        assert_that(records[0], instance_of(parser.record_class))
+
+    def test_unsupported_keys(self):
+        parser = NginxAccessLogParser('$remote_addr $keys')
+        assert_that(parser.record_class, equal_to(None))
+        assert_that(parser.parse('127.0.0.1 x', record=True), equal_to({
+            'malformed': False, 'remote_addr': '127.0.0.1', 'keys': 'x'
+        }))
+
+    def test_benchmark(self):
+        parser = NginxAccessLogParser()
+        lines = [self.line] * 10000
+
+        results = {}
+        for record in (False, True):
+            parsed = parser.parse_batch(lines, record=record)
+            results[record] = sum(sys.getsizeof(item) for item in parsed)
+
+        assert_that(results[True] * 4, less_than(results[False]))
+        assert_that(hasattr(parser.parse(self.line, record=True), '__dict__'), equal_to(False))
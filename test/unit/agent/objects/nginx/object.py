@@ -8,8 +8,13 @@ from hamcrest import *
 
 import amplify.agent.common.context
 
+from amplify.agent.common.context import context
 from amplify.agent.managers.nginx import NginxManager
-from test.base import RealNginxTestCase, nginx_plus_test, disabled_test
+from amplify.agent.objects.abstract import AbstractObject
+from amplify.agent.objects.nginx.filters import Filter
+from amplify.agent.objects.nginx.object import NginxObject
+from amplify.agent.pipelines.file import FileTailSubscriber
+from test.base import BaseTestCase, RealNginxTestCase, nginx_plus_test, disabled_test
 
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
@@ -185,3 +190,76 @@ class NginxObjectTestCase(RealNginxTestCase):
 
         # just check that everything went ok
         assert_that(nginx_obj, not_none())
+
+
+class LogsOnlyNginxObject(NginxObject):
+    """
+    NginxObject with access log collectors only, nginx is not run and its config is faked
+    """
+
+    def __init__(self, config, **kwargs):
+        AbstractObject.__init__(self, **kwargs)
+        self._config = config
+        self._local_id = self.data['local_id']
+        self.root_uuid = None
+        self.intervals = {'logs': 10}
+        self.filters = [Filter(**raw_filter) for raw_filter in self.data.get('filters') or []]
+        self._setup_access_logs()
+
+    @property
+    def config(self):
+        return self._config
+
+
+class NginxObjectLogsTestCase(BaseTestCase):
+    test_log = 'log/access_shared.log'
+    test_log_link = 'log/access_shared.log.link'
+
+    def setup_method(self, method):
+        super(NginxObjectLogsTestCase, self).setup_method(method)
+        open(self.test_log, 'w').close()
+        os.symlink(os.path.basename(self.test_log), self.test_log_link)
+        self.nginx_config = context.app_config['containers'].setdefault('nginx', {})
+        self.nginx_config.update(log_parse_workers=2, log_parse_workers_min_size=0)
+
+    def teardown_method(self, method):
+        for key in ('log_parse_workers', 'log_parse_workers_min_size'):
+            self.nginx_config.pop(key, None)
+        for filename in (self.test_log, self.test_log_link):
+            os.remove(filename)
+        super(NginxObjectLogsTestCase, self).teardown_method(method)
+
+    def test_parse_workers_shared_log(self):
+        class FakeConfig(object):
+            access_logs = {self.test_log: {'log_format': None}, self.test_log_link: {'log_format': None}}
+            log_formats = {}
+
+        nginx_obj = LogsOnlyNginxObject(FakeConfig(), data={
+            'local_id': 1,
+            'pid': 123,
+            'bin_path': '/usr/sbin/nginx',
+            'workers': [],
+            'filters': [
+                dict(filter_rule_id=1, metric='nginx.http.method.get', data=[['$request_uri', '~', '/1.*']])
+            ]
+        })
+        first, second = nginx_obj.collectors
+        assert_that(first.tail, instance_of(FileTailSubscriber))
+        assert_that(second.tail.shared, same_instance(first.tail.shared))
+
+        with open(self.test_log, 'a') as f:
+            for i in xrange(1000):
+                f.write('127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /%s HTTP/1.1" 200 %s "-" "curl"\n' % (i, i))
+
+        # the file is split into ranges and parsed in workers once for both collectors
+        first.collect()
+        assert_that(first.tail.shared.tail.unread_size(), equal_to(0))
+        assert_that(second.tail.parsed, has_length(greater_than(0)))
+
+        for collector in (first, second):
+            if collector is second:
+                collector.collect()
+            counter = nginx_obj.statsd.flush()['metrics']['counter']
+            assert_that(counter['C|nginx.http.method.get'][0][1], equal_to(1000))
+            assert_that(counter['C|nginx.http.method.get||1'][0][1], equal_to(111))
+            assert_that(collector.tail.unread_size(), equal_to(0))
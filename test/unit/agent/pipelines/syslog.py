@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
+import os
+import socket
+import stat
 import time
 import logging
 from logging.handlers import SysLogHandler
 
 from hamcrest import *
 
-from amplify.agent.pipelines.syslog import SyslogTail, SYSLOG_ADDRESSES, AmplifyAddresssAlreadyInUse
+from amplify.agent.pipelines.syslog import (
+    SyslogTail, SyslogServer, SyslogBuffer, SYSLOG_ADDRESSES, AmplifyAddresssAlreadyInUse, kernel_drops
+)
 from test.base import BaseTestCase, disabled_test
 
 
@@ -79,3 +84,289 @@ class SyslogTailTestCase(BaseTestCase):
             calling(SyslogTail).with_args(address=('localhost', 514)),
             raises(AmplifyAddresssAlreadyInUse)
         )
+
+
+class SyslogServerTestCase(BaseTestCase):
+    def setup_method(self, method):
+        super(SyslogServerTestCase, self).setup_method(method)
+        self.cache = SyslogBuffer(max_size=1200)
+        self.server = SyslogServer(self.cache, ('127.0.0.1', 0), chunk_size=64, rcvbuf=256 * 1024)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def teardown_method(self, method):
+        self.client.close()
+        self.server.close()
+        SYSLOG_ADDRESSES.discard(self.server.address)
+        super(SyslogServerTestCase, self).teardown_method(method)
+
+    def send(self, message):
+        self.client.sendto('<190>Jan  1 00:00:00 host amplify: %s' % message, self.server.address)
+
+    def test_drain(self):
+        assert_that(self.server.wait(0), equal_to(False))
+        assert_that(self.server.drain(), equal_to(0))
+
+        for i in xrange(50):
+            self.send('message #%s' % i)
+
+        assert_that(self.server.wait(1.0), equal_to(True))
+        assert_that(self.server.drain(), equal_to(50))
+        assert_that(list(self.cache), equal_to(['message #%s' % i for i in xrange(50)]))
+        assert_that(self.server.received, equal_to(50))
+        assert_that(self.server.dropped, equal_to(0))
+        assert_that(self.server.truncated, equal_to(0))
+
+    def test_drain_max_batch(self):
+        self.server.max_batch = 20
+        for i in xrange(50):
+            self.send('message #%s' % i)
+
+        # a flood is read in batches of max_batch datagrams
+        assert_that(self.server.wait(1.0), equal_to(True))
+        assert_that(self.server.drain(), equal_to(20))
+        assert_that(self.cache, has_length(20))
+        assert_that(self.server.drain(), equal_to(20))
+        assert_that(self.server.drain(), equal_to(10))
+        assert_that(list(self.cache), equal_to(['message #%s' % i for i in xrange(50)]))
+        assert_that(self.server.received, equal_to(50))
+
+    def test_truncated(self):
+        self.send('x' * 100)
+        self.server.wait(1.0)
+        self.server.drain()
+
+        assert_that(self.server.truncated, equal_to(1))
+        assert_that(self.cache[0], equal_to('x' * (64 - len('<190>Jan  1 00:00:00 host amplify: '))))
+
+    def test_dropped(self):
+        for i in xrange(150):
+            self.send('message #%03d' % i)
+        self.server.wait(1.0)
+        self.server.drain()
+
+        # 100 messages of 12 bytes fit
+        assert_that(self.server.received, equal_to(150))
+        assert_that(self.server.dropped, equal_to(50))
+        assert_that(self.cache, has_length(100))
+        assert_that(self.cache[0], equal_to('message #050'))
+
+    def test_kernel_drops(self):
+        assert_that(kernel_drops(self.server.socket), any_of(none(), equal_to(0)))
+
+
+class SyslogTailHandoffTestCase(BaseTestCase):
+    def setup_method(self, method):
+        super(SyslogTailHandoffTestCase, self).setup_method(method)
+        self.tail = SyslogTail(address=('127.0.0.1', 0), buffer_size=64 * 1024 * 1024, interval=0.1)
+
+    def teardown_method(self, method):
+        self.tail.stop()
+        self.tail = None
+        super(SyslogTailHandoffTestCase, self).teardown_method(method)
+
+    def test_swap(self):
+        server = self.tail.listener.server
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            client.sendto('<190>host amplify: first', server.address)
+            server.wait(1.0)
+            server.drain()
+            assert_that(list(self.tail), equal_to(['first']))
+
+            # the listener appends to the new cache
+            assert_that(server.cache, same_instance(self.tail.cache))
+            client.sendto('<190>host amplify: second', server.address)
+            server.wait(1.0)
+            server.drain()
+            assert_that(list(self.tail), equal_to(['second']))
+        finally:
+            client.close()
+
+    def test_read_chunks(self):
+        lines = ['line %s' % i for i in xrange(2500)]
+        self.tail.cache.extend(lines)
+
+        chunks = list(self.tail.read_chunks(batch_lines=1000))
+        assert_that(chunks, has_length(3))
+        assert_that('\n'.join(chunks).split('\n'), equal_to(lines))
+        assert_that(self.tail.cache, empty())
+
+    def test_read_chunks_interrupted(self):
+        lines = ['line %s' % i for i in xrange(2500)]
+        self.tail.cache.extend(lines)
+
+        chunks = self.tail.read_chunks(batch_lines=1000)
+        first = next(chunks)
+        self.tail.cache.append('newer')
+        chunks.close()
+
+        # the rest is returned before newer messages
+        assert_that(first.split('\n'), equal_to(lines[:1000]))
+        assert_that(list(self.tail), equal_to(lines[1000:] + ['newer']))
+        assert_that(self.tail.listener.server.cache, same_instance(self.tail.cache))
+
+    def test_handoff_no_copy(self):
+        """
+        A second of messages at 100k lines/s is handed to the reader as is, nothing is copied
+        """
+        lines = ['127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /%s HTTP/1.1" 200 10 "-" "curl"' % i
+                 for i in xrange(100000)]
+
+        self.tail.cache.extend(lines)
+        cache = self.tail.cache
+        swapped = list(self.tail)
+
+        assert_that(swapped, equal_to(lines))
+        assert_that(swapped[0], same_instance(lines[0]))
+        assert_that(swapped[-1], same_instance(lines[-1]))
+        assert_that(self.tail.cache, is_not(same_instance(cache)))  # the listener got a new buffer
+        assert_that(self.tail.cache, empty())
+
+    def test_stats(self):
+        server = self.tail.listener.server
+        server.received, server.truncated, server.overflows = 10, 1, 2
+        self.tail.cache.extend(['x' * 100, 'y' * 50])
+        list(self.tail)
+
+        stats = self.tail.stats()
+        assert_that(stats, has_entries({'received': 10, 'truncated': 1, 'buffer.peak': 150}))
+        assert_that(stats['dropped'], greater_than_or_equal_to(2))
+
+        # counters are reported since the last call
+        server.received = 15
+        stats = self.tail.stats()
+        assert_that(stats, has_entries({'received': 5, 'truncated': 0, 'buffer.peak': 0}))
+
+    def test_report(self):
+        listener = self.tail.listener
+        listener.statsd = FakeStatsd()
+        listener.server.received = 3
+        self.tail.cache.extend(['x' * 100])
+        list(self.tail)
+
+        listener.report()
+
+        # once per listener, named by its address
+        address = '127.0.0.1:%s' % listener.server.address[1]
+        assert_that(listener.statsd.gauges, has_entries({'amplify.agent.syslog.buffer.peak||%s' % address: 100}))
+
+        # counters add up if reported more than once per flush
+        listener.server.received = 5
+        listener.report()
+        assert_that(listener.statsd.counters['amplify.agent.syslog.received||%s' % address], equal_to(5))
+
+
+class FakeStatsd(object):
+    def __init__(self):
+        self.interval = 60
+        self.counters = {}
+        self.gauges = {}
+
+    def incr(self, metric_name, value=1):
+        self.counters[metric_name] = self.counters.get(metric_name, 0) + value
+
+    def agent(self, metric_name, value):
+        self.gauges[metric_name] = value
+
+
+class SyslogBufferTestCase(BaseTestCase):
+    def test_max_size(self):
+        buffer = SyslogBuffer(max_size=100)
+        assert_that(buffer.append('a' * 60), equal_to(0))
+        assert_that(buffer.append('b' * 30), equal_to(0))
+        assert_that(buffer.append('c' * 30), equal_to(1))
+
+        assert_that(list(buffer), equal_to(['b' * 30, 'c' * 30]))
+        assert_that(buffer.size, equal_to(60))
+        assert_that(buffer.peak, equal_to(90))
+        assert_that(buffer.dropped, equal_to(1))
+
+        assert_that(buffer.popleft(), equal_to('b' * 30))
+        assert_that(buffer.size, equal_to(30))
+        assert_that(buffer.extend(['d' * 50, 'e' * 50]), equal_to(1))
+        assert_that(list(buffer), equal_to(['d' * 50, 'e' * 50]))
+
+
+class UnixSyslogServerTestCase(BaseTestCase):
+    socket_path = 'log/syslog.sock'
+
+    def setup_method(self, method):
+        super(UnixSyslogServerTestCase, self).setup_method(method)
+        self.cache = SyslogBuffer(max_size=36)
+        self.client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.client.settimeout(1.0)
+
+    def teardown_method(self, method):
+        self.client.close()
+        SYSLOG_ADDRESSES.discard(self.socket_path)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        super(UnixSyslogServerTestCase, self).teardown_method(method)
+
+    def test_drain(self):
+        server = SyslogServer(self.cache, self.socket_path, chunk_size=64)
+        try:
+            assert_that(server.address, equal_to(self.socket_path))
+
+            # less than net.unix.max_dgram_qlen (10 by default), a sender blocks when the queue is full
+            self.client.sendto('<190>host amplify: %s' % ('x' * 100), self.socket_path)
+            for i in xrange(5):
+                self.client.sendto('<190>host amplify: message #%03d' % i, self.socket_path)
+
+            assert_that(server.wait(1.0), equal_to(True))
+            assert_that(server.drain(), equal_to(6))
+            assert_that(server.received, equal_to(6))
+            assert_that(server.truncated, equal_to(1))
+            assert_that(server.dropped, equal_to(3))  # 3 messages of 12 bytes fit
+            assert_that(list(self.cache), equal_to(['message #%03d' % i for i in xrange(2, 5)]))
+        finally:
+            server.close()
+
+        assert_that(os.path.exists(self.socket_path), equal_to(False))
+
+    def test_socket_mode(self):
+        server = SyslogServer(self.cache, self.socket_path)
+        try:
+            # not writable by others, nginx user should be in the agent group
+            assert_that(stat.S_IMODE(os.stat(self.socket_path).st_mode), equal_to(0o660))
+        finally:
+            server.close()
+
+        server = SyslogServer(self.cache, self.socket_path, socket_mode=0o600)
+        try:
+            assert_that(stat.S_IMODE(os.stat(self.socket_path).st_mode), equal_to(0o600))
+        finally:
+            server.close()
+
+    def test_stale_socket(self):
+        SyslogServer(self.cache, self.socket_path).socket.close()  # killed without close()
+        assert_that(os.path.exists(self.socket_path), equal_to(True))
+
+        server = SyslogServer(self.cache, self.socket_path)
+        try:
+            self.client.sendto('<190>host amplify: message', self.socket_path)
+            server.wait(1.0)
+            server.drain()
+            assert_that(list(self.cache), equal_to(['message']))
+        finally:
+            server.close()
+
+    def test_tail(self):
+        tail = SyslogTail(address=self.socket_path, interval=0.1)
+        try:
+            self.client.sendto('<190>host amplify: message', self.socket_path)
+
+            # the listener greenlet drains the socket while this one sleeps
+            messages = []
+            deadline = time.time() + 5.0
+            while not messages and time.time() < deadline:
+                time.sleep(0.01)
+                messages.extend(tail)
+            assert_that(messages, equal_to(['message']))
+            assert_that(tail.stats(), has_entries(received=1, dropped=0))
+
+            tail.listener.statsd = FakeStatsd()
+            tail.listener.report()
+            assert_that(tail.listener.statsd.counters, has_key('amplify.agent.syslog.received||%s' % self.socket_path))
+        finally:
+            tail.stop()
@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
+import json
 import os
+import shutil
+import time
+import weakref
 
 from hamcrest import *
 
-from amplify.agent.pipelines.file import FileTail
+from amplify.agent.common.context import context
+from amplify.agent.common.util import inotify
+from amplify.agent.pipelines import file
+from amplify.agent.pipelines.file import FileTail, read_range, save_offsets, shared_tail
 from test.base import BaseTestCase
 
 __author__ = "Mike Belov"
@@ -110,3 +117,526 @@ class TailTestCase(BaseTestCase):
         # create new
         tail = FileTail(filename=self.test_log)
         assert_that(tail._offset, equal_to(old_offset))
+
+    def test_read_chunks(self):
+        tail = FileTail(filename=self.test_log)
+        for i in xrange(100):
+            self.write_log('this is %s line' % i)
+
+        chunks = list(tail.read_chunks(size=64))
+        lines = '\n'.join(chunks).split('\n')
+        assert_that(lines, equal_to(['this is %s line' % i for i in xrange(100)]))
+        assert_that(tail._offset, equal_to(os.path.getsize(self.test_log)))
+
+        # nothing new
+        assert_that(list(tail.read_chunks()), has_length(0))
+
+    def test_read_chunks_partial_line(self):
+        tail = FileTail(filename=self.test_log)
+        with open(self.test_log, 'a') as f:
+            f.write('complete\nparti')
+
+        assert_that(list(tail.read_chunks()), equal_to(['complete']))
+
+        with open(self.test_log, 'a') as f:
+            f.write('al\n')
+
+        assert_that(list(tail.read_chunks()), equal_to(['partial']))
+        assert_that(tail.readlines(), has_length(0))
+
+    def test_read_ranges(self):
+        tail = FileTail(filename=self.test_log)
+        with open(self.test_log, 'a') as f:
+            for i in xrange(100):
+                f.write('this is %s line\n' % i)
+            f.write('parti')
+
+        assert_that(tail.unread_size(), equal_to(os.path.getsize(self.test_log) - tail._offset))
+
+        ranges = tail.read_ranges(3)
+        assert_that(ranges, has_length(3))
+        assert_that(tail._offset, equal_to(os.path.getsize(self.test_log) - len('parti')))
+
+        lines = []
+        for start, end in ranges:
+            chunks = list(read_range(self.test_log, start, end, size=32))
+            lines.extend('\n'.join(chunks).split('\n'))
+        assert_that(lines, equal_to(['this is %s line' % i for i in xrange(100)]))
+
+        # nothing new, partial line is left
+        assert_that(tail.read_ranges(3), has_length(0))
+        with open(self.test_log, 'a') as f:
+            f.write('al\n')
+        assert_that(list(tail.read_chunks()), equal_to(['partial']))
+
+    def test_read_ranges_small(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('a')
+        self.write_log('b')
+
+        ranges = tail.read_ranges(8)
+        assert_that(ranges, has_length(2))
+        assert_that(['\n'.join(read_range(self.test_log, start, end)) for start, end in ranges], equal_to(['a', 'b']))
+
+    def test_read_batch(self):
+        tail = FileTail(filename=self.test_log, block_size=16)
+        lines = ['this is %s line' % i for i in xrange(20)] + ['long line ' * 10, '', 'trailing space ']
+        with open(self.test_log, 'a') as f:
+            f.write('\n'.join(lines) + '\nparti')
+
+        batches = []
+        batch = tail.read_batch()
+        while batch:
+            batches.append(batch)
+            batch = tail.read_batch()
+
+        assert_that(len(batches), greater_than(1))
+        assert_that(sum(batches, []), equal_to([line.rstrip() for line in lines]))
+        assert_that(tail._offset, equal_to(os.path.getsize(self.test_log) - len('parti')))
+
+        with open(self.test_log, 'a') as f:
+            f.write('al\n')
+        assert_that(tail.read_batch(), equal_to(['partial']))
+        assert_that(tail._offset, equal_to(os.path.getsize(self.test_log)))
+
+    def test_iterator_and_batch(self):
+        tail = FileTail(filename=self.test_log, block_size=64)
+        for i in xrange(10):
+            self.write_log('this is %s line' % i)
+
+        assert_that(tail.next(), equal_to('this is 0 line'))
+        assert_that(tail.read_batch(), equal_to(['this is %s line' % i for i in xrange(1, 4)]))
+        assert_that(list(tail), equal_to(['this is %s line' % i for i in xrange(4, 10)]))
+
+    def test_rotate_offset(self):
+        tail = FileTail(filename=self.test_log, block_size=16)
+        with open(self.test_log, 'a') as f:
+            f.write('old line\nparti')
+        assert_that(tail.readlines(), equal_to(['old line']))
+
+        # the partial line is lost with the old file, the new one is read from the beginning
+        os.rename(self.test_log, self.test_log_rotated)
+        with open(self.test_log, 'a') as f:
+            f.write('new line\nnew parti')
+
+        assert_that(tail.readlines(), equal_to(['new line']))
+        assert_that(tail._offset, equal_to(len('new line\n')))
+
+        # the offset survives reloads
+        tail = FileTail(filename=self.test_log)
+        with open(self.test_log, 'a') as f:
+            f.write('al\n')
+        assert_that(tail.readlines(), equal_to(['new partial']))
+
+    def test_watcher(self):
+        tail = FileTail(filename=self.test_log)
+        assert_that(tail.watcher, not_none())
+
+        self.write_log('something')
+        assert_that(tail.readlines(), equal_to(['something']))
+        assert_that(tail.watcher.changed(), equal_to(False))
+
+        # nothing is read while nothing is written
+        assert_that(tail.readlines(), has_length(0))
+        self.write_log('something else')
+        assert_that(tail.watcher.changed(), equal_to(True))
+        assert_that(tail.readlines(), equal_to(['something else']))
+
+    def test_rotate_reads_old_file(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('first')
+        assert_that(tail.readlines(), equal_to(['first']))
+
+        self.write_log('from the old file')
+        os.rename(self.test_log, self.test_log_rotated)
+
+        # the old file is read until a new one appears, without waiting for it
+        start = time.time()
+        self.write_log_rotated('written after rename')
+        assert_that(tail.readlines(), equal_to(['from the old file', 'written after rename']))
+        assert_that(time.time() - start, less_than(0.5))
+
+        self.write_log('from a new file')
+        self.write_log_rotated('late line')
+        assert_that(tail.readlines(), equal_to(['late line', 'from a new file']))
+        assert_that(tail._offset, equal_to(os.path.getsize(self.test_log)))
+        assert_that(tail._rotated_fh, none())
+
+    def test_watchers_share_inotify(self):
+        self.write_log_rotated('other file')
+        tail = FileTail(filename=self.test_log)
+        other = FileTail(filename=self.test_log_rotated)
+        assert_that(other.watcher.dispatcher, same_instance(tail.watcher.dispatcher))
+
+        # the directory is watched once for both files
+        assert_that(other.watcher.directory_wd, equal_to(tail.watcher.directory_wd))
+        other.watcher.close()
+        self.write_log('something')
+        assert_that(tail.readlines(), equal_to(['something']))
+
+    def test_missed_rotation(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('from the old file')
+        assert_that(tail.readlines(), equal_to(['from the old file']))
+
+        os.rename(self.test_log, self.test_log_rotated)
+        self.write_log('from a new file')
+        tail.watcher.dispatcher.inotify.read_events()  # events are lost
+
+        # the inode is checked every verify_interval polls anyway
+        for _ in xrange(tail.watcher.verify_interval):
+            lines = tail.readlines()
+            if lines:
+                break
+        assert_that(lines, equal_to(['from a new file']))
+
+    def test_queue_overflow(self):
+        tail = FileTail(filename=self.test_log)
+        tail.readlines()
+
+        os.rename(self.test_log, self.test_log_rotated)
+        self.write_log('from a new file')
+
+        dispatcher = tail.watcher.dispatcher
+        dispatcher.inotify.read_events()
+        read_events = dispatcher.inotify.read_events
+        dispatcher.inotify.read_events = lambda: [(-1, inotify.IN_Q_OVERFLOW, '')]
+        try:
+            dispatcher.poll()
+        finally:
+            dispatcher.inotify.read_events = read_events
+
+        assert_that(tail.watcher.verify, equal_to(True))
+        assert_that(tail.readlines(), equal_to(['from a new file']))
+
+    def test_moved_without_new_file(self):
+        tail = FileTail(filename=self.test_log)
+        tail.readlines()
+
+        os.rename(self.test_log, self.test_log_rotated)
+        self.write_log_rotated('written after rename')
+        tail.watcher.dispatcher.inotify.read_events()
+        tail.watcher.handle(tail.watcher.file_wd, inotify.IN_MOVE_SELF, '')
+
+        # the moved file is read until a new one appears
+        assert_that(tail.readlines(), equal_to(['written after rename']))
+        self.write_log('from a new file')
+        assert_that(tail.readlines(), equal_to(['from a new file']))
+
+    def test_polling(self):
+        tail = FileTail(filename=self.test_log, watch=False)
+        assert_that(tail.watcher, none())
+
+        self.write_log('from the old file')
+        assert_that(tail.readlines(), equal_to(['from the old file']))
+        os.rename(self.test_log, self.test_log_rotated)
+        self.write_log('from a new file')
+        assert_that(tail.readlines(), equal_to(['from a new file']))
+
+    def write_log_rotated(self, line):
+        os.system('echo %s >> %s' % (line, self.test_log_rotated))
+
+    def test_catchup(self):
+        # offset in the middle of a mapping page
+        with open(self.test_log, 'a') as f:
+            f.write('x' * 5000 + '\n')
+        tail = FileTail(filename=self.test_log, catchup_size=1024)
+
+        lines = ['this is %s line' % i for i in xrange(1000)] + ['long line ' * 100]
+        with open(self.test_log, 'a') as f:
+            f.write('\n'.join(lines) + '\nparti')
+
+        mapped = list(tail._read_mapped(256))
+        assert_that(len(mapped), greater_than(10))
+        assert_that('\n'.join(mapped).split('\n'), equal_to(lines))
+        assert_that(tail._offset, equal_to(os.path.getsize(self.test_log) - len('parti')))
+
+        # back to normal reads
+        with open(self.test_log, 'a') as f:
+            f.write('al\n')
+        assert_that(list(tail.read_chunks()), equal_to(['partial']))
+
+    def test_catchup_switches_on(self):
+        tail = FileTail(filename=self.test_log, catchup_size=1024)
+        calls = []
+        read_mapped = tail._read_mapped
+
+        def _read_mapped(size):
+            calls.append(tail.unread_size())
+            return read_mapped(size)
+        tail._read_mapped = _read_mapped
+
+        self.write_log('a')
+        assert_that(list(tail.read_chunks()), equal_to(['a']))
+        assert_that(calls, empty())
+
+        with open(self.test_log, 'a') as f:
+            for i in xrange(100):
+                f.write('this is %s line\n' % i)
+        chunks = list(tail.read_chunks(size=128))
+        assert_that('\n'.join(chunks).split('\n'), equal_to(['this is %s line' % i for i in xrange(100)]))
+        assert_that(calls, has_length(1))
+
+    def test_catchup_truncated(self):
+        tail = FileTail(filename=self.test_log, catchup_size=1024)
+        with open(self.test_log, 'a') as f:
+            for i in xrange(100):
+                f.write('this is %s line\n' % i)
+
+        chunks = tail._read_mapped(64)
+        first = next(chunks)
+        offset = tail._offset
+
+        # copytruncate
+        with open(self.test_log, 'w'):
+            pass
+        assert_that(list(chunks), empty())
+        assert_that(first, starts_with('this is 0 line'))
+        assert_that(tail._offset, equal_to(offset))
+
+
+class OffsetCheckpointTestCase(BaseTestCase):
+    test_log = 'log/something.log'
+    test_log_rotated = 'log/something.log.rotated'
+    state_dir = 'log/state'
+
+    def setup_method(self, method):
+        super(OffsetCheckpointTestCase, self).setup_method(method)
+        self.write_log('start')
+        os.mkdir(self.state_dir)
+        context.app_config['daemon']['state_dir'] = self.state_dir
+
+    def teardown_method(self, method):
+        context.app_config['daemon']['state_dir'] = None
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+        for filename in (self.test_log, self.test_log_rotated):
+            if os.path.exists(filename):
+                os.remove(filename)
+        super(OffsetCheckpointTestCase, self).teardown_method(method)
+
+    def write_log(self, line):
+        os.system('echo %s >> %s' % (line, self.test_log))
+
+    def restart(self):
+        """
+        Forgets everything in memory, like a new agent process does
+        """
+        file.OFFSET_CACHE = {}
+        file.FILE_IDS = {}
+        file.CHECKPOINTS = {}
+        file.SHARED_TAILS = {}
+        file.TAILS = weakref.WeakValueDictionary()
+
+    def test_restore(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('a')
+        assert_that(tail.readlines(), equal_to(['a']))
+        save_offsets()
+
+        self.restart()
+        self.write_log('b')
+        self.write_log('c')
+        tail = FileTail(filename=self.test_log)
+        assert_that(tail.readlines(), equal_to(['b', 'c']))
+
+    def test_nothing_saved(self):
+        self.restart()
+        self.write_log('a')
+        tail = FileTail(filename=self.test_log)
+        assert_that(tail.readlines(), empty())
+
+    def test_rotated_while_stopped(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('a')
+        tail.readlines()
+        save_offsets()
+
+        self.restart()
+        os.rename(self.test_log, self.test_log_rotated)
+        self.write_log('new file')
+        tail = FileTail(filename=self.test_log)
+        assert_that(tail.readlines(), equal_to(['new file']))
+
+    def test_max_backlog(self):
+        FileTail(filename=self.test_log)
+        save_offsets()
+
+        self.restart()
+        with open(self.test_log, 'a') as f:
+            for i in xrange(100):
+                f.write('this is %s line\n' % i)
+        tail = FileTail(filename=self.test_log, max_backlog=64)
+        lines = tail.readlines()
+        assert_that(lines, has_length(less_than(5)))
+        assert_that(lines[-1], equal_to('this is 99 line'))
+        for line in lines:
+            assert_that(line, starts_with('this is '))
+
+    def test_save_atomic(self):
+        FileTail(filename=self.test_log)
+        save_offsets()
+
+        offsets_filename = os.path.join(self.state_dir, file.OFFSETS_FILENAME)
+        with open(offsets_filename) as f:
+            state = json.load(f)
+        st = os.stat(self.test_log)
+        assert_that(state, has_entry(
+            self.test_log, has_entries(offset=st.st_size, dev=st.st_dev, inode=st.st_ino)
+        ))
+        assert_that(os.listdir(self.state_dir), equal_to([file.OFFSETS_FILENAME]))
+
+        # not rewritten if nothing has changed
+        os.utime(offsets_filename, (0, 0))
+        save_offsets()
+        assert_that(os.stat(offsets_filename).st_mtime, equal_to(0))
+
+    def test_unconsumed_lines(self):
+        tail = FileTail(filename=self.test_log)
+        for line in ('a', 'b', 'c'):
+            self.write_log(line)
+        assert_that(next(tail), equal_to('a'))  # the whole block is read, b and c are not handed out yet
+        save_offsets()
+
+        self.restart()
+        tail = FileTail(filename=self.test_log)
+        assert_that(tail.readlines(), equal_to(['b', 'c']))
+
+    def test_shared_tail_slowest_subscriber(self):
+        first = shared_tail(self.test_log)
+        second = shared_tail(self.test_log)
+        start = os.stat(self.test_log).st_size
+        for line in ('a', 'b'):
+            self.write_log(line)
+
+        assert_that(first.readlines(), equal_to(['a', 'b']))
+        save_offsets()
+        assert_that(self.saved_offset(), equal_to(start))  # a and b are still queued for the second subscriber
+
+        assert_that(next(second), equal_to('a'))
+        save_offsets()
+        assert_that(self.saved_offset(), equal_to(start + 2))
+
+        assert_that(second.readlines(), equal_to(['b']))
+        save_offsets()
+        assert_that(self.saved_offset(), equal_to(os.stat(self.test_log).st_size))
+
+    def saved_offset(self):
+        with open(os.path.join(self.state_dir, file.OFFSETS_FILENAME)) as f:
+            return json.load(f)[self.test_log]['offset']
+
+
+class SharedTailTestCase(BaseTestCase):
+    test_log = 'log/something.log'
+    test_log_link = 'log/something.log.link'
+    test_log_rotated = 'log/something.log.rotated'
+
+    def setup_method(self, method):
+        super(SharedTailTestCase, self).setup_method(method)
+        self.write_log('start')
+
+    def teardown_method(self, method):
+        for filename in (self.test_log, self.test_log_link, self.test_log_rotated):
+            if os.path.lexists(filename):
+                os.remove(filename)
+        super(SharedTailTestCase, self).teardown_method(method)
+
+    def write_log(self, line):
+        os.system('echo %s >> %s' % (line, self.test_log))
+
+    def test_read_once(self):
+        os.symlink(os.path.basename(self.test_log), self.test_log_link)
+        first = shared_tail(self.test_log)
+        second = shared_tail(self.test_log_link)
+        assert_that(file.SHARED_TAILS, has_length(1))
+        assert_that(second.shared, same_instance(first.shared))
+
+        reads = []
+        read_chunks = first.shared.tail.read_chunks
+
+        def counted_read_chunks(size=None):
+            for chunk in read_chunks(size):
+                reads.append(chunk)
+                yield chunk
+        first.shared.tail.read_chunks = counted_read_chunks
+
+        for i in xrange(5):
+            self.write_log('line %s' % i)
+        expected = ['line %s' % i for i in xrange(5)]
+        assert_that(first.readlines(), equal_to(expected))
+        assert_that(second.readlines(), equal_to(expected))
+        assert_that(reads, equal_to(['\n'.join(expected)]))  # the file is read once
+
+        self.write_log('more')
+        assert_that(list(second.read_chunks()), equal_to(['more']))
+        assert_that(list(first.read_chunks()), equal_to(['more']))
+        assert_that(first.unread_size(), equal_to(0))
+
+    def test_max_pending(self):
+        first = shared_tail(self.test_log, max_pending=10)
+        second = shared_tail(self.test_log, max_pending=10)
+
+        self.write_log('0123456789')
+        assert_that(first.readlines(), equal_to(['0123456789']))
+
+        # nothing is read until the second subscriber catches up
+        self.write_log('abc')
+        assert_that(first.readlines(), empty())
+        assert_that(first.unread_size(), equal_to(4))
+        assert_that(second.unread_size(), equal_to(15))
+
+        assert_that(second.readlines(), equal_to(['0123456789', 'abc']))
+        assert_that(first.readlines(), equal_to(['abc']))
+
+    def test_unsubscribe(self):
+        first = shared_tail(self.test_log)
+        second = shared_tail(self.test_log)
+        first.stop()
+        assert_that(file.SHARED_TAILS, has_length(1))
+
+        self.write_log('a')
+        assert_that(second.readlines(), equal_to(['a']))
+        assert_that(first.chunks, empty())
+
+        second.stop()
+        assert_that(file.SHARED_TAILS, empty())
+
+    def test_ranges(self):
+        parsing = shared_tail(self.test_log)
+        parsing.parse_args = ('format', [])
+        other_parsing = shared_tail(self.test_log)
+        other_parsing.parse_args = ('format', [])
+        reading = shared_tail(self.test_log)
+
+        for i in xrange(10):
+            self.write_log('line %s' % i)
+        size = parsing.unread_size()
+        ranges = parsing.read_ranges(2)
+        assert_that(ranges, has_length(2))
+        assert_that(parsing.range_subscribers(), equal_to([parsing, other_parsing]))
+
+        # results are handed to subscribers which parse ranges, lines to the others
+        for start, end in ranges:
+            other_parsing.put_parsed(5, 'result', end - start)
+        parsing.ranges_parsed(ranges)
+        assert_that(parsing.unread_size(), equal_to(0))
+        assert_that(other_parsing.unread_size(), equal_to(size))
+        assert_that(other_parsing.take_parsed(), equal_to([(5, 'result'), (5, 'result')]))
+        assert_that(other_parsing.unread_size(), equal_to(0))
+        assert_that(reading.readlines(), equal_to(['line %s' % i for i in xrange(10)]))
+
+        # queued chunks go first
+        self.write_log('a')
+        assert_that(next(reading), equal_to('a'))
+        self.write_log('b')
+        assert_that(parsing.read_ranges(2), empty())
+        assert_that(parsing.readlines(), equal_to(['a', 'b']))
+
+    def test_rotated(self):
+        first = shared_tail(self.test_log)
+        os.rename(self.test_log, self.test_log_rotated)
+        self.write_log('new file')
+        assert_that(first.readlines(), equal_to(['new file']))
+
+        # the reader follows the file name
+        second = shared_tail(self.test_log)
+        assert_that(second.shared, same_instance(first.shared))